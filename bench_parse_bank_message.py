@@ -0,0 +1,133 @@
+"""
+قياس سرعة ودقة تحليل رسائل البنك (parse_bank_message) على مجموعة رسائل معنونة
+
+المجموعة في bench_bank_messages.jsonl: رسائل مجهولة الهوية بصيغ الأهلي والراجحي
+و STC Pay وبطاقة ماستر (عربي وإنجليزي)، ولكل رسالة القيم الصحيحة المتوقعة:
+النوع والمبلغ والحساب والتاريخ والتصنيف. التاريخ null يعني أن الرسالة بلا تاريخ
+فالمتوقع تاريخ اليوم.
+
+الاستخدام:
+    python bench_parse_bank_message.py [--corpus FILE] [--repeat N] [--show N]
+                                       [--save FILE] [--baseline FILE]
+
+--save يحفظ الدقة لكل حقل، و --baseline يقارن بها ويخرج بخطأ إذا نقصت دقة أي حقل
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+
+from finance import parse_bank_message
+
+FIELDS = ('type', 'amount', 'account', 'date', 'category')
+
+def load_corpus(path):
+    """قراءة المجموعة المعنونة (سطر JSON لكل رسالة)"""
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def field_matches(field, expected, actual):
+    """مقارنة حقل واحد من نتيجة التحليل بالقيمة المتوقعة"""
+    if field == 'amount':
+        return actual is not None and abs(actual - expected) < 0.005
+    if field == 'account' and actual:
+        # أسماء الحسابات في الإعدادات قد تحمل مسافة زائدة في آخرها
+        return actual.strip() == expected
+    if field == 'date' and expected is None:
+        return actual == datetime.now().strftime('%Y-%m-%d')
+    return actual == expected
+
+def percentile(sorted_values, fraction):
+    """قيمة المئين من قائمة مرتبة (أقرب رتبة)"""
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def run(corpus, repeat):
+    """تحليل كل رسالة repeat مرة: زمن كل استدعاء ونتيجة آخر تحليل لكل رسالة"""
+    latencies = []
+    results = []
+    for sample in corpus:
+        message = sample['message']
+        for _ in range(repeat):
+            started = time.perf_counter_ns()
+            result = parse_bank_message(message)
+            latencies.append(time.perf_counter_ns() - started)
+        results.append(result)
+    return latencies, results
+
+def score(corpus, results):
+    """الدقة لكل حقل ولكل بنك، وقائمة الأخطاء"""
+    correct = dict.fromkeys(FIELDS, 0)
+    per_bank = {}
+    mistakes = []
+    for sample, result in zip(corpus, results):
+        bank = per_bank.setdefault(sample['bank'], [0, 0])
+        bank[1] += 1
+        wrong = [field for field in FIELDS
+                 if not field_matches(field, sample['expected'][field], result.get(field))]
+        for field in FIELDS:
+            if field not in wrong:
+                correct[field] += 1
+        if wrong:
+            mistakes.append((sample, result, wrong))
+        else:
+            bank[0] += 1
+    accuracy = {field: correct[field] / len(corpus) for field in FIELDS}
+    accuracy['all'] = (len(corpus) - len(mistakes)) / len(corpus)
+    return accuracy, per_bank, mistakes
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس سرعة ودقة parse_bank_message")
+    parser.add_argument('--corpus', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         'bench_bank_messages.jsonl'))
+    parser.add_argument('--repeat', type=int, default=200, help="عدد مرات تحليل كل رسالة")
+    parser.add_argument('--show', type=int, default=10, help="عدد الأخطاء المعروضة")
+    parser.add_argument('--save', help="حفظ الدقة في ملف JSON")
+    parser.add_argument('--baseline', help="ملف دقة سابق للمقارنة")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    # تحمية: أول استدعاء يدفع كلفة تجميع الأنماط
+    run(corpus, 1)
+    latencies, results = run(corpus, args.repeat)
+    accuracy, per_bank, mistakes = score(corpus, results)
+
+    latencies.sort()
+    total = sum(latencies) / 1e9
+    print(f"الرسائل: {len(corpus)} × {args.repeat} | {len(latencies) / total:,.0f} رسالة/ثانية")
+    print(f"زمن الرسالة: p50 {percentile(latencies, 0.50) / 1000:.1f} µs | "
+          f"p99 {percentile(latencies, 0.99) / 1000:.1f} µs | "
+          f"الأقصى {latencies[-1] / 1000:.1f} µs")
+    print("الدقة: " + " | ".join(f"{field} {accuracy[field]:.1%}" for field in FIELDS) +
+          f" | كل الحقول {accuracy['all']:.1%}")
+    print("لكل بنك: " + " | ".join(f"{bank} {ok}/{count}" for bank, (ok, count) in per_bank.items()))
+    if mistakes and args.show:
+        print()
+
+    for sample, result, wrong in mistakes[:args.show]:
+        if 'raw_message' in result:
+            print(f"✗ {sample['id']}: لم تُحلل")
+            continue
+        print(f"✗ {sample['id']}: " + ", ".join(
+            f"{field} {sample['expected'][field]!r} ≠ {result.get(field)!r}" for field in wrong))
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(accuracy, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = [field for field in baseline if accuracy.get(field, 0) < baseline[field]]
+        if regressions:
+            print("\n❌ نقصت الدقة في: " + ", ".join(
+                f"{field} ({baseline[field]:.1%} → {accuracy[field]:.1%})" for field in regressions))
+            sys.exit(1)
+        print("\n✅ لا تراجع عن الدقة السابقة")
+
+if __name__ == '__main__':
+    main()
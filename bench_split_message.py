@@ -0,0 +1,61 @@
+"""
+قياس سرعة تقسيم الرسائل الطويلة (split_long_message) على كشف حساب صناعي
+
+الاستخدام:
+    python bench_split_message.py [عدد الأسطر]
+"""
+import os
+import re
+import sys
+import time
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+
+from finance import split_long_message
+
+TELEGRAM_LIMIT = 4096
+
+def build_statement(lines):
+    """كشف صناعي بنفس شكل كشف الحساب بالتاريخ (سطران لكل عملية وسطر فارغ)"""
+    message = ["<b>📊 كشف بالتاريخ: حساب تجريبي</b>\n", "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n\n"]
+    balance = 0
+    for i in range(lines // 3):
+        amount = (i * 37) % 900 + 10
+        balance += amount if i % 4 == 0 else -amount
+        message.append(f"<b> 📆 {i % 28 + 1:02d}-08-2025 || عملية رقم {i} &amp; وصف</b>\n")
+        message.append(f"<b> ▪  -{amount:,.0f} ريال ||   الرصيد :  {balance:,.0f} ريال 📗</b>\n\n")
+    # سطر واحد أطول من الحد داخل <code> للتأكد من التقسيم داخل السطر
+    message.append("<code>" + "x" * (3 * TELEGRAM_LIMIT) + "</code>\n")
+    return ''.join(message)
+
+def check_parts(parts):
+    """كل جزء ضمن الحد وعلاماته متوازنة"""
+    for part in parts:
+        assert len(part) <= TELEGRAM_LIMIT, len(part)
+        depth = []
+        for closing, name in re.findall(r'<(/?)(\w+)[^>]*>', part):
+            if closing:
+                assert depth and depth.pop() == name, part[:200]
+            else:
+                depth.append(name)
+        assert not depth, part[-200:]
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    message = build_statement(lines)
+
+    runs = 5
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        parts = split_long_message(message)
+        timings.append(time.perf_counter() - started)
+    check_parts(parts)
+
+    best = min(timings)
+    print(f"الأسطر: {message.count(chr(10)):,} | الحروف: {len(message):,} | الأجزاء: {len(parts):,}")
+    print(f"أفضل زمن: {best * 1000:.1f} ms | المتوسط: {sum(timings) / runs * 1000:.1f} ms "
+          f"| {len(message) / best / 1e6:.1f} مليون حرف/ثانية")
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,24 @@
 import os
+import numpy as np
 import pandas as pd
-from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, ConversationHandler
+from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, Filters, CallbackContext, ConversationHandler
+from telegram.utils.helpers import escape_markdown
 from dotenv import load_dotenv
 from datetime import datetime
+from collections import OrderedDict
 from keep_alive import keep_alive
 import re
+import json
+import sqlite3
+import threading
+import itertools
+import hashlib
+import difflib
+import calendar
+from functools import lru_cache
+from bisect import bisect_left
 
 # تحميل المتغيرات من ملف .env
 try:
@@ -19,6 +32,12 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("❌ لم يتم العثور على TELEGRAM_BOT_TOKEN في ملف البيئة")
 
+# ملف القواعد (JSON): يحل محل ALLOWED_USER_IDS و ACCOUNT_MAPPING و AUTO_CATEGORIES أدناه
+# ويُعاد تحميله تلقائياً عند تعديله بدون إعادة تشغيل البوت. الملف لا يُرفع للمستودع
+# لأنه يحتوي معرفات المستخدمين: انسخ rules.example.json إليه وعدّله
+RULES_FILE = os.getenv("RULES_FILE", "rules.json")
+RULES_RELOAD_INTERVAL = int(os.getenv("RULES_RELOAD_INTERVAL", "10"))  # بالثواني
+
 # قائمة المستخدمين المسموح لهم (استبدل بمعرفاتك الحقيقية)
 ALLOWED_USER_IDS = [1919573036, 987654321]  # أضف معرفات المستخدمين المسموح لهم
 
@@ -37,44 +56,122 @@ ACCOUNT_MAPPING = {
     '2842': '🏛 راجحي',
 }
 
+# الميزانيات الشهرية (من ملف القواعد): التصنيف أو الحساب -> الحد الشهري للمصروف
+MONTHLY_BUDGETS = {'categories': {}, 'accounts': {}}
+
 # دالة للتحقق من الصلاحيات
 def restricted(func):
     def wrapper(update: Update, context: CallbackContext):
         user_id = update.effective_user.id
         if user_id not in ALLOWED_USER_IDS:
-            update.message.reply_text("⛔ ليس لديك صلاحية استخدام هذا البوت")
+            if update.callback_query:
+                update.callback_query.answer("⛔ ليس لديك صلاحية استخدام هذا البوت")
+            else:
+                update.message.reply_text("⛔ ليس لديك صلاحية استخدام هذا البوت")
             return ConversationHandler.END
         return func(update, context)
     return wrapper
 
 # حالات المحادثة
 # حالات المحادثة
-ADD_EXPENSE, ADD_INCOME, TRANSFER, NEW_ACCOUNT, CATEGORY, TRANSFER_CONFIRM, PROCESS_BANK_MSG, CONFIRM_TRANSACTION, ACCOUNT_STATEMENT_BALANCE, DATE_STATEMENT_ACCOUNT, DATE_STATEMENT_DATES = range(11)
+ADD_EXPENSE, ADD_INCOME, TRANSFER, NEW_ACCOUNT, CATEGORY, TRANSFER_CONFIRM, PROCESS_BANK_MSG, CONFIRM_TRANSACTION, ACCOUNT_STATEMENT_BALANCE, DATE_STATEMENT_ACCOUNT, DATE_STATEMENT_DATES, BULK_IMPORT, BULK_IMPORT_CONFIRM = range(13)
 EXCEL_FILE = "financial_tracker.xlsx"
+# سجل العمليات الجديدة (سطر JSON لكل عملية) يُدمج في ملف Excel دورياً
+JOURNAL_FILE = "financial_tracker.journal.jsonl"
+JOURNAL_COMPACT_INTERVAL = int(os.getenv("JOURNAL_COMPACT_INTERVAL", "300"))  # بالثواني
+# طبقة التخزين: excel (الافتراضي) أو sqlite
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "excel").lower()
+SQLITE_FILE = os.getenv("SQLITE_FILE", "financial_tracker.db")
+# بصمات رسائل البنك المسجلة (سطر لكل بصمة) لاكتشاف الرسائل المكررة
+MESSAGE_INDEX_FILE = "financial_tracker.messages.txt"
+# التصنيفات المتعلمة من المعاملات المسجلة (الجهة -> التصنيف)
+MERCHANT_CATEGORIES_FILE = "financial_tracker.categories.json"
+MERCHANT_CATEGORIES_LIMIT = int(os.getenv("MERCHANT_CATEGORIES_LIMIT", "2000"))
+# الموازنة = مجموع أرصدة كل الحسابات مطروحاً منه هذا المبلغ
+BUDGET_BASELINE = float(os.getenv("BUDGET_BASELINE", "800000"))
+# نسبة استهلاك الميزانية الشهرية التي يبدأ عندها التنبيه
+BUDGET_ALERT_PERCENT = float(os.getenv("BUDGET_ALERT_PERCENT", "85"))
+# عدد الأشهر في مقارنة التقارير، وعدد التصنيفات الأعلى مصروفاً
+REPORT_MONTHS = int(os.getenv("REPORT_MONTHS", "6"))
+REPORT_TOP_CATEGORIES = int(os.getenv("REPORT_TOP_CATEGORIES", "5"))
 
 # دالة جديدة للتعامل مع أسماء الحسابات مع الإيموجي
-def get_account_name(user_input, accounts_df):
+# توحيد الحروف العربية المتشابهة في البحث عن الحسابات (أرينا = ارينا، مكة = مكه)
+_ARABIC_NORMALIZATION = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ة': 'ه', 'ـ': None})
+
+def normalize_account_name(text):
+    """توحيد اسم الحساب للبحث: بدون إيموجي وتشكيل، بحروف عربية موحدة ومسافات مفردة"""
+    text = re.sub(r'[^\w\s]', '', str(text)).translate(_ARABIC_NORMALIZATION)
+    return ' '.join(text.lower().split())
+
+# فهرس أسماء الحسابات: يُبنى مرة واحدة لكل قائمة حسابات ويُعاد بناؤه فقط عند تغير الأسماء
+_ACCOUNT_NAME_INDEX = {
+    'names': None,     # أسماء الحسابات الأصلية بترتيب الجدول
+    'normalized': [],  # الأسماء الموحدة بنفس الترتيب
+    'exact': {},       # الاسم الموحد -> مواضع الحسابات
+    'grams': {},       # حرف أو حرفان متتاليان -> مواضع الحسابات التي تحتويهما
+}
+
+def _account_name_index(accounts_df):
+    """فهرس الأسماء المطابق لقائمة الحسابات (يُعاد بناؤه إذا تغيرت الأسماء)"""
+    names = tuple(accounts_df['اسم الحساب'])
+    if names != _ACCOUNT_NAME_INDEX['names']:
+        normalized = [normalize_account_name(name) for name in names]
+        exact = {}
+        grams = {}
+        for position, name in enumerate(normalized):
+            exact.setdefault(name, []).append(position)
+            for size in (1, 2):
+                for i in range(len(name) - size + 1):
+                    grams.setdefault(name[i:i + size], set()).add(position)
+        _ACCOUNT_NAME_INDEX.update(names=names, normalized=normalized, exact=exact, grams=grams)
+    return _ACCOUNT_NAME_INDEX
+
+def find_account_names(user_input, accounts_df):
     """
-    البحث عن اسم الحساب مع أو بدون الإيموجي
+    كل الحسابات المطابقة للنص المدخل بترتيب الجدول
+    
+    الأولوية للتطابق الكامل ثم بداية إحدى كلمات الاسم (ومنها بداية الاسم) ثم أي جزء منه،
+    ويُرجع أفضل مستوى فقط. بداية الاسم وبداية كلمة فيه مستوى واحد حتى لا يخفي أحدهما الآخر
+    («ابو» يطابق «ابو مسير» و «العم أبو عمر» فيُعرض الاثنان)
     """
-    # إزالة الإيموجي من أسماء الحسابات للبحث
-    accounts_without_emoji = []
-    for account_name in accounts_df['اسم الحساب']:
-        # إزالة جميع الأحرف غير الأبجدية والمسافات
-        cleaned_name = re.sub(r'[^\w\s]', '', account_name).strip()
-        accounts_without_emoji.append(cleaned_name)
+    index = _account_name_index(accounts_df)
+    query = normalize_account_name(user_input)
+    if not query:
+        return []
     
-    # البحث عن الحساب بدون الإيموجي
-    for i, account_name in enumerate(accounts_without_emoji):
-        if user_input.strip() in account_name:
-            return accounts_df.iloc[i]['اسم الحساب']
+    positions = index['exact'].get(query)
+    if not positions:
+        # المرشحون: الحسابات التي تحتوي كل الأزواج المتتالية من النص، ثم التحقق من احتوائه كاملاً
+        size = min(len(query), 2)
+        candidates = None
+        for i in range(len(query) - size + 1):
+            posting = index['grams'].get(query[i:i + size], set())
+            candidates = posting if candidates is None else candidates & posting
+            if not candidates:
+                return []
+        candidates = sorted(p for p in candidates if query in index['normalized'][p])
+        word_matches = [p for p in candidates if (' ' + index['normalized'][p]).find(' ' + query) != -1]
+        positions = word_matches or candidates
     
-    # إذا لم يتم العثور، البحث بالإيموجي
-    for account_name in accounts_df['اسم الحساب']:
-        if user_input.strip() in account_name:
-            return account_name
+    return [index['names'][p] for p in positions]
+
+def get_account_name(user_input, accounts_df):
+    """
+    البحث عن اسم الحساب مع أو بدون الإيموجي
     
-    return None
+    ترجع None إذا لم يوجد الحساب أو إذا طابق النص أكثر من حساب (انظر account_not_found_message)
+    """
+    matches = find_account_names(user_input, accounts_df)
+    return matches[0] if len(matches) == 1 else None
+
+def account_not_found_message(user_input, accounts_df):
+    """رسالة الخطأ المناسبة عندما لا ترجع get_account_name حساباً"""
+    matches = find_account_names(user_input, accounts_df)
+    if len(matches) > 1:
+        options = "\n".join("• " + re.sub(r'[^\w\s]', '', name).strip() for name in matches)
+        return f"⚠️ «{user_input.strip()}» يطابق أكثر من حساب:\n{options}\n\nاكتب اسم الحساب بشكل أدق."
+    return "❌ الحساب غير موجود!"
 
 # دالة جديدة لإنشاء قائمة الحسابات بدون إيموجي
 def get_accounts_without_emoji(accounts_df):
@@ -87,6 +184,65 @@ def get_accounts_without_emoji(accounts_df):
         accounts_list.append("• " + cleaned_name)
     return "\n".join(accounts_list)
 
+# ===== توحيد التواريخ =====
+# كل التواريخ تُخزن وتُقارن بصيغة YYYY-MM-DD وتُعرض بصيغة DD-MM-YYYY.
+# تُوحد مرة واحدة عند التحميل، ومن رسائل البنك عند التحليل
+_DAYS_IN_MONTH = (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+@lru_cache(maxsize=4096)
+def _normalize_date_text(text):
+    """
+    تاريخ رقمي بصيغة YYYY-MM-DD أو None
+    
+    يقبل يوم-شهر-سنة أو سنة-شهر-يوم بالفاصل - أو / أو . مع وقت اختياري بعد مسافة.
+    السنة أولاً إذا كانت 4 أرقام
+    """
+    head = text.strip().split(' ', 1)[0].split('T', 1)[0]
+    for separator in '-/.':
+        if separator in head:
+            parts = head.split(separator)
+            break
+    else:
+        return None
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        return None
+    first, month, last = parts
+    if len(first) == 4:
+        year, day = first, last
+    elif len(first) <= 2 and len(last) in (2, 4):
+        year, day = last, first
+    else:
+        return None
+    two_digit_year = len(year) == 2
+    year, month, day = int(year), int(month), int(day)
+    if two_digit_year:
+        # نفس قاعدة strptime مع %y: 69-99 -> 19xx و 00-68 -> 20xx
+        year += 1900 if year >= 69 else 2000
+    if not (1 <= month <= 12 and 1 <= day <= _DAYS_IN_MONTH[month - 1]):
+        return None
+    if month == 2 and day == 29 and not calendar.isleap(year):
+        return None
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+def normalize_date(value):
+    """أي تاريخ (نص بالصيغ الرقمية الشائعة أو datetime) بصيغة YYYY-MM-DD، أو None"""
+    if isinstance(value, str):
+        return _normalize_date_text(value)
+    if value is None or pd.isna(value):
+        return None
+    if hasattr(value, 'strftime'):
+        return value.strftime('%Y-%m-%d')
+    return None
+
+def display_date(value):
+    """التاريخ بصيغة العرض DD-MM-YYYY (النص غير المفهوم يُعرض كما هو)"""
+    iso = normalize_date(value)
+    return f"{iso[8:10]}-{iso[5:7]}-{iso[:4]}" if iso else str(value)
+
+def normalize_date_column(dates):
+    """توحيد عمود تواريخ عند التحميل (القيم غير المفهومة تبقى كما هي)"""
+    return dates.map(lambda value: normalize_date(value) or value)
+
 # تهيئة ملف Excel إذا لم يكن موجوداً
 def init_excel_file():
     if not os.path.exists(EXCEL_FILE):
@@ -118,23 +274,1344 @@ def init_excel_file():
             pd.DataFrame(transfers_data).to_excel(writer, sheet_name='التحويلات', index=False)
 
 
-def load_data():
-    accounts = pd.read_excel(EXCEL_FILE, sheet_name='الحسابات')
-    transactions = pd.read_excel(EXCEL_FILE, sheet_name='المعاملات')
+# كاش البيانات في الذاكرة: يُقرأ الملف مرة واحدة ويُعاد التحقق منه عبر وقت التعديل والحجم
+# حتى تظهر التعديلات اليدوية في Excel دون إعادة تشغيل البوت.
+# الكاش يحمل الحالة المدمجة: ملف Excel + العمليات المعلقة في سجل العمليات
+_LEDGER_CACHE = {
+    'signature': None,     # (mtime_ns, size) لملف Excel عند آخر قراءة أو حفظ
+    'journal_offset': 0,   # عدد البايتات المطبقة من سجل العمليات
+    'journal_pending': 0,  # عدد العمليات المعلقة التي لم تُدمج بعد
+    'data': None,          # (accounts, transactions, transfers)
+    'version': 0,          # يزيد مع كل تغيير في البيانات
+    'hits': 0,
+    'misses': 0,
+}
+_LEDGER_LOCK = threading.RLock()
+
+def _file_signature(path):
+    """بصمة الملف (وقت التعديل، الحجم) أو None إذا لم يكن موجوداً"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _float_balances(accounts):
+    """عمود الرصيد float64 دائماً: الأرصدة الصحيحة في الملف تُقرأ int64 فتفشل إضافة مبالغ عشرية إليها"""
+    return accounts.astype({'الرصيد': 'float64'})
+
+def _read_workbook(path=EXCEL_FILE):
+    """قراءة الأوراق الثلاث في عملية تحليل واحدة للملف"""
+    sheets = pd.read_excel(path, sheet_name=['الحسابات', 'المعاملات', 'التحويلات'])
+    accounts = _float_balances(sheets['الحسابات'])
+    transactions = sheets['المعاملات']
     
     # إذا كان عمود الوصف غير موجود، إضافته
     if 'الوصف' not in transactions.columns:
         transactions['الوصف'] = ''
     
-    transfers = pd.read_excel(EXCEL_FILE, sheet_name='التحويلات')
+    transfers = sheets['التحويلات']
+    transactions['التاريخ'] = normalize_date_column(transactions['التاريخ'])
+    transfers['التاريخ'] = normalize_date_column(transfers['التاريخ'])
     return accounts, transactions, transfers
 
-def save_data(accounts, transactions, transfers):
-    with pd.ExcelWriter(EXCEL_FILE) as writer:
+def _read_journal(path, offset=0):
+    """قراءة الأسطر المكتملة من سجل العمليات ابتداءً من offset
+    
+    ترجع (العمليات، الموضع الجديد). السطر الأخير غير المكتمل (كتابة مقطوعة) يُترك لقراءة لاحقة
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            chunk = f.read()
+    except FileNotFoundError:
+        return [], offset
+    
+    complete = chunk[:chunk.rfind(b'\n') + 1]
+    records = []
+    for line in complete.splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            print(f"⚠️ تم تجاهل سطر تالف في سجل العمليات: {line[:80]!r}")
+    return records, offset + len(complete)
+
+def _adjust_balance(accounts, account_name, delta):
+    accounts.loc[accounts['اسم الحساب'] == account_name, 'الرصيد'] += delta
+
+def _record_deltas(record):
+    """تغيرات الأرصدة التي تحدثها العملية: [(الحساب، التغير)]"""
+    row = record['row']
+    if record['kind'] == 'transaction':
+        return [(row['الحساب'], -row['المبلغ'] if row['النوع'] == 'مصروف' else row['المبلغ'])]
+    return [(row['من حساب'], -row['المبلغ']), (row['إلى حساب'], row['المبلغ'])]
+
+def _apply_journal_records(data, records):
+    """تطبيق عمليات السجل على البيانات: إضافة الصفوف وتعديل أرصدة الحسابات"""
+    accounts, transactions, transfers = data
+    new_transactions = []
+    new_transfers = []
+    
+    for record in records:
+        for account_name, delta in _record_deltas(record):
+            _adjust_balance(accounts, account_name, delta)
+        if record['kind'] == 'transaction':
+            new_transactions.append(record['row'])
+        elif record['kind'] == 'transfer':
+            new_transfers.append(record['row'])
+    
+    if new_transactions:
+        transactions = pd.concat([transactions, pd.DataFrame(new_transactions)], ignore_index=True)
+    if new_transfers:
+        transfers = pd.concat([transfers, pd.DataFrame(new_transfers)], ignore_index=True)
+    return accounts, transactions, transfers
+
+def _refresh_excel_ledger():
+    """التأكد من أن الكاش مطابق لملف Excel وسجل العمليات. ترجع True إذا أُعيدت قراءة ملف Excel"""
+    signature = _file_signature(EXCEL_FILE)
+    journal_size = os.path.getsize(JOURNAL_FILE) if os.path.exists(JOURNAL_FILE) else 0
+    
+    if (_LEDGER_CACHE['data'] is not None
+            and signature == _LEDGER_CACHE['signature']
+            and journal_size >= _LEDGER_CACHE['journal_offset']):
+        # إضافات إلى السجل من خارج هذه العملية (إن وجدت) تُطبق كذيل فقط
+        if journal_size > _LEDGER_CACHE['journal_offset']:
+            records, offset = _read_journal(JOURNAL_FILE, _LEDGER_CACHE['journal_offset'])
+            if records:
+                _LEDGER_CACHE['data'] = _apply_journal_records(_LEDGER_CACHE['data'], records)
+                _LEDGER_CACHE['journal_pending'] += len(records)
+                _LEDGER_CACHE['version'] += 1
+            _LEDGER_CACHE['journal_offset'] = offset
+        return False
+    
+    data = _read_workbook()
+    pending = 0
+    
+    # دمج متقطع سابق لم يكتمل: نعيد تطبيقه فقط إذا لم يُكتب ملف Excel بعده
+    compacting_file = JOURNAL_FILE + '.compacting'
+    compacting_signature = _file_signature(compacting_file)
+    if compacting_signature:
+        if signature and signature[0] > compacting_signature[0]:
+            os.remove(compacting_file)
+        else:
+            records, _ = _read_journal(compacting_file)
+            data = _apply_journal_records(data, records)
+            pending += len(records)
+    
+    records, offset = _read_journal(JOURNAL_FILE)
+    _LEDGER_CACHE['data'] = _apply_journal_records(data, records)
+    _LEDGER_CACHE['signature'] = signature
+    _LEDGER_CACHE['journal_offset'] = offset
+    _LEDGER_CACHE['journal_pending'] = pending + len(records)
+    _LEDGER_CACHE['version'] += 1
+    return True
+
+def _write_workbook(path, accounts, transactions, transfers):
+    with pd.ExcelWriter(path, engine='openpyxl') as writer:
         accounts.to_excel(writer, sheet_name='الحسابات', index=False)
         transactions.to_excel(writer, sheet_name='المعاملات', index=False)
         transfers.to_excel(writer, sheet_name='التحويلات', index=False)
 
+def _save_excel(accounts, transactions, transfers):
+    """كتابة الحالة الكاملة إلى ملف Excel، وتفريغ سجل العمليات لأنه أصبح مدمجاً فيها"""
+    compacting_file = JOURNAL_FILE + '.compacting'
+    if os.path.exists(JOURNAL_FILE):
+        if os.path.exists(compacting_file):
+            # دمج سابق لم يكتمل: نضم السجل الحالي إليه حتى لا تضيع أي عملية
+            with open(compacting_file, 'ab') as dst, open(JOURNAL_FILE, 'rb') as src:
+                dst.write(src.read())
+            os.remove(JOURNAL_FILE)
+        else:
+            os.replace(JOURNAL_FILE, compacting_file)
+    
+    # الكتابة إلى ملف مؤقت ثم الاستبدال حتى لا يبقى ملف Excel نصف مكتوب
+    root, ext = os.path.splitext(EXCEL_FILE)
+    temp_file = f"{root}.tmp{ext}"
+    _write_workbook(temp_file, accounts, transactions, transfers)
+    os.replace(temp_file, EXCEL_FILE)
+    
+    if os.path.exists(compacting_file):
+        os.remove(compacting_file)
+    
+    _LEDGER_CACHE['signature'] = _file_signature(EXCEL_FILE)
+    _LEDGER_CACHE['journal_offset'] = 0
+    _LEDGER_CACHE['journal_pending'] = 0
+
+def _append_excel_journal(records):
+    """إضافة عمليات إلى نهاية السجل بكتابة واحدة - بدون إعادة كتابة ملف Excel"""
+    lines = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+    with open(JOURNAL_FILE, 'ab') as f:
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    _LEDGER_CACHE['journal_offset'] += len(lines)
+    _LEDGER_CACHE['journal_pending'] += len(records)
+
+def _filter_account_ledger(transactions, transfers, account_name):
+    """معاملات وتحويلات حساب واحد من الجداول الكاملة"""
+    account_transactions = transactions[transactions['الحساب'] == account_name]
+    account_transfers = transfers[(transfers['من حساب'] == account_name) | (transfers['إلى حساب'] == account_name)]
+    return account_transactions, account_transfers
+
+# ===== طبقة تخزين SQLite =====
+# أسماء الأعمدة في قاعدة البيانات مقابل أسماء الأعمدة في الجداول (وفي ملف Excel)
+_SQLITE_COLUMNS = {
+    'accounts': {'اسم الحساب': 'name', 'النوع': 'type', 'الرصيد': 'balance'},
+    'transactions': {'التاريخ': 'date', 'النوع': 'type', 'المبلغ': 'amount', 'الحساب': 'account',
+                     'التصنيف': 'category', 'الوصف': 'description'},
+    'transfers': {'التاريخ': 'date', 'من حساب': 'from_account', 'إلى حساب': 'to_account', 'المبلغ': 'amount'},
+}
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    name TEXT PRIMARY KEY,
+    type TEXT,
+    balance REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT,
+    type TEXT,
+    amount REAL,
+    account TEXT,
+    category TEXT,
+    description TEXT
+);
+CREATE TABLE IF NOT EXISTS transfers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT,
+    from_account TEXT,
+    to_account TEXT,
+    amount REAL
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_account_date ON transactions (account, date);
+CREATE INDEX IF NOT EXISTS idx_transfers_from_date ON transfers (from_account, date);
+CREATE INDEX IF NOT EXISTS idx_transfers_to_date ON transfers (to_account, date);
+"""
+
+_SQLITE_CONNECTION = None
+
+def _sqlite():
+    """اتصال واحد مشترك بقاعدة البيانات (الوصول إليه محمي بـ _LEDGER_LOCK)"""
+    global _SQLITE_CONNECTION
+    if _SQLITE_CONNECTION is None:
+        _SQLITE_CONNECTION = sqlite3.connect(SQLITE_FILE, check_same_thread=False)
+        _SQLITE_CONNECTION.executescript(_SQLITE_SCHEMA)
+    return _SQLITE_CONNECTION
+
+def _sqlite_select(table, where='', params=()):
+    """قراءة جدول (أو جزء منه) بأسماء الأعمدة العربية وبترتيب الإدخال"""
+    columns = _SQLITE_COLUMNS[table]
+    select = ", ".join(f'{column} AS "{name}"' for name, column in columns.items())
+    order = 'rowid' if table == 'accounts' else 'id'
+    query = f"SELECT {select} FROM {table} {where} ORDER BY {order}"
+    df = pd.read_sql_query(query, _sqlite(), params=params)
+    if 'التاريخ' in df:
+        df['التاريخ'] = normalize_date_column(df['التاريخ'])
+    return df
+
+def _sqlite_rows(table, df):
+    """تحويل جدول إلى صفوف جاهزة للإدخال (القيم الفارغة تصبح NULL)"""
+    columns = _SQLITE_COLUMNS[table]
+    frame = df.reindex(columns=list(columns)).astype(object)
+    frame = frame.where(pd.notna(frame), None)
+    return list(frame.itertuples(index=False, name=None))
+
+def _sqlite_insert_sql(table):
+    columns = list(_SQLITE_COLUMNS[table].values())
+    return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+def _sqlite_data_version():
+    # يتغير فقط عند تعديل القاعدة من اتصال آخر (مثلاً أداة خارجية)
+    return _sqlite().execute("PRAGMA data_version").fetchone()[0]
+
+def _refresh_sqlite_ledger():
+    """التأكد من أن الكاش مطابق لقاعدة البيانات. ترجع True إذا أُعيدت القراءة منها"""
+    signature = _sqlite_data_version()
+    if _LEDGER_CACHE['data'] is not None and signature == _LEDGER_CACHE['signature']:
+        return False
+    
+    _LEDGER_CACHE['data'] = (
+        _float_balances(_sqlite_select('accounts')),
+        _sqlite_select('transactions'),
+        _sqlite_select('transfers'),
+    )
+    _LEDGER_CACHE['signature'] = signature
+    _LEDGER_CACHE['version'] += 1
+    return True
+
+def _save_sqlite(accounts, transactions, transfers):
+    """استبدال محتوى القاعدة بالكامل بالجداول المعطاة في معاملة واحدة"""
+    connection = _sqlite()
+    with connection:
+        for table, df in (('accounts', accounts), ('transactions', transactions), ('transfers', transfers)):
+            connection.execute(f"DELETE FROM {table}")
+            connection.executemany(_sqlite_insert_sql(table), _sqlite_rows(table, df))
+    _LEDGER_CACHE['signature'] = _sqlite_data_version()
+
+def _append_sqlite_records(records):
+    """إدخال العمليات وتحديث الأرصدة المتأثرة في معاملة قاعدة بيانات واحدة"""
+    connection = _sqlite()
+    with connection:
+        for record in records:
+            table = 'transactions' if record['kind'] == 'transaction' else 'transfers'
+            connection.execute(_sqlite_insert_sql(table), _sqlite_rows(table, pd.DataFrame([record['row']]))[0])
+            for account_name, delta in _record_deltas(record):
+                connection.execute("UPDATE accounts SET balance = balance + ? WHERE name = ?", (delta, account_name))
+
+def _sqlite_account_ledger(account_name):
+    """معاملات وتحويلات حساب واحد باستخدام الفهارس بدلاً من تحميل الجداول كاملة"""
+    account_transactions = _sqlite_select('transactions', "WHERE account = ?", (account_name,))
+    account_transfers = _sqlite_select('transfers', "WHERE from_account = ? OR to_account = ?", (account_name, account_name))
+    return typed_transactions(account_transactions), typed_transfers(account_transfers)
+
+def migrate_excel_to_sqlite(excel_file=EXCEL_FILE):
+    """نقل البيانات من ملف Excel (مع سجل العمليات المعلق) إلى قاعدة SQLite"""
+    with _LEDGER_LOCK:
+        data = _read_workbook(excel_file)
+        data = _apply_journal_records(data, _read_journal(JOURNAL_FILE)[0])
+        _save_sqlite(*data)
+        _LEDGER_CACHE['data'] = None
+    return len(data[1]), len(data[2])
+
+def export_to_excel(path):
+    """تصدير البيانات الحالية (من أي طبقة تخزين) إلى ملف Excel"""
+    _write_workbook(path, *load_data())
+
+# ===== الواجهة الموحدة للتخزين =====
+def _refresh_ledger():
+    if STORAGE_BACKEND == 'sqlite':
+        return _refresh_sqlite_ledger()
+    return _refresh_excel_ledger()
+
+def init_storage():
+    """تهيئة طبقة التخزين عند بدء التشغيل"""
+    init_excel_file()
+    if STORAGE_BACKEND == 'sqlite':
+        with _LEDGER_LOCK:
+            # ترحيل لمرة واحدة: فقط إذا كانت القاعدة فارغة
+            if _sqlite().execute("SELECT COUNT(*) FROM accounts").fetchone()[0] == 0:
+                transactions_count, transfers_count = migrate_excel_to_sqlite()
+                print(f"🗃 تم ترحيل {transactions_count} معاملة و {transfers_count} تحويل إلى {SQLITE_FILE}")
+
+def load_data():
+    """إرجاع نسخة من البيانات من الكاش، مع إعادة القراءة فقط إذا تغير مصدر البيانات"""
+    with _LEDGER_LOCK:
+        if _refresh_ledger():
+            _LEDGER_CACHE['misses'] += 1
+        else:
+            _LEDGER_CACHE['hits'] += 1
+        # نُرجع نسخاً لأن المعالجات تعدل الجداول قبل الحفظ
+        return tuple(df.copy() for df in _LEDGER_CACHE['data'])
+
+def load_accounts():
+    """جدول الحسابات فقط - أرخص من load_data للمعالجات التي لا تحتاج العمليات"""
+    with _LEDGER_LOCK:
+        if _refresh_ledger():
+            _LEDGER_CACHE['misses'] += 1
+        else:
+            _LEDGER_CACHE['hits'] += 1
+        return _LEDGER_CACHE['data'][0].copy()
+
+def load_account_ledger(account_name):
+    """معاملات حساب واحد وتحويلاته (الصادرة والواردة) بالأنواع الثابتة (انظر typed_ledger)"""
+    with _LEDGER_LOCK:
+        if STORAGE_BACKEND == 'sqlite':
+            return _sqlite_account_ledger(account_name)
+        return _filter_account_ledger(*typed_ledger(), account_name)
+
+def save_data(accounts, transactions, transfers):
+    """حفظ الحالة الكاملة في طبقة التخزين الحالية"""
+    with _LEDGER_LOCK:
+        if STORAGE_BACKEND == 'sqlite':
+            _save_sqlite(accounts, transactions, transfers)
+        else:
+            _save_excel(accounts, transactions, transfers)
+        
+        # تحديث الكاش بما تم حفظه حتى لا نعيد قراءة ما كتبناه للتو
+        _LEDGER_CACHE['data'] = (_float_balances(accounts), transactions.copy(), transfers.copy())
+        _LEDGER_CACHE['version'] += 1
+
+# الهياكل المشتقة من البيانات (فهرس الأرصدة، العدادات، النقاط...) تحفظ نسخة البيانات التي تطابقها.
+# مسار التسجيل يُحدّثها تدريجياً، وأي تغير آخر (حفظ كامل أو تعديل يدوي للملف) يغير النسخة
+# فيُعاد بناؤها عند أول طلب
+def _derived_is_stale(state):
+    """هل الهيكل المشتق لا يطابق نسخة البيانات الحالية (فيُعاد بناؤه)؟ يُستدعى تحت _LEDGER_LOCK"""
+    return state['version'] != _LEDGER_CACHE['version']
+
+def _advance_derived(state, previous_version):
+    """
+    نقل الهيكل المشتق إلى نسخة البيانات الجديدة بعد التسجيل. ترجع True إذا كان يطابق النسخة
+    السابقة فيُحدّث بالعمليات الجديدة، و False إذا كان قديماً فيبقى ليُعاد بناؤه عند الطلب
+    """
+    if state['version'] != previous_version:
+        return False
+    state['version'] = _LEDGER_CACHE['version']
+    return True
+
+def _append_records(records):
+    """تسجيل عمليات في طبقة التخزين بكتابة واحدة وتطبيقها على الكاش"""
+    if not records:
+        return
+    # نسخ الصفوف قبل توحيد التاريخ حتى لا تتغير قواميس المستدعي (مثل صفوف الاستيراد المعروضة)
+    records = [
+        {'kind': record['kind'],
+         'row': dict(record['row'], التاريخ=normalize_date(record['row']['التاريخ']) or record['row']['التاريخ'])}
+        for record in records
+    ]
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        if STORAGE_BACKEND == 'sqlite':
+            _append_sqlite_records(records)
+        else:
+            _append_excel_journal(records)
+        
+        previous_version = _LEDGER_CACHE['version']
+        _LEDGER_CACHE['data'] = _apply_journal_records(_LEDGER_CACHE['data'], records)
+        _LEDGER_CACHE['version'] += 1
+        for state, update in ((_TYPED_LEDGER, _update_typed_ledger), (_BALANCE_INDEX, _update_balance_index),
+                              (_TOTAL_BALANCE, _update_total_balance), (_MONTHLY_SPEND, _update_monthly_spend),
+                              (_ROLLUPS, _update_rollups), (_CHECKPOINTS, _update_checkpoints),
+                              (_DAILY_BALANCES, _update_daily_balances), (_DUPLICATE_INDEX, _update_duplicate_index)):
+            if _advance_derived(state, previous_version):
+                update(records)
+        _learn_from_records(records)
+
+def _append_record(kind, row):
+    """تسجيل عملية واحدة في طبقة التخزين وتطبيقها على الكاش"""
+    _append_records([{'kind': kind, 'row': row}])
+
+def record_transaction(new_transaction):
+    """تسجيل معاملة (دخل/مصروف) وتحديث رصيد حسابها"""
+    _append_record('transaction', new_transaction)
+
+def record_transactions(new_transactions):
+    """تسجيل مجموعة معاملات دفعة واحدة (كتابة واحدة ونسخة بيانات واحدة)"""
+    _append_records([{'kind': 'transaction', 'row': row} for row in new_transactions])
+
+def record_transfer(new_transfer):
+    """تسجيل تحويل وتحديث رصيد الحسابين"""
+    _append_record('transfer', new_transfer)
+
+def compact_journal():
+    """دمج العمليات المعلقة في ملف Excel. ترجع عدد العمليات التي تم دمجها"""
+    if STORAGE_BACKEND == 'sqlite':
+        return 0  # كل عملية تُكتب مباشرة في القاعدة
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        pending = _LEDGER_CACHE['journal_pending']
+        if pending:
+            # البيانات نفسها لم تتغير، لذلك لا نغير رقم النسخة
+            _save_excel(*_LEDGER_CACHE['data'])
+        return pending
+
+def compact_journal_job(context: CallbackContext):
+    """مهمة دورية لدمج سجل العمليات في ملف Excel والتحقق من نقاط الأرصدة وحفظ التصنيفات المتعلمة"""
+    try:
+        merged = compact_journal()
+        if merged:
+            print(f"🗜 تم دمج {merged} عملية في {EXCEL_FILE}")
+    except Exception as e:
+        print(f"❌ فشل دمج سجل العمليات: {e}")
+    try:
+        verify_updated_checkpoints()
+    except Exception as e:
+        print(f"❌ فشل التحقق من نقاط الأرصدة: {e}")
+    try:
+        save_merchant_categories()
+    except Exception as e:
+        print(f"❌ فشل حفظ التصنيفات المتعلمة: {e}")
+
+def get_ledger_version():
+    """رقم نسخة البيانات الحالية (يتغير مع كل تعديل)"""
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        return _LEDGER_CACHE['version']
+
+def get_ledger_cache_stats():
+    """إحصائيات كاش البيانات (عدد الإصابات والإخفاقات ورقم النسخة)"""
+    with _LEDGER_LOCK:
+        hits = _LEDGER_CACHE['hits']
+        misses = _LEDGER_CACHE['misses']
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0,
+            'version': _LEDGER_CACHE['version'],
+            'journal_pending': _LEDGER_CACHE['journal_pending'],
+        }
+
+# ===== الجداول المنمطة =====
+# نسخة من المعاملات والتحويلات بأنواع ثابتة تُبنى مرة واحدة لكل نسخة بيانات:
+# التاريخ datetime64 لليوم، والحسابات والنوع والتصنيف category، والمبلغ بالهللات int64.
+# للقراءة فقط (الكشوفات والتجميعات)، أما الحفظ فيبقى من الجداول الأصلية
+_TYPED_LEDGER = {
+    'version': None,  # نسخة البيانات التي تطابقها الجداول
+    'data': None,     # (المعاملات، التحويلات)
+}
+
+def to_halalas(amounts):
+    """مبالغ بالريال -> هللات int64 (بالتقريب لأقرب هللة)"""
+    values = pd.to_numeric(pd.Series(amounts), errors='coerce').fillna(0.0).to_numpy(dtype=float)
+    return np.rint(values * 100).astype(np.int64)
+
+def to_day(dates):
+    """تواريخ YYYY-MM-DD (موحدة عند التحميل) -> datetime64، و NaT لما لا يُفهم"""
+    return pd.to_datetime(dates, format='%Y-%m-%d', errors='coerce')
+
+def typed_transactions(transactions):
+    """جدول المعاملات بالأنواع الثابتة"""
+    return pd.DataFrame({
+        'التاريخ': to_day(transactions['التاريخ']),
+        'النوع': transactions['النوع'].astype('category'),
+        'المبلغ': to_halalas(transactions['المبلغ']),
+        'الحساب': transactions['الحساب'].astype('category'),
+        'التصنيف': transactions['التصنيف'].astype('category'),
+        'الوصف': transactions['الوصف'] if 'الوصف' in transactions else '',
+    }, index=transactions.index)
+
+def typed_transfers(transfers):
+    """جدول التحويلات بالأنواع الثابتة"""
+    return pd.DataFrame({
+        'التاريخ': to_day(transfers['التاريخ']),
+        'من حساب': transfers['من حساب'].astype('category'),
+        'إلى حساب': transfers['إلى حساب'].astype('category'),
+        'المبلغ': to_halalas(transfers['المبلغ']),
+    }, index=transfers.index)
+
+def typed_ledger():
+    """(المعاملات، التحويلات) بالأنواع الثابتة لنسخة البيانات الحالية. بدون نسخ - لا تُعدل"""
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        if _derived_is_stale(_TYPED_LEDGER):
+            _, transactions, transfers = _LEDGER_CACHE['data']
+            _TYPED_LEDGER['data'] = (typed_transactions(transactions), typed_transfers(transfers))
+            _TYPED_LEDGER['version'] = _LEDGER_CACHE['version']
+        return _TYPED_LEDGER['data']
+
+def _append_typed(frame, new_rows):
+    """إلحاق صفوف منمطة بجدول منمط. الأعمدة category تبقى category بإضافة الفئات الجديدة فقط"""
+    if new_rows.empty:
+        return frame
+    columns = {}
+    for column in frame.columns:
+        old, new = frame[column], new_rows[column]
+        if isinstance(old.dtype, pd.CategoricalDtype):
+            missing = [value for value in pd.unique(new.dropna()) if value not in old.cat.categories]
+            if missing:
+                old = old.cat.add_categories(missing)
+            new = new.astype(old.dtype)
+        columns[column] = (old, new)
+    return pd.concat([pd.DataFrame({column: old for column, (old, _) in columns.items()}),
+                      pd.DataFrame({column: new for column, (_, new) in columns.items()})],
+                     ignore_index=True)
+
+def _update_typed_ledger(records):
+    """إلحاق العمليات الجديدة بالجداول المنمطة بدل تحويل الجداول كاملة"""
+    new_transactions = [record['row'] for record in records if record['kind'] == 'transaction']
+    new_transfers = [record['row'] for record in records if record['kind'] == 'transfer']
+    transactions, transfers = _TYPED_LEDGER['data']
+    if new_transactions:
+        rows = pd.DataFrame(new_transactions).reindex(columns=['التاريخ', 'النوع', 'المبلغ', 'الحساب', 'التصنيف', 'الوصف'])
+        transactions = _append_typed(transactions, typed_transactions(rows))
+    if new_transfers:
+        rows = pd.DataFrame(new_transfers).reindex(columns=['التاريخ', 'من حساب', 'إلى حساب', 'المبلغ'])
+        transfers = _append_typed(transfers, typed_transfers(rows))
+    _TYPED_LEDGER['data'] = (transactions, transfers)
+
+# محرك الكشوفات: عمليات الحساب كجدول واحد بمبالغ موقعة (+ للدخل والوارد، - للمصروف والصادر)
+# مرتب بالتاريخ (datetime64) مع الرصيد الجاري المحسوب بـ cumsum
+
+# ترتيب العمليات في نفس التاريخ: المعاملات ثم التحويلات الصادرة ثم الواردة
+_OPERATION_RANK = {'تحويل صادر': 1, 'تحويل وارد': 2}
+
+_STATEMENT_COLUMNS = ['date', 'shown', 'day', 'rank', 'seq', 'description', 'counterparty', 'amount', 'type',
+                      'is_income', 'balance']
+
+# أنواع العمليات التي تدخل في حساب الرصيد المدور
+_ROLLED_SIGNS = {'دخل': 1.0, 'مصروف': -1.0, 'تحويل وارد': 1.0, 'تحويل صادر': -1.0}
+
+def _clean_account_names(names):
+    """إزالة الإيموجي من أسماء الحسابات (لعمود كامل)"""
+    return names.astype(str).str.replace(r'[^\w\s]', '', regex=True).str.strip()
+
+def _statement_part(days, rank, descriptions, counterparties, halalas, types):
+    return pd.DataFrame({
+        'day': days,
+        'rank': rank,
+        'description': descriptions,
+        'counterparty': counterparties,  # الحساب الآخر في التحويل (منظفاً من الإيموجي)
+        'amount': halalas / 100,
+        'type': types,
+    })
+
+def build_statement_frame(account_name, transactions, transfers, opening_balance=None, current_balance=None):
+    """بناء جدول عمليات الحساب (من الجداول المنمطة) مرتباً بالتاريخ مع الرصيد الجاري
+    
+    ترجع (الجدول، الرصيد الافتتاحي، الإجماليات حسب النوع). إذا لم يُعطَ الرصيد الافتتاحي
+    يُستنتج من الرصيد الحالي بطرح أثر كل العمليات
+    """
+    account_transactions = transactions[transactions['الحساب'] == account_name]
+    outgoing_transfers = transfers[transfers['من حساب'] == account_name]
+    incoming_transfers = transfers[transfers['إلى حساب'] == account_name]
+    
+    to_accounts = _clean_account_names(outgoing_transfers['إلى حساب'])
+    from_accounts = _clean_account_names(incoming_transfers['من حساب'])
+    parts = [
+        _statement_part(account_transactions['التاريخ'], 0, account_transactions['التصنيف'].astype(object), '',
+                        account_transactions['المبلغ'], account_transactions['النوع'].astype(object)),
+        _statement_part(outgoing_transfers['التاريخ'], _OPERATION_RANK['تحويل صادر'], "تحويل إلى " + to_accounts,
+                        to_accounts, outgoing_transfers['المبلغ'], 'تحويل صادر'),
+        _statement_part(incoming_transfers['التاريخ'], _OPERATION_RANK['تحويل وارد'], "تحويل من " + from_accounts,
+                        from_accounts, incoming_transfers['المبلغ'], 'تحويل وارد'),
+    ]
+    # الأجزاء الفارغة تُستبعد من الدمج حتى لا تؤثر على أنواع الأعمدة
+    frame = pd.concat([part for part in parts if len(part)] or parts[:1], ignore_index=True)
+    frame['seq'] = np.arange(len(frame))
+    # التاريخ datetime64 للترتيب والبحث الثنائي، ونصوص التاريخ تُحسب مرة واحدة هنا وليس لكل سطر عند رسم الكشف
+    frame['date'] = frame['day'].dt.strftime('%Y-%m-%d').fillna('')
+    frame['shown'] = frame['day'].dt.strftime('%d-%m-%Y').fillna('')
+    frame['is_income'] = ((frame['rank'] == 0) & (frame['type'] == 'دخل')) | (frame['rank'] == _OPERATION_RANK['تحويل وارد'])
+    
+    # المجاميع بالهللات (أعداد صحيحة) ثم بالريال
+    totals = {
+        'دخل': account_transactions.loc[account_transactions['النوع'] == 'دخل', 'المبلغ'].sum() / 100,
+        'مصروف': account_transactions.loc[account_transactions['النوع'] == 'مصروف', 'المبلغ'].sum() / 100,
+        'تحويل وارد': incoming_transfers['المبلغ'].sum() / 100,
+        'تحويل صادر': outgoing_transfers['المبلغ'].sum() / 100,
+    }
+    if opening_balance is None:
+        # الرصيد الافتتاحي = الرصيد الحالي + المصروفات - الدخل + التحويلات الصادرة - التحويلات الواردة
+        opening_balance = current_balance + totals['مصروف'] - totals['دخل'] + totals['تحويل صادر'] - totals['تحويل وارد']
+    
+    # ترتيب مستقر: العمليات في نفس التاريخ تبقى بترتيب الدمج (معاملات، صادر، وارد)
+    frame = frame.sort_values('day', kind='stable', na_position='last', ignore_index=True)
+    
+    # cumsum تراكمي من اليسار لليمين فيطابق جمع الرصيد عملية بعد عملية
+    signed = np.where(frame['is_income'], frame['amount'], -frame['amount'])
+    frame['balance'] = np.cumsum(np.concatenate(([opening_balance], signed)))[1:]
+    
+    return frame[_STATEMENT_COLUMNS], opening_balance, totals
+
+# فهرس الأرصدة الجارية: لكل حساب جدول عملياته من محرك الكشوفات.
+# يُبنى عند أول طلب كشف للحساب ثم يُحدّث مع كل عملية جديدة بدلاً من إعادة الحساب من الجداول
+_BALANCE_INDEX = {
+    'version': None,  # نسخة البيانات التي يطابقها الفهرس
+    'accounts': {},   # اسم الحساب -> مدخل الفهرس
+}
+
+def _build_account_index(account_name):
+    """بناء مدخل الفهرس لحساب واحد من معاملاته وتحويلاته"""
+    accounts = _LEDGER_CACHE['data'][0]
+    current_balance = accounts.loc[accounts['اسم الحساب'] == account_name, 'الرصيد'].iloc[0]
+    transactions, transfers = load_account_ledger(account_name)
+    frame, opening_balance, totals = build_statement_frame(
+        account_name, transactions, transfers, current_balance=current_balance)
+    return {
+        'opening': opening_balance,
+        'frame': frame,
+        'totals': totals,
+        'next_seq': len(frame),
+    }
+
+_EMPTY_TRANSACTIONS = typed_transactions(pd.DataFrame(columns=['التاريخ', 'النوع', 'المبلغ', 'الحساب', 'التصنيف']))
+_EMPTY_TRANSFERS = typed_transfers(pd.DataFrame(columns=['التاريخ', 'من حساب', 'إلى حساب', 'المبلغ']))
+
+def _insert_operation(entry, account_name, record):
+    """إدراج عملية جديدة في مكانها وتعديل الأرصدة التي بعدها فقط"""
+    row = record['row']
+    if record['kind'] == 'transaction':
+        transactions, transfers = typed_transactions(pd.DataFrame([row])), _EMPTY_TRANSFERS
+    else:
+        transactions, transfers = _EMPTY_TRANSACTIONS, typed_transfers(pd.DataFrame([row]))
+    new_operations, _, _ = build_statement_frame(account_name, transactions, transfers, opening_balance=0.0)
+    
+    frame = entry['frame']
+    for operation in new_operations.to_dict('records'):
+        # الموضع: بعد كل العمليات الأقدم، وبعد عمليات نفس التاريخ ذات الترتيب الأسبق أو المساوي
+        days = frame['day'].to_numpy()
+        day = np.datetime64(operation['day'], 'ns')
+        low = np.searchsorted(days, day, side='left')
+        high = np.searchsorted(days, day, side='right')
+        position = low + np.searchsorted(frame['rank'].to_numpy()[low:high], operation['rank'], side='right')
+        
+        signed_amount = operation['amount'] if operation['is_income'] else -operation['amount']
+        previous_balance = frame['balance'].iat[position - 1] if position else entry['opening']
+        operation['seq'] = entry['next_seq']
+        operation['balance'] = previous_balance + signed_amount
+        entry['next_seq'] += 1
+        
+        balances = frame['balance'].to_numpy().copy()
+        balances[position:] += signed_amount
+        frame = frame.assign(balance=balances)
+        frame = pd.concat([frame.iloc[:position], pd.DataFrame([operation]), frame.iloc[position:]], ignore_index=True)
+        if operation['rank'] or operation['type'] in ('دخل', 'مصروف'):
+            entry['totals'][operation['type']] += operation['amount']
+    entry['frame'] = frame
+
+# دفعة أكبر من هذا العدد تُسقط مداخل الحسابات المتأثرة ليُعاد بناؤها (أسرع من الإدراج واحدة واحدة)
+_INDEX_INSERT_LIMIT = 20
+
+def _update_balance_index(records):
+    """تحديث الفهرس بالعمليات الجديدة"""
+    
+    affected_records = {}
+    for record in records:
+        row = record['row']
+        if record['kind'] == 'transaction':
+            affected = (row['الحساب'],)
+        else:
+            affected = (row['من حساب'], row['إلى حساب'])
+        for account_name in dict.fromkeys(affected):
+            affected_records.setdefault(account_name, []).append(record)
+    
+    for account_name, account_records in affected_records.items():
+        entry = _BALANCE_INDEX['accounts'].get(account_name)
+        if entry is None:
+            continue
+        if len(account_records) > _INDEX_INSERT_LIMIT:
+            del _BALANCE_INDEX['accounts'][account_name]
+            continue
+        for record in account_records:
+            row = record['row']
+            if record['kind'] == 'transaction' and row['النوع'] not in ('دخل', 'مصروف'):
+                # نوع آخر يزيد الرصيد الحالي ولا يدخل في معادلة الرصيد الافتتاحي، فيتغير الافتتاحي المستنتج
+                entry['opening'] += row['المبلغ']
+                entry['frame'] = entry['frame'].assign(balance=entry['frame']['balance'] + row['المبلغ'])
+            _insert_operation(entry, account_name, record)
+
+def _account_index_entry(account_name):
+    """مدخل فهرس الأرصدة للحساب (يُبنى عند الحاجة). بدون نسخ - يُستدعى تحت _LEDGER_LOCK"""
+    _refresh_ledger()
+    if _derived_is_stale(_BALANCE_INDEX):
+        _BALANCE_INDEX['accounts'].clear()
+        _BALANCE_INDEX['version'] = _LEDGER_CACHE['version']
+    
+    entry = _BALANCE_INDEX['accounts'].get(account_name)
+    if entry is None:
+        entry = _build_account_index(account_name)
+        _BALANCE_INDEX['accounts'][account_name] = entry
+    return entry
+
+def get_account_index(account_name):
+    """نسخة من مدخل فهرس الأرصدة للحساب: جدول العمليات المرتب مع الرصيد بعد كل عملية"""
+    with _LEDGER_LOCK:
+        entry = _account_index_entry(account_name)
+        return {
+            'opening': entry['opening'],
+            'frame': entry['frame'].copy(),
+            'totals': dict(entry['totals']),
+        }
+
+# مجموع أرصدة كل الحسابات: يُحسب مرة من جدول الحسابات ثم يُحدّث بنفس تغيرات الأرصدة
+# التي يطبقها _append_records، فحساب الموازنة بعد كل عملية لا يقرأ ولا ينسخ جدول الحسابات
+_TOTAL_BALANCE = {
+    'version': None,  # نسخة البيانات التي يطابقها المجموع
+    'total': 0.0,
+    'names': frozenset(),  # أسماء الحسابات الموجودة (تتغير فقط مع تغير نسخة البيانات خارج التسجيل)
+}
+
+def _update_total_balance(records):
+    """إضافة تغيرات أرصدة العمليات الجديدة إلى المجموع"""
+    names = _TOTAL_BALANCE['names']
+    for record in records:
+        for account_name, delta in _record_deltas(record):
+            # نفس سلوك _adjust_balance: التغير على حساب غير موجود لا يُحتسب
+            if account_name in names:
+                _TOTAL_BALANCE['total'] += delta
+
+def get_total_balance():
+    """مجموع أرصدة كل الحسابات"""
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        if _derived_is_stale(_TOTAL_BALANCE):
+            accounts = _LEDGER_CACHE['data'][0]
+            _TOTAL_BALANCE['total'] = float(accounts['الرصيد'].sum())
+            _TOTAL_BALANCE['names'] = frozenset(accounts['اسم الحساب'])
+            _TOTAL_BALANCE['version'] = _LEDGER_CACHE['version']
+        return _TOTAL_BALANCE['total']
+
+# ===== الميزانيات الشهرية =====
+# عدادات المصروف لكل (شهر، تصنيف) ولكل (شهر، حساب): تُبنى من المعاملات عند التشغيل
+# (أو بعد حفظ كامل أو تعديل يدوي) ثم يزيد كل مصروف جديد عداده مباشرة،
+# فتنبيه الميزانية بحث في قاموس ولا يمر على جدول المعاملات
+_MONTHLY_SPEND = {
+    'version': None,   # نسخة البيانات التي تطابقها العدادات
+    'categories': {},  # (الشهر YYYY-MM، التصنيف الموحد) -> مجموع المصروف
+    'accounts': {},    # (الشهر، الحساب الموحد) -> مجموع المصروف
+}
+
+def _build_monthly_spend():
+    """حساب العدادات من كل المصروفات المسجلة (تجميع واحد لكل نوع)"""
+    transactions = _LEDGER_CACHE['data'][1]
+    expenses = transactions[transactions['النوع'] == 'مصروف']
+    months = expenses['التاريخ'].astype(str).str[:7]
+    amounts = pd.to_numeric(expenses['المبلغ'], errors='coerce').fillna(0.0)
+    for section, column in (('categories', 'التصنيف'), ('accounts', 'الحساب')):
+        names = expenses[column].fillna('').map(normalize_account_name)
+        _MONTHLY_SPEND[section] = amounts.groupby([months, names]).sum().to_dict()
+    _MONTHLY_SPEND['version'] = _LEDGER_CACHE['version']
+
+def build_monthly_spend():
+    """بناء عدادات الميزانيات الشهرية عند التشغيل"""
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        _build_monthly_spend()
+        print(f"🎯 عدادات الميزانية: {len(_MONTHLY_SPEND['categories'])} (شهر، تصنيف) و "
+              f"{len(_MONTHLY_SPEND['accounts'])} (شهر، حساب)")
+
+def _update_monthly_spend(records):
+    """إضافة المصروفات الجديدة إلى عداداتها"""
+    for record in records:
+        row = record['row']
+        if record['kind'] != 'transaction' or row['النوع'] != 'مصروف':
+            continue
+        month = str(row['التاريخ'])[:7]
+        for section, name in (('categories', row.get('التصنيف', '')), ('accounts', row['الحساب'])):
+            key = (month, normalize_account_name(name))
+            counters = _MONTHLY_SPEND[section]
+            counters[key] = counters.get(key, 0.0) + float(row['المبلغ'])
+
+def budget_alerts(category, account_name, date=None):
+    """
+    أسطر تنبيه للميزانيات الشهرية التي وصل استهلاكها إلى BUDGET_ALERT_PERCENT
+    
+    تُستدعى بعد تسجيل المصروف، فالعدادات تشمله
+    """
+    month = (normalize_date(date) if date else None) or datetime.now().strftime('%Y-%m-%d')
+    month = month[:7]
+    this_month = month == datetime.now().strftime('%Y-%m')
+    budgets = MONTHLY_BUDGETS
+    alerts = []
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        if _derived_is_stale(_MONTHLY_SPEND):
+            _build_monthly_spend()
+        for section, name in (('categories', category), ('accounts', account_name)):
+            key = normalize_account_name(name)
+            for budget_name, limit in budgets[section].items():
+                if limit <= 0 or normalize_account_name(budget_name) != key:
+                    continue
+                used = _MONTHLY_SPEND[section].get((month, key), 0.0)
+                percent = used / limit * 100
+                if percent < BUDGET_ALERT_PERCENT:
+                    continue
+                period = "هذا الشهر" if this_month else f"شهر {month}"
+                if used > limit:
+                    alerts.append(f"🚨 تجاوزت ميزانية {budget_name} ل{period}: "
+                                  f"{used:,.0f} من {limit:,.0f} ريال ({percent:.0f}%)")
+                else:
+                    alerts.append(f"⚠️ استهلكت {percent:.0f}% من ميزانية {budget_name} ل{period} "
+                                  f"({used:,.0f} من {limit:,.0f} ريال)")
+    return alerts
+
+# ===== تجميعات التقارير =====
+# مجاميع شهرية للمعاملات لكل (شهر، نوع، تصنيف، حساب) وللتحويلات لكل (شهر، من، إلى):
+# تُبنى بتجميع واحد من الجداول المنمطة ثم تُحدّث مع كل عملية جديدة، فالتقرير يمر على
+# التجميعات (بعدد الأشهر × التصنيفات × الحسابات) وليس على كل العمليات المسجلة
+_ROLLUPS = {
+    'version': None,     # نسخة البيانات التي تطابقها التجميعات
+    'transactions': {},  # (الشهر YYYY-MM، النوع، التصنيف، الحساب) -> [المبلغ بالهللات، العدد]
+    'transfers': {},     # (الشهر، من حساب، إلى حساب) -> [المبلغ بالهللات، العدد]
+}
+
+def _rollup(frame, columns):
+    """تجميع جدول منمط حسب الشهر والأعمدة المعطاة. العمليات بلا تاريخ صالح لا تدخل"""
+    keys = [frame['التاريخ'].dt.strftime('%Y-%m')]
+    keys += [frame[column].astype(object).fillna('') for column in columns]
+    grouped = frame['المبلغ'].groupby(keys).agg(['sum', 'count'])
+    return {key: [int(total), int(count)]
+            for key, total, count in zip(grouped.index, grouped['sum'], grouped['count'])}
+
+def _build_rollups():
+    transactions, transfers = typed_ledger()
+    _ROLLUPS['transactions'] = _rollup(transactions, ['النوع', 'التصنيف', 'الحساب'])
+    _ROLLUPS['transfers'] = _rollup(transfers, ['من حساب', 'إلى حساب'])
+    _ROLLUPS['version'] = _LEDGER_CACHE['version']
+
+def build_rollups():
+    """بناء تجميعات التقارير عند التشغيل"""
+    with _LEDGER_LOCK:
+        _build_rollups()
+        print(f"📊 تجميعات التقارير: {len(_ROLLUPS['transactions'])} مجموعة معاملات و "
+              f"{len(_ROLLUPS['transfers'])} مجموعة تحويلات")
+
+def _update_rollups(records):
+    """إضافة العمليات الجديدة إلى مجموعاتها"""
+    for record in records:
+        row = record['row']
+        date = normalize_date(row['التاريخ'])
+        if date is None:
+            continue
+        if record['kind'] == 'transaction':
+            category = row.get('التصنيف', '')
+            key = (date[:7], row['النوع'], '' if pd.isna(category) else category, row['الحساب'])
+            rollup = _ROLLUPS['transactions']
+        else:
+            key = (date[:7], row['من حساب'], row['إلى حساب'])
+            rollup = _ROLLUPS['transfers']
+        entry = rollup.setdefault(key, [0, 0])
+        entry[0] += int(to_halalas([row['المبلغ']])[0])
+        entry[1] += 1
+
+def report_summary(months=REPORT_MONTHS, top=REPORT_TOP_CATEGORIES):
+    """
+    ملخص التقارير من التجميعات
+    
+    ترجع قاموساً: الأشهر الأخيرة (حتى آخر شهر فيه عمليات) بمجاميع الدخل والمصروف
+    والتحويلات، وأعلى التصنيفات مصروفاً في آخر شهر مع مصروفها في الشهر السابق.
+    المبالغ بالريال. المعاملات بنوع غير الدخل والمصروف (مثل «تحويل» مسجل كمعاملة) لا تدخل
+    في أي مجموع وتُحسب في العدد فقط
+    """
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        if _derived_is_stale(_ROLLUPS):
+            _build_rollups()
+        totals = {}
+        categories = {}
+        for (month, kind, category, _), (amount, count) in _ROLLUPS['transactions'].items():
+            month_totals = totals.setdefault(month, {'دخل': 0, 'مصروف': 0, 'تحويلات': 0, 'العدد': 0})
+            month_totals['العدد'] += count
+            if kind not in ('دخل', 'مصروف'):
+                continue  # نوع آخر: ليس دخلاً ولا مصروفاً، والتحويلات تُجمع من جدولها فقط
+            month_totals[kind] += amount
+            if kind == 'مصروف':
+                categories[(month, category)] = categories.get((month, category), 0) + amount
+        for (month, _, _), (amount, count) in _ROLLUPS['transfers'].items():
+            month_totals = totals.setdefault(month, {'دخل': 0, 'مصروف': 0, 'تحويلات': 0, 'العدد': 0})
+            month_totals['تحويلات'] += amount
+            month_totals['العدد'] += count
+    
+    # آخر شهر فيه عمليات حتى الشهر الحالي (التواريخ المستقبلية أخطاء إدخال على الأغلب)
+    current_month = datetime.now().strftime('%Y-%m')
+    past = [m for m in totals if m <= current_month]
+    if not past:
+        return {'months': [], 'month': None, 'previous_month': None, 'top_categories': []}
+    month = max(past)
+    # أشهر متتالية تنتهي بهذا الشهر، فالمقارنة دائماً بالشهر السابق فعلاً
+    year, number = map(int, month.split('-'))
+    recent = []
+    for offset in range(months - 1, -1, -1):
+        index = year * 12 + number - 1 - offset
+        recent.append(f"{index // 12}-{index % 12 + 1:02d}")
+    previous_month = recent[-2] if len(recent) > 1 else None
+    empty = {'دخل': 0, 'مصروف': 0, 'تحويلات': 0, 'العدد': 0}
+    month_categories = sorted(((amount, category) for (m, category), amount in categories.items() if m == month),
+                              reverse=True)[:top]
+    return {
+        'months': [(m, {kind: value / 100 if kind != 'العدد' else value
+                        for kind, value in totals.get(m, empty).items()})
+                   for m in recent],
+        'month': month,
+        'previous_month': previous_month,
+        'top_categories': [(category, amount / 100, categories.get((previous_month, category), 0) / 100)
+                           for amount, category in month_categories],
+    }
+
+def _percent_change(current, previous):
+    if not previous:
+        return ""
+    change = (current - previous) / previous * 100
+    return f" ({'↑' if change >= 0 else '↓'}{abs(change):.0f}%)"
+
+def build_report_message(summary):
+    """رسالة التقارير (HTML) من report_summary"""
+    from html import escape
+    
+    if not summary['months']:
+        return "📭 لا توجد معاملات مسجلة بعد."
+    
+    message = "<b>📊 التقارير الشهرية</b>\n<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n\n"
+    message += "<b>📅 مقارنة الأشهر (المصروف مقارنة بالشهر السابق):</b>\n"
+    previous_expense = None
+    for month, totals in summary['months']:
+        net = totals['دخل'] - totals['مصروف']
+        message += (f"<b>▪ {month}</b>: دخل {totals['دخل']:,.0f} | مصروف {totals['مصروف']:,.0f}"
+                    f"{_percent_change(totals['مصروف'], previous_expense)} | صافي {net:,.0f}"
+                    f" | تحويلات {totals['تحويلات']:,.0f}\n")
+        previous_expense = totals['مصروف']
+    
+    month_expense = summary['months'][-1][1]['مصروف']
+    message += f"\n<b>🏷 أعلى التصنيفات مصروفاً في {summary['month']}:</b>\n"
+    for position, (category, amount, previous) in enumerate(summary['top_categories'], 1):
+        share = amount / month_expense * 100 if month_expense else 0
+        message += (f"{position}. {escape(str(category)) or 'بدون تصنيف'}: {amount:,.0f} ريال ({share:.0f}%)"
+                    f"{_percent_change(amount, previous)}\n")
+    if not summary['top_categories']:
+        message += "لا توجد مصروفات في هذا الشهر\n"
+    return message
+
+# ===== نقاط الأرصدة الشهرية =====
+# لكل حساب: الرصيد الافتتاحي (قبل كل العمليات) ورصيد نهاية كل شهر فيه عمليات، بالهللات.
+# أي رصيد تاريخي = نقطة نهاية الشهر السابق + عمليات جزء الشهر حتى التاريخ فقط.
+# تُحسب بتجميع واحد عند التشغيل (أو لكل حساب من عملياته فقط عند أول طلب بعد تغير البيانات)،
+# وكل عملية جديدة تضيف أثرها إلى نقاط شهرها وما بعده، ويُتحقق منها بإعادة حساب كاملة
+# في المهمة الدورية (على طبقتي التخزين) إذا حُدّثت منذ آخر تحقق
+_CHECKPOINTS = {
+    'version': None,   # نسخة البيانات التي تطابقها النقاط
+    'verified': None,  # نسخة البيانات عند آخر حساب كامل (لا تحديثات تدريجية بعدها إذا ساوت version)
+    'accounts': {},   # اسم الحساب -> {'opening', 'months': [YYYY-MM مرتبة], 'balances': [رصيد نهاية كل شهر]}
+}
+
+def _balance_effects(transactions, transfers):
+    """أثر كل عملية من الجداول المنمطة على رصيد حسابها بالهللات: جدول (الحساب، اليوم، الأثر)"""
+    # أثر كل عملية كما في الرصيد المدور للكشوفات (_ROLLED_SIGNS: أنواع المعاملات الأخرى بلا أثر)
+    signs = transactions['النوع'].astype(object).map(_ROLLED_SIGNS).fillna(0.0).to_numpy().astype(np.int64)
+    effects = pd.concat([
+        pd.DataFrame({'account': transactions['الحساب'].astype(object), 'day': transactions['التاريخ'],
+                      'delta': signs * transactions['المبلغ'].to_numpy()}),
+        pd.DataFrame({'account': transfers['من حساب'].astype(object), 'day': transfers['التاريخ'],
+                      'delta': -transfers['المبلغ'].to_numpy()}),
+        pd.DataFrame({'account': transfers['إلى حساب'].astype(object), 'day': transfers['التاريخ'],
+                      'delta': transfers['المبلغ'].to_numpy()}),
+    ], ignore_index=True)
+    return effects.astype({'delta': np.int64})
+
+def _ledger_effects(account_name=None):
+    """
+    أثر العمليات والرصيد الافتتاحي لكل حساب: لكل الحسابات من الجداول المنمطة، أو لحساب
+    واحد من عملياته فقط (load_account_ledger: استعلام بالفهارس في SQLite)
+    
+    الرصيد الافتتاحي = الرصيد الحالي - أثر كل العمليات (بما فيها التي بلا تاريخ صالح)
+    """
+    accounts = _LEDGER_CACHE['data'][0]
+    if account_name is None:
+        effects = _balance_effects(*typed_ledger())
+    else:
+        accounts = accounts[accounts['اسم الحساب'] == account_name]
+        if accounts.empty:
+            return None, {}
+        effects = _balance_effects(*load_account_ledger(account_name))
+        effects = effects[effects['account'] == account_name]
+    totals = effects.groupby('account')['delta'].sum()
+    openings = {name: int(current) - int(totals.get(name, 0))
+                for name, current in zip(accounts['اسم الحساب'], to_halalas(accounts['الرصيد']))}
+    return effects, openings
+
+def _record_effects(record):
+    """
+    أثر عملية جديدة على كل حساب موجود: {الحساب: (الفرق، الأثر)} بالهللات
+    
+    الأثر كما في _balance_effects، والفرق ما يغير الرصيد الحالي دون أن يظهر في الكشف
+    (نوع معاملة آخر) فيغير الرصيد الافتتاحي وكل ما بعده
+    """
+    row = record['row']
+    if record['kind'] == 'transaction':
+        effects = [(row['الحساب'], _ROLLED_SIGNS.get(row['النوع'], 0.0) * row['المبلغ'])]
+    else:
+        effects = [(row['من حساب'], -row['المبلغ']), (row['إلى حساب'], row['المبلغ'])]
+    deltas = {}
+    for account_name, delta in _record_deltas(record):
+        deltas[account_name] = deltas.get(account_name, 0.0) + delta
+    account_effects = {}
+    for account_name, effect in effects:
+        account_effects[account_name] = account_effects.get(account_name, 0.0) + effect
+    result = {}
+    for account_name, delta in deltas.items():
+        effect = int(to_halalas([account_effects[account_name]])[0])
+        result[account_name] = (int(to_halalas([delta])[0]) - effect, effect)
+    return result
+
+def _compute_checkpoints(account_name=None):
+    """حساب نقاط كل الحسابات (أو حساب واحد) من العمليات وأرصدة الحسابات الحالية"""
+    effects, openings = _ledger_effects(account_name)
+    if not openings:
+        return {}
+    # العمليات بلا تاريخ صالح تأتي في آخر الكشف فلا تدخل في نقاط الأشهر
+    effects = effects.assign(month=effects['day'].dt.strftime('%Y-%m'))
+    monthly = effects.dropna(subset=['month']).groupby(['account', 'month'])['delta'].sum()
+    
+    checkpoints = {}
+    for account_name, opening in openings.items():
+        if account_name in monthly.index.get_level_values(0):
+            account_months = monthly.loc[account_name]
+            months = list(account_months.index)
+            balances = [int(balance) for balance in opening + np.cumsum(account_months.to_numpy())]
+        else:
+            months, balances = [], []
+        checkpoints[account_name] = {'opening': opening, 'months': months, 'balances': balances}
+    return checkpoints
+
+def _account_checkpoints(account_name):
+    """نقاط الحساب لنسخة البيانات الحالية (أو None لحساب غير موجود). يُستدعى تحت _LEDGER_LOCK"""
+    _refresh_ledger()
+    if _derived_is_stale(_CHECKPOINTS):
+        # كل حساب يُحسب من عملياته عند أول طلب له
+        _CHECKPOINTS['accounts'].clear()
+        _CHECKPOINTS['version'] = _CHECKPOINTS['verified'] = _LEDGER_CACHE['version']
+    entry = _CHECKPOINTS['accounts'].get(account_name)
+    if entry is None:
+        entry = _compute_checkpoints(account_name).get(account_name)
+        if entry is not None:
+            _CHECKPOINTS['accounts'][account_name] = entry
+    return entry
+
+def build_checkpoints():
+    """بناء نقاط الأرصدة الشهرية لكل الحسابات عند التشغيل (تجميع واحد)"""
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        _CHECKPOINTS['accounts'] = _compute_checkpoints()
+        _CHECKPOINTS['version'] = _CHECKPOINTS['verified'] = _LEDGER_CACHE['version']
+        months = sum(len(entry['months']) for entry in _CHECKPOINTS['accounts'].values())
+        print(f"📍 نقاط الأرصدة: {months} نهاية شهر لـ {len(_CHECKPOINTS['accounts'])} حساب")
+
+def _update_checkpoints(records):
+    """إضافة أثر العمليات الجديدة إلى نقاط شهرها وما بعده"""
+    for record in records:
+        date = normalize_date(record['row']['التاريخ'])
+        for account_name, (drift, effect) in _record_effects(record).items():
+            entry = _CHECKPOINTS['accounts'].get(account_name)
+            if entry is None:
+                continue  # حساب غير موجود، أو لم تُحسب نقاطه بعد (تُحسب عند طلبها)
+            entry['opening'] += drift
+            months, balances = entry['months'], entry['balances']
+            if date is None:
+                # العملية بلا تاريخ تأتي في آخر الكشف فلا تغير نقاط الأشهر إلا بالفرق
+                position, effect = len(months), 0
+            else:
+                position = bisect_left(months, date[:7])
+                if position == len(months) or months[position] != date[:7]:
+                    months.insert(position, date[:7])
+                    balances.insert(position, balances[position - 1] if position else entry['opening'] - drift)
+            for i in range(len(balances)):
+                balances[i] += drift + (effect if i >= position else 0)
+
+def balance_before(account_name, date):
+    """
+    رصيد الحساب قبل عمليات اليوم date (YYYY-MM-DD)، أو None لحساب غير موجود
+    
+    نقطة نهاية الشهر السابق، ثم عمليات هذا الشهر قبل اليوم من فهرس الأرصدة المرتب بالتاريخ
+    (بحث ثنائي على عمود اليوم، بدون المرور على عمليات الحساب الأخرى)
+    """
+    with _LEDGER_LOCK:
+        entry = _account_checkpoints(account_name)
+        if entry is None:
+            return None
+        month = date[:7]
+        position = bisect_left(entry['months'], month)
+        balance = entry['balances'][position - 1] if position else entry['opening']
+        if position < len(entry['months']) and entry['months'][position] == month:
+            frame = _account_index_entry(account_name)['frame']
+            days = frame['day'].to_numpy()
+            start = np.searchsorted(days, np.datetime64(f"{month}-01", 'ns'), side='left')
+            end = np.searchsorted(days, np.datetime64(date, 'ns'), side='left')
+            tail = frame.iloc[start:end]
+            signs = tail['type'].map(_ROLLED_SIGNS).fillna(0.0).to_numpy().astype(np.int64)
+            balance += int(signs @ to_halalas(tail['amount']))
+        return balance / 100
+
+def verify_checkpoints():
+    """مقارنة النقاط المحدثة تدريجياً بإعادة حساب كاملة واستبدالها. ترجع الحسابات المختلفة"""
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        fresh = _compute_checkpoints()
+        mismatched = []
+        if _CHECKPOINTS['version'] == _LEDGER_CACHE['version']:
+            # الحسابات التي حُسبت نقاطها ثم حُدّثت تدريجياً
+            current = _CHECKPOINTS['accounts']
+            mismatched = sorted(name for name in current if fresh.get(name) != current[name])
+            if mismatched:
+                print(f"⚠️ نقاط الأرصدة لا تطابق إعادة الحساب في: {', '.join(mismatched)} - تم تصحيحها")
+        _CHECKPOINTS['accounts'] = fresh
+        _CHECKPOINTS['version'] = _CHECKPOINTS['verified'] = _LEDGER_CACHE['version']
+        return mismatched
+
+def verify_updated_checkpoints():
+    """التحقق من النقاط فقط إذا حُدّثت تدريجياً منذ آخر حساب كامل. ترجع الحسابات المختلفة"""
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        if _derived_is_stale(_CHECKPOINTS) or _CHECKPOINTS['verified'] == _CHECKPOINTS['version']:
+            return []
+        return verify_checkpoints()
+
+# ===== سلسلة الأرصدة اليومية =====
+# لكل حساب مصفوفة int64 برصيد نهاية كل يوم (بالهللات) من يوم أول عملية إلى يوم آخر عملية،
+# والموضع = رقم اليوم (أيام منذ 1970-01-01) - رقم اليوم الأول. قبلها الرصيد الافتتاحي وبعدها
+# رصيد آخر يوم. تُبنى بمجموع تراكمي واحد ثم تُحدّث مع كل عملية (إضافة الأثر من يومها فما بعد)
+_DAILY_BALANCES = {
+    'version': None,  # نسخة البيانات التي تطابقها السلاسل
+    'accounts': {},   # اسم الحساب -> {'opening', 'first': رقم اليوم الأول، 'balances': np.ndarray}
+}
+
+def day_number(date):
+    """رقم اليوم (أيام منذ 1970-01-01) لتاريخ YYYY-MM-DD"""
+    return int(np.datetime64(date, 'D').astype(np.int64))
+
+def _compute_daily_balances():
+    """حساب سلاسل كل الحسابات من الجداول المنمطة وأرصدة الحسابات الحالية"""
+    effects, openings = _ledger_effects()
+    # العمليات بلا تاريخ صالح تأتي في آخر الكشف فلا تدخل في السلسلة
+    effects = effects.dropna(subset=['day'])
+    effects = effects.assign(number=effects['day'].to_numpy().astype('datetime64[D]').astype(np.int64))
+    grouped = dict(tuple(effects.groupby('account')))
+    
+    series = {}
+    for account_name, opening in openings.items():
+        account_effects = grouped.get(account_name)
+        if account_effects is None or account_effects.empty:
+            series[account_name] = {'opening': opening, 'first': None, 'balances': np.zeros(0, dtype=np.int64)}
+            continue
+        numbers = account_effects['number'].to_numpy()
+        first = int(numbers.min())
+        daily = np.zeros(int(numbers.max()) - first + 1, dtype=np.int64)
+        np.add.at(daily, numbers - first, account_effects['delta'].to_numpy().astype(np.int64))
+        series[account_name] = {'opening': opening, 'first': first, 'balances': opening + np.cumsum(daily)}
+    return series
+
+def _account_daily_balances(account_name):
+    """سلسلة الحساب لنسخة البيانات الحالية (أو None لحساب غير موجود). يُستدعى تحت _LEDGER_LOCK"""
+    _refresh_ledger()
+    if _derived_is_stale(_DAILY_BALANCES):
+        _DAILY_BALANCES['accounts'] = _compute_daily_balances()
+        _DAILY_BALANCES['version'] = _LEDGER_CACHE['version']
+    return _DAILY_BALANCES['accounts'].get(account_name)
+
+def build_daily_balances():
+    """بناء سلاسل الأرصدة اليومية عند التشغيل"""
+    with _LEDGER_LOCK:
+        _account_daily_balances(None)
+        days = sum(len(entry['balances']) for entry in _DAILY_BALANCES['accounts'].values())
+        print(f"📈 الأرصدة اليومية: {days} يوم لـ {len(_DAILY_BALANCES['accounts'])} حساب")
+
+def _update_daily_balances(records):
+    """إضافة أثر العمليات الجديدة من يومها فما بعد"""
+    for record in records:
+        date = normalize_date(record['row']['التاريخ'])
+        for account_name, (drift, effect) in _record_effects(record).items():
+            entry = _DAILY_BALANCES['accounts'].get(account_name)
+            if entry is None:
+                continue  # الحساب غير الموجود لا يتأثر رصيده
+            entry['opening'] += drift
+            balances = entry['balances'] + drift
+            if date is not None:
+                number = day_number(date)
+                if entry['first'] is None:
+                    entry['first'] = number
+                    balances = np.array([entry['opening']], dtype=np.int64)
+                elif number < entry['first']:
+                    # أيام جديدة قبل أول يوم برصيد افتتاحي
+                    balances = np.concatenate((np.full(entry['first'] - number, entry['opening'], dtype=np.int64), balances))
+                    entry['first'] = number
+                elif number - entry['first'] >= len(balances):
+                    # أيام جديدة بعد آخر يوم برصيد آخر يوم
+                    balances = np.concatenate((balances, np.full(number - entry['first'] - len(balances) + 1,
+                                                                 balances[-1], dtype=np.int64)))
+                balances[number - entry['first']:] += effect
+            entry['balances'] = balances
+
+def _daily_positions(entry, start, end):
+    """أرصدة نهاية الأيام من start إلى end (رقما يومين) من السلسلة، مع ما قبلها وما بعدها"""
+    if entry['first'] is None:
+        return np.full(end - start + 1, entry['opening'], dtype=np.int64)
+    positions = np.arange(start, end + 1) - entry['first']
+    inside = np.clip(positions, 0, len(entry['balances']) - 1)
+    return np.where(positions < 0, entry['opening'], entry['balances'][inside])
+
+def balance_on(account_name, date):
+    """رصيد الحساب في نهاية اليوم date (YYYY-MM-DD)، أو None لحساب غير موجود"""
+    with _LEDGER_LOCK:
+        entry = _account_daily_balances(account_name)
+        if entry is None:
+            return None
+        number = day_number(date)
+        return int(_daily_positions(entry, number, number)[0]) / 100
+
+def balance_stats(account_name, start_date, end_date):
+    """
+    أقل وأعلى ومتوسط رصيد نهاية اليوم للحساب في الفترة (YYYY-MM-DD شاملة)، أو None لحساب غير موجود
+    
+    ترجع قاموساً: min و max و average (بالريال) و min_date و max_date (أول يوم وصل فيه الرصيد لها)
+    """
+    with _LEDGER_LOCK:
+        entry = _account_daily_balances(account_name)
+        if entry is None:
+            return None
+        start, end = sorted((day_number(start_date), day_number(end_date)))
+        balances = _daily_positions(entry, start, end)
+    low, high = int(balances.argmin()), int(balances.argmax())
+    return {
+        'min': int(balances[low]) / 100,
+        'max': int(balances[high]) / 100,
+        'average': float(balances.mean()) / 100,
+        'min_date': str(np.datetime64(start + low, 'D')),
+        'max_date': str(np.datetime64(start + high, 'D')),
+    }
+
+# فهرس التكرار: بصمات رسائل البنك المسجلة وبصمات المعاملات (المبلغ، التاريخ، الحساب، الوصف)
+# يُبنى عند التشغيل ويُحدّث مع كل عملية جديدة، فالفحص عملية بحث واحدة في مجموعة
+_DUPLICATE_INDEX = {
+    'version': None,       # نسخة البيانات التي تطابقها بصمات المعاملات
+    'fingerprints': set(),
+    'messages': set(),     # بصمات الرسائل (محفوظة في MESSAGE_INDEX_FILE)
+}
+
+def message_hash(message):
+    """بصمة رسالة البنك بعد توحيدها (المسافات وحالة الأحرف والحروف العربية المتشابهة)"""
+    normalized = ' '.join(str(message).lower().translate(_ARABIC_NORMALIZATION).split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+def transaction_fingerprint(amount, date, account, merchant):
+    """بصمة المعاملة: معاملتان بنفس المبلغ والتاريخ والحساب والوصف على الأغلب مكررتان"""
+    merchant = '' if pd.isna(merchant) else normalize_account_name(merchant)
+    return (round(float(amount), 2), str(date)[:10], normalize_account_name(account), merchant)
+
+def _build_transaction_fingerprints():
+    """بصمات كل المعاملات المسجلة من جدول المعاملات"""
+    transactions = _LEDGER_CACHE['data'][1]
+    descriptions = transactions['الوصف'] if 'الوصف' in transactions else itertools.repeat('')
+    _DUPLICATE_INDEX['fingerprints'] = set(map(
+        transaction_fingerprint, transactions['المبلغ'], transactions['التاريخ'],
+        transactions['الحساب'], descriptions))
+    _DUPLICATE_INDEX['version'] = _LEDGER_CACHE['version']
+
+def build_duplicate_index():
+    """بناء فهرس التكرار عند التشغيل"""
+    with _LEDGER_LOCK:
+        _refresh_ledger()
+        _build_transaction_fingerprints()
+        if os.path.exists(MESSAGE_INDEX_FILE):
+            with open(MESSAGE_INDEX_FILE, encoding='utf-8') as f:
+                _DUPLICATE_INDEX['messages'] = {line.strip() for line in f if line.strip()}
+        print(f"🔁 فهرس التكرار: {len(_DUPLICATE_INDEX['fingerprints'])} معاملة و "
+              f"{len(_DUPLICATE_INDEX['messages'])} رسالة")
+
+def _update_duplicate_index(records):
+    """إضافة بصمات المعاملات الجديدة"""
+    for record in records:
+        if record['kind'] == 'transaction':
+            row = record['row']
+            _DUPLICATE_INDEX['fingerprints'].add(transaction_fingerprint(
+                row['المبلغ'], row['التاريخ'], row['الحساب'], row.get('الوصف', '')))
+
+def remember_bank_messages(messages):
+    """حفظ بصمات رسائل البنك التي تم تسجيلها"""
+    hashes = [message_hash(message) for message in messages if message]
+    with _LEDGER_LOCK:
+        hashes = [h for h in dict.fromkeys(hashes) if h not in _DUPLICATE_INDEX['messages']]
+        if not hashes:
+            return
+        with open(MESSAGE_INDEX_FILE, 'a', encoding='utf-8') as f:
+            f.write(''.join(h + '\n' for h in hashes))
+        _DUPLICATE_INDEX['messages'].update(hashes)
+
+def find_duplicate(new_transaction, message=None):
+    """سبب الاشتباه بأن المعاملة مسجلة مسبقاً، أو None"""
+    with _LEDGER_LOCK:
+        if message and message_hash(message) in _DUPLICATE_INDEX['messages']:
+            return "نفس رسالة البنك سُجلت من قبل"
+        _refresh_ledger()
+        if _derived_is_stale(_DUPLICATE_INDEX):
+            _build_transaction_fingerprints()
+        fingerprint = transaction_fingerprint(
+            new_transaction['المبلغ'], new_transaction['التاريخ'],
+            new_transaction['الحساب'], new_transaction.get('الوصف', ''))
+        if fingerprint in _DUPLICATE_INDEX['fingerprints']:
+            return "توجد معاملة بنفس المبلغ والتاريخ والحساب والوصف"
+    return None
+
 # التصنيفات التلقائية للمعاملات
 AUTO_CATEGORIES = {
     'al faisal': '🍔 طعام',
@@ -156,99 +1633,442 @@ AUTO_CATEGORIES = {
     'economy': '🍔 طعام',
 }
 
-def parse_date_from_message(date_str):
-    """تحويل التاريخ من الصيغ المختلفة إلى صيغة قياسية YYYY-MM-DD"""
+# أنماط تحليل رسائل البنك (تُجمّع مرة واحدة)
+_EXPENSE_PATTERN = re.compile(r'pos purchase|شراء|عملية شراء|بطاقة|مدى|مدى باي|online purchase|شراء اون لاين')
+_TRANSFER_PATTERN = re.compile(r'transfer|تحويل|حوالة|مدفوعات|دفع|خدمات')
+_INCOME_PATTERN = re.compile(r'deposit|إيداع|رواتب|payroll')
+_AMOUNT_PATTERN = re.compile(r'(?:amount|مبلغ)[:\s]*sar?\s*([\d,]+(?:\.\d{1,2})?)', re.IGNORECASE)
+_AMOUNT_CURRENCY_PATTERN = re.compile(r'([\d,]+(?:\.\d{1,2})?)\s*(?:sar|ر\.س)')
+_MERCHANT_PATTERN = re.compile(r'(?:at|عند|من|لدى)[:\s]*([^\n]+)', re.IGNORECASE)
+_MESSAGE_DATE_PATTERN = re.compile(r'(\d{1,2}[-/]\d{1,2}[-/]\d{2,4}(?: \d{1,2}:\d{2})?)')
+_CARD_DIGITS_PATTERN = re.compile(r'\d{4}')
+_CARD_WORDS_PATTERN = re.compile(r'credit card|بطاقة|visa|mastercard')
+_ACCOUNT_WORDS_PATTERN = re.compile(r'account|حساب|بنك|bank')
+
+# جداول القواعد (AUTO_CATEGORIES و ACCOUNT_MAPPING) مجمّعة في تعبير واحد لكل جدول.
+# لا يُعدل القاموس أبداً: عند تغير القواعد يُبنى قاموس جديد ويحل محله بإسناد واحد
+_RULE_MATCHERS = {
+    'categories': None,  # (النمط، الكلمة -> (الأولوية، القيمة)، أطوال الكلمات)
+    'accounts': None,
+}
+
+def _trie_pattern(node):
+    """تحويل شجرة الحروف إلى تعبير منتظم: الفروع تبدأ بحروف مختلفة فلا يُجرب عند كل موضع إلا فرع واحد"""
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    # نهاية كلمة داخل الشجرة: الاستمرار اختياري (ويُفضل الأطول)
+    return '(?:' + body + ')?' if '' in node else body
+
+def _compile_rule_table(table, fold_case=False):
+    """تجميع جدول قواعد (كلمة -> قيمة) في تعبير واحد يطابق أطول كلمة عند أي موضع"""
+    rules = {}
+    for keyword, value in table.items():
+        keyword = keyword.lower() if fold_case else keyword
+        if keyword:
+            rules.setdefault(keyword, (len(rules), value))
+    if not rules:
+        return None
+    
+    trie = {}
+    for keyword in rules:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = True
+    lengths = sorted({len(keyword) for keyword in rules})
+    return re.compile(_trie_pattern(trie)), rules, lengths
+
+def _compile_matchers(auto_categories, account_mapping):
+    """مطابقات جداول القواعد"""
+    return {
+        'categories': _compile_rule_table(auto_categories, fold_case=True),
+        'accounts': _compile_rule_table(account_mapping),
+    }
+
+def compile_rules():
+    """إعادة تجميع جداول القواعد (تُستدعى عند التشغيل وعند تغير القواعد)"""
+    global _RULE_MATCHERS
+    _RULE_MATCHERS = _compile_matchers(AUTO_CATEGORIES, ACCOUNT_MAPPING)
+
+def _match_rule(matcher, text):
+    """
+    قيمة القاعدة الأعلى أولوية (الأسبق في الجدول) التي تظهر في النص
+    
+    كل بحث يقفز مباشرة إلى الموضع التالي الذي تبدأ عنده كلمة، فعدد الخطوات
+    بعدد المطابقات وليس بعدد القواعد
+    """
+    if matcher is None:
+        return None
+    pattern, rules, lengths = matcher
+    best = None
+    position = 0
+    while True:
+        match = pattern.search(text, position)
+        if match is None:
+            break
+        # أطول كلمة عند هذا الموضع، والكلمات الأقصر التي تبدأ بها تطابق أيضاً
+        matched = match.group()
+        for length in lengths:
+            if length > len(matched):
+                break
+            rule = rules.get(matched[:length])
+            if rule and (best is None or rule[0] < best[0]):
+                best = rule
+        if best[0] == 0:
+            break
+        position = match.start() + 1
+    return best[1] if best else None
+
+def match_category(merchant):
+    """التصنيف التلقائي للجهة من AUTO_CATEGORIES (أو None)"""
+    return _match_rule(_RULE_MATCHERS['categories'], merchant.lower())
+
+def match_account(message):
+    """الحساب من أرقام ACCOUNT_MAPPING الموجودة في الرسالة (أو None)"""
+    return _match_rule(_RULE_MATCHERS['accounts'], message)
+
+compile_rules()
+
+# ===== ملف القواعد =====
+_RULES_FILE_STATE = {'signature': None}  # بصمة آخر نسخة تمت قراءتها من ملف القواعد
+_RULES_LOCK = threading.Lock()
+
+def _read_rules_file(path):
+    """قراءة ملف القواعد والتحقق من أنواعه. القسم غير الموجود في الملف يبقى على قيمته الحالية"""
+    with open(path, encoding='utf-8') as f:
+        rules = json.load(f)
+    if not isinstance(rules, dict):
+        raise ValueError("يجب أن يكون الملف كائن JSON")
+    account_mapping = rules.get('account_mapping', ACCOUNT_MAPPING)
+    auto_categories = rules.get('auto_categories', AUTO_CATEGORIES)
+    allowed_user_ids = rules.get('allowed_user_ids', ALLOWED_USER_IDS)
+    monthly_budgets = rules.get('monthly_budgets', MONTHLY_BUDGETS)
+    if not isinstance(account_mapping, dict) or not isinstance(auto_categories, dict):
+        raise ValueError("account_mapping و auto_categories يجب أن تكون كائنات")
+    if not isinstance(allowed_user_ids, list):
+        raise ValueError("allowed_user_ids يجب أن تكون قائمة")
+    if not isinstance(monthly_budgets, dict) or not all(
+            isinstance(monthly_budgets.get(section, {}), dict) for section in ('categories', 'accounts')):
+        raise ValueError("monthly_budgets يجب أن يحتوي كائنين categories و accounts")
+    return (
+        {str(digits): str(account) for digits, account in account_mapping.items()},
+        {str(keyword): str(category) for keyword, category in auto_categories.items()},
+        [int(user_id) for user_id in allowed_user_ids],
+        {section: {str(name): float(limit) for name, limit in monthly_budgets.get(section, {}).items()}
+         for section in ('categories', 'accounts')},
+    )
+
+def reload_rules():
+    """
+    تحميل ملف القواعد إذا تغير (وقت التعديل والحجم). ترجع True إذا استُبدلت القواعد
+    
+    المطابقات الجديدة تُجمّع أولاً ثم تُستبدل المراجع، فالمعالجات الجارية تكمل بالقواعد
+    التي بدأت بها ولا تنتظر. الملف غير الصالح يُترك مع إبقاء القواعد الحالية.
+    """
+    global ACCOUNT_MAPPING, AUTO_CATEGORIES, ALLOWED_USER_IDS, MONTHLY_BUDGETS, _RULE_MATCHERS
+    signature = _file_signature(RULES_FILE)
+    if signature == _RULES_FILE_STATE['signature']:
+        return False
+    with _RULES_LOCK:
+        if signature == _RULES_FILE_STATE['signature']:
+            return False
+        # لا نعيد قراءة ملف غير صالح حتى يتغير مرة أخرى
+        _RULES_FILE_STATE['signature'] = signature
+        if signature is None:
+            return False
+        try:
+            account_mapping, auto_categories, allowed_user_ids, monthly_budgets = _read_rules_file(RULES_FILE)
+            matchers = _compile_matchers(auto_categories, account_mapping)
+        except (OSError, ValueError, TypeError, re.error) as e:
+            print(f"❌ ملف القواعد {RULES_FILE} غير صالح، نستمر بالقواعد الحالية: {e}")
+            return False
+        
+        ACCOUNT_MAPPING, AUTO_CATEGORIES, ALLOWED_USER_IDS = account_mapping, auto_categories, allowed_user_ids
+        MONTHLY_BUDGETS = monthly_budgets
+        _RULE_MATCHERS = matchers
+        budgets = len(monthly_budgets['categories']) + len(monthly_budgets['accounts'])
+        print(f"📜 تم تحميل القواعد من {RULES_FILE}: {len(account_mapping)} رقم حساب، "
+              f"{len(auto_categories)} تصنيف، {len(allowed_user_ids)} مستخدم، {budgets} ميزانية")
+        return True
+
+def reload_rules_job(context: CallbackContext):
+    """مهمة دورية لمراقبة ملف القواعد"""
     try:
-        if not date_str:
-            return None
-            
-        # إزالة أي مسافات زائدة
-        date_str = date_str.strip()
-        
-        # تحديد الفاصل المستخدم (/ أو -)
-        if '/' in date_str:
-            parts = date_str.split('/')
-        elif '-' in date_str:
-            parts = date_str.split('-')
-        else:
-            return None
-        
-        if len(parts) != 3:
-            return None
-        
-        # تنظيف الأجزاء من أي مسافات
-        parts = [part.strip() for part in parts]
-        
-        # تحديد تنسيق التاريخ (افترض DD/MM/YY)
-        # إذا كان الجزء الأول أكبر من 31 فهو likely السنة
-        if len(parts[0]) == 4 or int(parts[0]) > 31:
-            # التنسيق: YYYY/MM/DD أو YY/MM/DD
-            year, month, day = parts
-        elif int(parts[2]) > 31:
-            # التنسيق: DD/MM/YYYY أو DD/MM/YY
-            day, month, year = parts
-        else:
-            # افترض التنسيق: DD/MM/YY
-            day, month, year = parts
-        
-        # تحويل السنة إلى 4 أرقام إذا كانت مكونة من رقمين
-        if len(year) == 2:
-            # تحديد القرن المناسب (افترض القرن 21 للسنوات 00-99)
-            year = '20' + year
-        
-        # تحويل اليوم والشهر إلى صيغة مكونة من رقمين
-        day = day.zfill(2)
-        month = month.zfill(2)
-        
-        # التحقق من صحة التاريخ
-        datetime.strptime(f"{year}-{month}-{day}", "%Y-%m-%d")
-        
-        return f"{year}-{month}-{day}"
-        
+        reload_rules()
     except Exception as e:
-        print(f"Error parsing date {date_str}: {e}")
+        print(f"❌ فشل تحميل ملف القواعد: {e}")
+
+if not os.path.exists(RULES_FILE):
+    print(f"ℹ️ ملف القواعد {RULES_FILE} غير موجود، نستخدم القواعد المدمجة (انسخ rules.example.json وعدّله)")
+reload_rules()
+
+# ===== التصنيفات المتعلمة =====
+# من كل معاملة مسجلة لها وصف وتصنيف نتعلم تصنيف الجهة، وتُقدم على AUTO_CATEGORIES.
+# لا نحفظ إلا ما يخالف القواعد الثابتة، فتبقى القواعد هي المرجع لما تغطيه
+_MERCHANT_CATEGORIES = {
+    'entries': OrderedDict(),  # مفتاح الجهة -> التصنيف (الأحدث استخداماً في الآخر)
+    'prefixes': {},            # أول 3 حروف -> مفاتيح الجهات (للبحث التقريبي)
+    'dirty': False,            # تغيرات لم تُحفظ في الملف
+}
+_MERCHANT_KEY_PATTERN = re.compile(r'[^\w\s]|\d|_')
+
+def merchant_key(merchant):
+    """توحيد اسم الجهة: بدون أرقام (رقم الفرع) ورموز، بحروف صغيرة ومسافات مفردة"""
+    if not isinstance(merchant, str):
+        return ''
+    text = _MERCHANT_KEY_PATTERN.sub(' ', merchant.lower().translate(_ARABIC_NORMALIZATION))
+    return ' '.join(text.split())
+
+def _forget_merchant(key):
+    """حذف جهة من الكاش ومن فهرس الكلمات"""
+    _MERCHANT_CATEGORIES['entries'].pop(key)
+    prefixes = _MERCHANT_CATEGORIES['prefixes']
+    prefixes[key[:3]].discard(key)
+    if not prefixes[key[:3]]:
+        del prefixes[key[:3]]
+
+def learn_merchant_category(merchant, category):
+    """تعلم تصنيف جهة من معاملة مسجلة"""
+    key = merchant_key(merchant)
+    if not key or not isinstance(category, str) or not category.strip() or category == 'أخرى':
+        return
+    entries = _MERCHANT_CATEGORIES['entries']
+    if category == match_category(merchant):
+        # القواعد الثابتة تعطي نفس التصنيف، فلا حاجة لحفظه
+        if key in entries:
+            _forget_merchant(key)
+            _MERCHANT_CATEGORIES['dirty'] = True
+        return
+    if entries.get(key) != category:
+        _MERCHANT_CATEGORIES['dirty'] = True
+    entries[key] = category
+    entries.move_to_end(key)
+    _MERCHANT_CATEGORIES['prefixes'].setdefault(key[:3], set()).add(key)
+    while len(entries) > MERCHANT_CATEGORIES_LIMIT:
+        _forget_merchant(next(iter(entries)))
+
+def _similar_merchant(key):
+    """أقرب جهة متعلمة تبدأ بنفس الحروف (اسم أطول أو أقصر من نفس الجهة، أو اختلاف حرف)"""
+    candidates = _MERCHANT_CATEGORIES['prefixes'].get(key[:3])
+    if not candidates:
         return None
+    best, best_ratio = None, 0.85
+    for candidate in candidates:
+        shorter, longer = sorted((key, candidate), key=len)
+        if longer.startswith(shorter + ' '):
+            return candidate
+        ratio = difflib.SequenceMatcher(None, key, candidate).ratio()
+        if ratio >= best_ratio:
+            best, best_ratio = candidate, ratio
+    return best
+
+def learned_category(merchant):
+    """التصنيف المتعلم للجهة (مطابق أو تقريبي)، أو None"""
+    key = merchant_key(merchant)
+    if not key:
+        return None
+    with _LEDGER_LOCK:
+        entries = _MERCHANT_CATEGORIES['entries']
+        if key not in entries:
+            key = _similar_merchant(key)
+            if key is None:
+                return None
+        entries.move_to_end(key)
+        return entries[key]
+
+def categorize_merchant(merchant):
+    """تصنيف الجهة: المتعلم أولاً ثم AUTO_CATEGORIES، و «أخرى» إذا لم يوجد"""
+    if not merchant:
+        return 'أخرى'
+    return learned_category(merchant) or match_category(merchant) or 'أخرى'
+
+def _learn_from_records(records):
+    """تعلم التصنيفات من العمليات الجديدة (في الذاكرة فقط، والحفظ دفعات عبر save_merchant_categories)"""
+    for record in records:
+        row = record['row']
+        if record['kind'] == 'transaction' and row.get('الوصف'):
+            learn_merchant_category(row['الوصف'], row.get('التصنيف'))
+
+_MERCHANT_CATEGORIES_SAVE_LOCK = threading.Lock()
+
+def save_merchant_categories():
+    """
+    حفظ التصنيفات المتعلمة (بترتيب الاستخدام) إذا تغيرت
+    
+    تُستدعى مع دمج سجل العمليات وبعد الاستيراد وعند الإغلاق، لا مع كل معاملة.
+    تُؤخذ نسخة تحت _LEDGER_LOCK ثم يُكتب الملف بدونه حتى لا ينتظر التسجيل الكتابة
+    """
+    with _MERCHANT_CATEGORIES_SAVE_LOCK:
+        with _LEDGER_LOCK:
+            if not _MERCHANT_CATEGORIES['dirty']:
+                return
+            entries = list(_MERCHANT_CATEGORIES['entries'].items())
+            _MERCHANT_CATEGORIES['dirty'] = False
+        try:
+            temp_file = MERCHANT_CATEGORIES_FILE + '.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(temp_file, MERCHANT_CATEGORIES_FILE)
+        except OSError:
+            with _LEDGER_LOCK:
+                _MERCHANT_CATEGORIES['dirty'] = True
+            raise
+
+def build_merchant_categories():
+    """تحميل التصنيفات المتعلمة عند التشغيل، أو تعلمها من كل المعاملات إذا لم يوجد ملف"""
+    with _LEDGER_LOCK:
+        _MERCHANT_CATEGORIES['entries'].clear()
+        _MERCHANT_CATEGORIES['prefixes'].clear()
+        if os.path.exists(MERCHANT_CATEGORIES_FILE):
+            with open(MERCHANT_CATEGORIES_FILE, encoding='utf-8') as f:
+                for key, category in json.load(f):
+                    learn_merchant_category(key, category)
+        else:
+            _refresh_ledger()
+            transactions = _LEDGER_CACHE['data'][1]
+            if 'الوصف' in transactions:
+                # بالترتيب الزمني حتى يغلب آخر تصنيف للجهة
+                for merchant, category in zip(transactions['الوصف'], transactions['التصنيف']):
+                    learn_merchant_category(merchant, category)
+            _MERCHANT_CATEGORIES['dirty'] = True
+        save_merchant_categories()
+        print(f"🏷 التصنيفات المتعلمة: {len(_MERCHANT_CATEGORIES['entries'])} جهة")
+
+# ===== محللات خاصة بكل بنك =====
+# كل محلل يُسجل بنمط توقيع رخيص يميز صيغة رسائل البنك، ولا يُشغل إلا محلل أول توقيع
+# مطابق. إذا لم يطابق أي توقيع أو فشل المحلل نرجع إلى التحليل العام.
+BANK_PARSERS = []  # (اسم البنك، نمط التوقيع، دالة الاستخراج) بترتيب الفحص
+
+def bank_parser(name, signature):
+    """تسجيل محلل رسائل بنك: signature يُفحص على الرسالة قبل تشغيل المحلل"""
+    def register(extractor):
+        BANK_PARSERS.append((name, re.compile(signature, re.IGNORECASE | re.MULTILINE), extractor))
+        return extractor
+    return register
+
+# أسطر «العنوان: القيمة» التي تُكتب بها رسائل البنوك
+_LABELLED_LINE_PATTERN = re.compile(r'^[ \t]*([^:\n]{1,25}?)[ \t]*:[ \t]*(.*?)[ \t]*$', re.MULTILINE)
+_LABEL_NUMBER_PATTERN = re.compile(r'\d[\d,]*(?:\.\d+)?')
+_LABEL_DIGITS_PATTERN = re.compile(r'(?<!\d)\d{4}(?!\d)')
+_NUMERIC_DATE_PATTERN = re.compile(r'(?<!\d)(\d{1,4})[-/](\d{1,2})[-/](\d{2,4})(?!\d)')
+
+# عناوين كل حقل (بحروف صغيرة)
+_AMOUNT_LABELS = ('بقيمة', 'مبلغ', 'المبلغ', 'amount')  # «بقيمة» هي المبلغ بالريال في الشراء بعملة أجنبية
+_ACCOUNT_LABELS = {'بطاقة', 'البطاقة', 'card', 'حساب', 'الحساب', 'account', 'من حساب', 'إلى حساب',
+                   'المحفظة', 'wallet', 'من', 'إلى', 'from', 'to'}
+_MERCHANT_LABELS = {'لدى', 'عند', 'at', 'merchant', 'التاجر', 'الجهة', 'المفوتر'}
+_COUNTERPARTY_LABELS = {'من', 'إلى', 'from', 'to'}
+_DATE_LABELS = {'في', 'on', 'date', 'التاريخ'}
+
+def _numeric_date(text):
+    """أول تاريخ رقمي في النص بصيغة YYYY-MM-DD (السنة أولاً إذا كانت 4 أرقام، وإلا اليوم أولاً)"""
+    match = _NUMERIC_DATE_PATTERN.search(text)
+    return normalize_date(match.group()) if match else None
+
+def _parse_labelled_message(message, income_pattern, default_account=None):
+    """
+    استخراج المعاملة من رسالة بأسطر «العنوان: القيمة»
+    
+    النوع من السطر الأول (عنوان الرسالة)، والحساب من أرقام حقل البطاقة/الحساب فقط
+    وليس من أول 4 أرقام في الرسالة. يُرجع None إذا لم يوجد مبلغ.
+    """
+    labels = _LABELLED_LINE_PATTERN.findall(message)
+    fields = {}
+    for label, value in labels:
+        fields.setdefault(label.lower(), value)
+    
+    amount = None
+    for label in _AMOUNT_LABELS:
+        number = _LABEL_NUMBER_PATTERN.search(fields.get(label, ''))
+        if number:
+            amount = float(number.group().replace(',', ''))
+            break
+    if not amount:
+        return None
+    
+    account = None
+    merchant = None
+    counterparty = None
+    date_str = None
+    for label, value in labels:
+        label = label.lower()
+        digits = _LABEL_DIGITS_PATTERN.search(value)
+        if account is None and label in _ACCOUNT_LABELS and digits:
+            account = ACCOUNT_MAPPING.get(digits.group(), f"💳 بطاقة {digits.group()}")
+        elif merchant is None and label in _MERCHANT_LABELS and value:
+            merchant = value
+        elif counterparty is None and label in _COUNTERPARTY_LABELS and value and not digits:
+            counterparty = value
+        if date_str is None and label in _DATE_LABELS:
+            date_str = _numeric_date(value)
+    
+    # في الحوالات لا يوجد تاجر، فالوصف هو الطرف الآخر
+    merchant = merchant or counterparty
+    title = message.strip().split('\n', 1)[0].lower()
+    return {
+        'type': 'دخل' if income_pattern.search(title) else 'مصروف',
+        'amount': amount,
+        'merchant': merchant,
+        # الراجحي يكتب التاريخ في سطر بدون عنوان
+        'date': date_str or _numeric_date(message) or datetime.now().strftime('%Y-%m-%d'),
+        'account': account or match_account(message) or default_account,
+        'category': categorize_merchant(merchant)
+    }
 
+_CREDIT_CARD_INCOME = re.compile(r'سداد|استرداد|payment|refund')
+_STC_INCOME = re.compile(r'واردة|شحن|استرداد|received|top-up|refund')
+_BANK_INCOME = re.compile(r'واردة|إيداع|راتب|incoming|deposit|payroll|salary')
 
-def parse_date_from_message(date_str):
-    """محاولة تحويل التاريخ إلى yyyy-mm-dd"""
-    date_formats = [
-        "%d/%m/%Y",
-        "%d/%m/%y",
-        "%d-%m-%Y",
-        "%d-%m-%y",
-        "%d-%m-%y %H:%M",
-        "%d-%m-%Y %H:%M",
-        "%Y-%m-%d",
-        "%Y-%m-%d %H:%M"
-    ]
-    for fmt in date_formats:
-        try:
-            return datetime.strptime(date_str, fmt).strftime("%Y-%m-%d")
-        except ValueError:
-            continue
-    return None
+@bank_parser('mastercard', r'بطاقة ائتمانية|credit card')
+def parse_mastercard_message(message):
+    """بطاقة ماستر الائتمانية: سداد البطاقة والاسترداد دخل لحساب البطاقة"""
+    return _parse_labelled_message(message, _CREDIT_CARD_INCOME, default_account='💳 ماستر')
+
+@bank_parser('stc', r'ر\.س|wallet|المحفظة|^(?:date|التاريخ): ?\d{4}-')
+def parse_stc_message(message):
+    """STC Pay: التاريخ بصيغة YYYY-MM-DD والمبلغ بعد الرقم"""
+    return _parse_labelled_message(message, _STC_INCOME)
+
+@bank_parser('ahli', r'^(?:amount|مبلغ): ?sar')
+def parse_ahli_message(message):
+    """الأهلي: العملة قبل المبلغ والتاريخ في سطر «في:» / «On:»"""
+    return _parse_labelled_message(message, _BANK_INCOME)
+
+@bank_parser('rajhi', r'^(?:amount|مبلغ): ?[\d,.]+ ?sar\s*$')
+def parse_rajhi_message(message):
+    """الراجحي: العملة بعد المبلغ والتاريخ في آخر سطر بدون عنوان"""
+    return _parse_labelled_message(message, _BANK_INCOME)
 
 
 def parse_bank_message(message):
     """تحليل رسالة البنك واستخراج البيانات"""
     try:
+        # محلل البنك الخاص إن عُرفت صيغة الرسالة من توقيعها
+        for bank, signature, extractor in BANK_PARSERS:
+            if signature.search(message):
+                result = extractor(message)
+                if result:
+                    return result
+                break
+        
         message_lower = message.lower()
         
         # تحديد نوع المعاملة
         transaction_type = None
-        if re.search(r'pos purchase|شراء|عملية شراء|بطاقة|مدى|مدى باي|online purchase|شراء اون لاين', message_lower):
+        if _EXPENSE_PATTERN.search(message_lower):
             transaction_type = 'مصروف'
-        elif re.search(r'transfer|تحويل|حوالة|مدفوعات|دفع|خدمات', message_lower):
+        elif _TRANSFER_PATTERN.search(message_lower):
             transaction_type = 'مصروف'
-        elif re.search(r'deposit|إيداع|رواتب|payroll', message_lower):
+        elif _INCOME_PATTERN.search(message_lower):
             transaction_type = 'دخل'
         
         # استخراج المبلغ
         amount = None
-        amount_match = re.search(r'(?:amount|مبلغ)[:\s]*sar?\s*([\d,]+(?:\.\d{1,2})?)', message_lower, re.IGNORECASE)
+        amount_match = _AMOUNT_PATTERN.search(message_lower)
         if not amount_match:
-            amount_match = re.search(r'([\d,]+(?:\.\d{1,2})?)\s*(?:sar|ر\.س)', message_lower)
+            amount_match = _AMOUNT_CURRENCY_PATTERN.search(message_lower)
         if amount_match:
             try:
                 amount = float(amount_match.group(1).replace(',', ''))
@@ -257,18 +2077,18 @@ def parse_bank_message(message):
         
         # استخراج الجهة (merchant)
         merchant = None
-        merchant_match = re.search(r'(?:at|عند|من|لدى)[:\s]*([^\n]+)', message, re.IGNORECASE)
+        merchant_match = _MERCHANT_PATTERN.search(message)
         if merchant_match:
             merchant = merchant_match.group(1).strip()
         
         # استخراج التاريخ
         date_str = None
-        date_match = re.search(r'(\d{1,2}[-/]\d{1,2}[-/]\d{2,4}(?: \d{1,2}:\d{2})?)', message)
+        date_match = _MESSAGE_DATE_PATTERN.search(message)
         if date_match:
             date_str = date_match.group(1).strip()
         
         if date_str:
-            parsed_date = parse_date_from_message(date_str)
+            parsed_date = normalize_date(date_str)
             if parsed_date:
                 date_str = parsed_date
             else:
@@ -277,28 +2097,19 @@ def parse_bank_message(message):
             date_str = datetime.now().strftime('%Y-%m-%d')
         
         # التعرف على الحساب من خلال الأرقام
-        account = None
-        for acc_number, acc_name in ACCOUNT_MAPPING.items():
-            if acc_number in message:
-                account = acc_name
-                break
+        account = match_account(message)
         
         if not account:
-            acc_match = re.search(r'\d{4}', message)  # آخر 4 أرقام البطاقة
+            acc_match = _CARD_DIGITS_PATTERN.search(message)  # آخر 4 أرقام البطاقة
             if acc_match:
                 account = ACCOUNT_MAPPING.get(acc_match.group(), f"💳 بطاقة {acc_match.group()}")
-            elif re.search(r'credit card|بطاقة|visa|mastercard', message_lower):
+            elif _CARD_WORDS_PATTERN.search(message_lower):
                 account = '💳 ماستر'
-            elif re.search(r'account|حساب|بنك|bank', message_lower):
+            elif _ACCOUNT_WORDS_PATTERN.search(message_lower):
                 account = '🏦 أهلي 136'
         
         # التصنيف التلقائي
-        category = 'أخرى'
-        if merchant:
-            for keyword, cat in AUTO_CATEGORIES.items():
-                if keyword.lower() in merchant.lower():
-                    category = cat
-                    break
+        category = categorize_merchant(merchant)
         
         if transaction_type and amount:
             return {
@@ -314,9 +2125,31 @@ def parse_bank_message(message):
         return {"raw_message": message}
         
     except Exception as e:
-        logging.error("Error parsing bank message", exc_info=True)
+        print(f"❌ خطأ في تحليل رسالة البنك: {e}")
         return {"raw_message": message}
 
+def bank_transaction_row(transaction_data, accounts):
+    """صف المعاملة من بيانات رسالة بنك محللة، أو None إذا لم يُعرف الحساب"""
+    # تحديد الحساب إذا لم يتم التعرف عليه تلقائياً
+    if not transaction_data['account']:
+        # افتراضي بطاقة الائتمان للمصروفات، البنك للدخل
+        transaction_data['account'] = '💳 بطاقة الائتمان' if transaction_data['type'] == 'مصروف' else '💳 البنك الأهلي'
+    
+    # البحث عن اسم الحساب
+    account_name = get_account_name(transaction_data['account'], accounts)
+    if not account_name:
+        return None
+    
+    return {
+        # استخدام التاريخ من رسالة البنك أو التاريخ الحالي إذا لم يكن موجوداً
+        'التاريخ': transaction_data.get('date') or datetime.now().strftime('%Y-%m-%d'),
+        'النوع': transaction_data['type'],
+        'المبلغ': transaction_data['amount'],
+        'الحساب': account_name,
+        'التصنيف': transaction_data['category'],
+        'الوصف': transaction_data.get('merchant', '')
+    }
+
 # تنسيق البيانات للموافقة
 def format_transaction_for_approval(transaction_data):
     """تنسيق بيانات المعاملة للموافقة عليها"""
@@ -353,9 +2186,9 @@ def start(update: Update, context: CallbackContext):
     keyboard = [
         ['➕ إضافة مصروف', '💸 إضافة دخل'], 
         ['🔄 تحويل بين الحسابات', '📊 عرض الحسابات'], 
-        ['📈 عرض المصروفات', '🏦 إضافة حساب جديد'],
+        ['📈 عرض المصروفات', '📊 تقارير', '🏦 إضافة حساب جديد'],
         ['📋 كشف حساب', '📋 كشف حساب رصيد العملية', '📅 كشف بالتاريخ'],
-        ['🏦 معالجة رسالة بنك']  # ✅ أضف هذا السطر
+        ['🏦 معالجة رسالة بنك', '📥 استيراد رسائل بنك']
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     update.message.reply_text(
@@ -371,7 +2204,7 @@ def start(update: Update, context: CallbackContext):
     )
 @restricted
 def show_accounts(update: Update, context: CallbackContext):
-    accounts, _, _ = load_data()
+    accounts = load_accounts()
     
     # ترتيب الحسابات من الأصغر إلى الأكبر
     accounts_sorted = accounts.sort_values(by='الرصيد', ascending=True)
@@ -445,9 +2278,65 @@ def show_expenses(update: Update, context: CallbackContext):
     
     update.message.reply_text(message, parse_mode='Markdown')
 
+@restricted
+def show_reports(update: Update, context: CallbackContext):
+    """مقارنة الأشهر وأعلى التصنيفات من تجميعات التقارير"""
+    update.message.reply_text(build_report_message(report_summary()), parse_mode='HTML')
+
+@restricted
+def show_balance_history(update: Update, context: CallbackContext):
+    """
+    /balance الحساب [ddmmyy] [ddmmyy]: رصيد الحساب في نهاية يوم، أو أقل وأعلى ومتوسط رصيد في فترة
+    
+    بدون تاريخ يُعرض رصيد اليوم
+    """
+    args = list(context.args or [])
+    dates = []
+    while args and re.fullmatch(r'\d{6}', args[-1]) and len(dates) < 2:
+        dates.insert(0, args.pop())
+    if not args:
+        update.message.reply_text(
+            "📈 الاستخدام:\n"
+            "/balance الحساب ddmmyy ← الرصيد في نهاية اليوم\n"
+            "/balance الحساب ddmmyy ddmmyy ← أقل وأعلى ومتوسط رصيد في الفترة"
+        )
+        return
+    
+    accounts = load_accounts()
+    account_input = ' '.join(args)
+    account_name = get_account_name(account_input, accounts)
+    if not account_name:
+        update.message.reply_text(account_not_found_message(account_input, accounts))
+        return
+    try:
+        dates = [datetime.strptime(date, '%d%m%y').strftime('%Y-%m-%d') for date in dates]
+    except ValueError:
+        update.message.reply_text("❌ خطأ في صيغة التاريخ. استخدم الصيغة: ddmmyy")
+        return
+    
+    cleaned_account_name = re.sub(r'[^\w\s]', '', account_name).strip()
+    if len(dates) < 2:
+        date = dates[0] if dates else datetime.now().strftime('%Y-%m-%d')
+        balance = balance_on(account_name, date)
+        update.message.reply_text(
+            f"<b>📈 {cleaned_account_name}</b>\n"
+            f"<b>▪ الرصيد في نهاية {display_date(date)}: {balance:,.2f} ريال</b>",
+            parse_mode='HTML'
+        )
+        return
+    
+    stats = balance_stats(account_name, dates[0], dates[1])
+    update.message.reply_text(
+        f"<b>📈 {cleaned_account_name}: من {display_date(min(dates))} إلى {display_date(max(dates))}</b>\n"
+        f"<b>▪ أقل رصيد: {stats['min']:,.2f} ريال ({display_date(stats['min_date'])})</b>\n"
+        f"<b>▪ أعلى رصيد: {stats['max']:,.2f} ريال ({display_date(stats['max_date'])})</b>\n"
+        f"<b>▪ متوسط الرصيد: {stats['average']:,.2f} ريال</b>",
+        parse_mode='HTML'
+    )
+
 @restricted
 def add_expense(update: Update, context: CallbackContext):
-    accounts, _, _ = load_data()
+    accounts = load_accounts()
     
     # عرض الحسابات بدون الإيموجي للمستخدم
     accounts_list = get_accounts_without_emoji(accounts)
@@ -459,14 +2348,14 @@ def add_expense(update: Update, context: CallbackContext):
         f"🏦 **الحسابات المتاحة:**\n{accounts_list}\n\n"
         "**أمثلة:**\n"
         "• `طعام, 50, راجح`\n"
-        "• `مواصلات, 30, أهلي`",
+        "• `مواصلات, 30, أهلي 136`",
         parse_mode='Markdown'
     )
     return ADD_EXPENSE
 
 @restricted
 def add_income(update: Update, context: CallbackContext):
-    accounts, _, _ = load_data()
+    accounts = load_accounts()
     
     # عرض الحسابات بدون الإيموجي للمستخدم
     accounts_list = get_accounts_without_emoji(accounts)
@@ -477,7 +2366,7 @@ def add_income(update: Update, context: CallbackContext):
         "`المصدر, المبلغ, اسم الحساب`\n\n"
         f"🏦 **الحسابات المتاحة:**\n{accounts_list}\n\n"
         "**أمثلة:**\n"
-        "• `راتب, 5000, أهلي`\n"
+        "• `راتب, 5000, أهلي 136`\n"
         "• `عمل حر, 300, زراع`",
         parse_mode='Markdown'
     )
@@ -485,7 +2374,7 @@ def add_income(update: Update, context: CallbackContext):
 
 @restricted
 def transfer_money(update: Update, context: CallbackContext):
-    accounts, _, _ = load_data()
+    accounts = load_accounts()
     
     # عرض الحسابات بدون الإيموجي للمستخدم
     accounts_list = get_accounts_without_emoji(accounts)
@@ -555,18 +2444,25 @@ def handle_transaction_confirmation(update: Update, context: CallbackContext):
             transaction_data = context.user_data.get('pending_transaction')
             
             if transaction_data:
-                accounts, transactions, transfers = load_data()
+                accounts = load_accounts()
                 
-                # تحديد الحساب إذا لم يتم التعرف عليه تلقائياً
-                if not transaction_data['account']:
-                    # افتراضي بطاقة الائتمان للمصروفات، البنك للدخل
-                    transaction_data['account'] = '💳 بطاقة الائتمان' if transaction_data['type'] == 'مصروف' else '💳 البنك الأهلي'
-                
-                # البحث عن اسم الحساب
-                account_name = get_account_name(transaction_data['account'], accounts)
-                if not account_name:
-                    update.message.reply_text("❌ الحساب غير موجود!")
+                new_transaction = bank_transaction_row(transaction_data, accounts)
+                if not new_transaction:
+                    update.message.reply_text(account_not_found_message(transaction_data['account'], accounts))
                     return ConversationHandler.END
+                account_name = new_transaction['الحساب']
+                transaction_date = new_transaction['التاريخ']
+                
+                # تنبيه قبل تسجيل معاملة مكررة، والتسجيل فقط إذا أكد المستخدم مرة ثانية
+                duplicate = find_duplicate(new_transaction, transaction_data.get('original_message'))
+                if duplicate and not transaction_data.get('duplicate_confirmed'):
+                    transaction_data['duplicate_confirmed'] = True
+                    update.message.reply_text(
+                        f"⚠️ <b>يبدو أن هذه المعاملة مكررة:</b> {duplicate}\n\n"
+                        "أرسل <b>نعم</b> مرة أخرى لتسجيلها رغم ذلك، أو <b>لا</b> للإلغاء.",
+                        parse_mode='HTML'
+                    )
+                    return CONFIRM_TRANSACTION
                 
                 # تحديث رصيد الحساب
                 account_index = accounts[accounts['اسم الحساب'] == account_name].index
@@ -578,23 +2474,8 @@ def handle_transaction_confirmation(update: Update, context: CallbackContext):
                 
                 new_balance = accounts.at[account_index[0], 'الرصيد']
                 
-                # استخدام التاريخ من رسالة البنك أو التاريخ الحالي إذا لم يكن موجوداً
-                transaction_date = transaction_data.get('date')
-                if not transaction_date:
-                    transaction_date = datetime.now().strftime('%Y-%m-%d')
-                
-                # إضافة المعاملة مع الوصف
-                new_transaction = {
-                    'التاريخ': transaction_date,  # استخدام التاريخ المستخلص
-                    'النوع': transaction_data['type'],
-                    'المبلغ': transaction_data['amount'],
-                    'الحساب': account_name,
-                    'التصنيف': transaction_data['category'],
-                    'الوصف': transaction_data.get('merchant', '')  # إضافة الوصف
-                }
-                transactions = pd.concat([transactions, pd.DataFrame([new_transaction])], ignore_index=True)
-                
-                save_data(accounts, transactions, transfers)
+                record_transaction(new_transaction)
+                remember_bank_messages([transaction_data.get('original_message')])
                 
                 # حساب الموازنة
                 budget = calculate_budget()
@@ -618,6 +2499,10 @@ def handle_transaction_confirmation(update: Update, context: CallbackContext):
                     f"<b>▪ موازنة : {budget:,.0f} ريال</b>"
                 )
                 
+                if transaction_data['type'] == 'مصروف':
+                    for alert in budget_alerts(transaction_data['category'], account_name, transaction_date):
+                        message += f"\n{alert}"
+                
                 update.message.reply_text(message, parse_mode='HTML')
             else:
                 update.message.reply_text("❌ لا توجد معاملة معلقة!")
@@ -631,6 +2516,224 @@ def handle_transaction_confirmation(update: Update, context: CallbackContext):
         return ConversationHandler.END
 
 
+
+# ===== استيراد رسائل البنك دفعة واحدة =====
+# الرسائل في النص الملصق أو الملف النصي يفصلها سطر فارغ أو سطر من --- / ===
+_BANK_MESSAGE_SEPARATOR = re.compile(r'^\s*(?:[-=_]{3,})?\s*$')
+# أسماء عمود نص الرسالة في ملفات CSV المصدرة من تطبيقات الرسائل
+_CSV_MESSAGE_COLUMNS = {'body', 'message', 'text', 'sms', 'الرسالة', 'النص', 'نص الرسالة'}
+
+def split_bank_messages(text):
+    """تقسيم نص ملصق أو ملف .txt إلى رسائل بنك منفصلة"""
+    messages, current = [], []
+    for line in text.splitlines():
+        if _BANK_MESSAGE_SEPARATOR.match(line):
+            if current:
+                messages.append('\n'.join(current))
+                current = []
+        else:
+            current.append(line.strip())
+    if current:
+        messages.append('\n'.join(current))
+    return messages
+
+def read_bank_messages_csv(text):
+    """رسائل البنك من ملف CSV: عمود الرسالة إن وُجد في العنوان، وإلا أطول خلية في كل صف"""
+    import csv
+    from io import StringIO
+    
+    # StringIO وليس splitlines حتى تبقى الرسائل متعددة الأسطر داخل الخلية كما هي
+    rows = [row for row in csv.reader(StringIO(text)) if any(cell.strip() for cell in row)]
+    if not rows:
+        return []
+    header = [cell.strip().lower() for cell in rows[0]]
+    column = next((i for i, name in enumerate(header) if name in _CSV_MESSAGE_COLUMNS), None)
+    if column is not None:
+        return [row[column].strip() for row in rows[1:] if len(row) > column and row[column].strip()]
+    return [max(row, key=len).strip() for row in rows]
+
+def _decode_upload(data):
+    """فك ترميز الملف المرفوع (UTF-8 أو ترميز ويندوز العربي)"""
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('cp1256', errors='replace')
+
+def parse_bank_messages(messages, accounts):
+    """تحليل مجموعة رسائل دفعة واحدة. لكل رسالة: الصف الجاهز للتسجيل أو سبب الرفض"""
+    results = []
+    seen_messages = set()
+    seen_fingerprints = set()  # بصمات المعاملات المقبولة مبدئياً في هذه الدفعة
+    for message in messages:
+        transaction_data = parse_bank_message(message)
+        result = {'message': message, 'row': None, 'reason': None, 'duplicate': None}
+        if 'type' not in transaction_data:
+            result['reason'] = 'لم تُفهم'
+        else:
+            result['row'] = bank_transaction_row(transaction_data, accounts)
+            if result['row'] is None:
+                result['reason'] = f"حساب غير معروف: {transaction_data['account']}"
+            else:
+                # مكررة في السجل، أو في نفس الدفعة (نفس الرسالة أو معاملة بنفس البصمة من رسالة أخرى)
+                row = result['row']
+                message_fingerprint = message_hash(message)
+                fingerprint = transaction_fingerprint(row['المبلغ'], row['التاريخ'], row['الحساب'], row.get('الوصف', ''))
+                result['duplicate'] = find_duplicate(row, message) or (
+                    "مكررة في نفس الدفعة"
+                    if message_fingerprint in seen_messages or fingerprint in seen_fingerprints else None)
+                seen_messages.add(message_fingerprint)
+                if not result['duplicate']:
+                    seen_fingerprints.add(fingerprint)
+        results.append(result)
+    return results
+
+def _format_bulk_row(number, result, accepted):
+    """سطر مختصر لرسالة واحدة في ملخص الاستيراد"""
+    from html import escape
+    
+    row = result['row']
+    if row is None:
+        preview = result['message'].replace('\n', ' ')[:40]
+        return f"<code>{number:>3}</code> ❓ {result['reason']} | {escape(preview)}\n"
+    mark = "✅" if accepted else "🔁" if result['duplicate'] else "🚫"
+    account = re.sub(r'[^\w\s]', '', row['الحساب']).strip()
+    return (f"<code>{number:>3}</code> {mark} {row['التاريخ']} | {row['النوع']} {row['المبلغ']:,.2f} | "
+            f"{escape(account)} | {escape(str(row['التصنيف']))}\n")
+
+def _bulk_status(batch):
+    """عدد الرسائل المقبولة والمرفوضة وتعليمات الخطوة التالية"""
+    accepted = len(batch['accepted'])
+    rejected = len(batch['results']) - accepted
+    duplicates = sum(1 for result in batch['results'] if result['duplicate'])
+    return (f"<b>✅ مقبولة: {accepted} | ❌ مرفوضة: {rejected}</b>\n" +
+            (f"🔁 {duplicates} رسالة مكررة مستبعدة مبدئياً\n" if duplicates else "") + "\n"
+            "• <b>نعم</b> لتسجيل المقبولة دفعة واحدة\n"
+            "• <b>رفض 3 7 10-12</b> لاستبعاد رسائل\n"
+            "• <b>قبول 3</b> لإرجاع رسالة مستبعدة\n"
+            "• <b>لا</b> للإلغاء")
+
+def _parse_row_numbers(text, count):
+    """أرقام الصفوف من نص مثل «3 7 10-12» (ترقيم من 1)"""
+    numbers = set()
+    for start, end in re.findall(r'(\d+)(?:\s*-\s*(\d+))?', text):
+        start = int(start)
+        end = int(end) if end else start
+        numbers.update(n - 1 for n in range(start, end + 1) if 1 <= n <= count)
+    return numbers
+
+@restricted
+def bulk_import(update: Update, context: CallbackContext):
+    """بداية استيراد مجموعة رسائل بنك"""
+    context.user_data['bulk_messages'] = []
+    update.message.reply_text(
+        "📥 <b>استيراد رسائل البنك دفعة واحدة:</b>\n\n"
+        "الصق الرسائل (يمكن على عدة رسائل) مع سطر فارغ بين كل رسالة والتي بعدها،\n"
+        "أو أرسل ملف <b>.txt</b> أو <b>.csv</b> بالرسائل.\n\n"
+        "عند الانتهاء من اللصق أرسل: <b>تم</b>",
+        parse_mode='HTML'
+    )
+    return BULK_IMPORT
+
+@restricted
+def handle_bulk_import(update: Update, context: CallbackContext):
+    """جمع الرسائل الملصقة أو قراءة الملف ثم تحليلها كلها وعرض الملخص"""
+    try:
+        buffered = context.user_data.setdefault('bulk_messages', [])
+        document = update.message.document
+        if document:
+            content = _decode_upload(bytes(document.get_file().download_as_bytearray()))
+            if (document.file_name or '').lower().endswith('.csv'):
+                buffered.extend(read_bank_messages_csv(content))
+            else:
+                buffered.extend(split_bank_messages(content))
+        else:
+            text = update.message.text.strip()
+            if text not in ('تم', 'done'):
+                # تيليجرام يقسم اللصق الطويل إلى عدة رسائل، فنجمعها حتى «تم»
+                buffered.append(text)
+                update.message.reply_text("📥 تم الاستلام. أكمل اللصق أو أرسل «تم».")
+                return BULK_IMPORT
+            buffered = split_bank_messages('\n'.join(buffered))
+        
+        messages = buffered
+        context.user_data.pop('bulk_messages', None)
+        if not messages:
+            update.message.reply_text("❌ لم أجد أي رسائل.")
+            return ConversationHandler.END
+        
+        results = parse_bank_messages(messages, load_accounts())
+        batch = {
+            'results': results,
+            # المكررة مستبعدة مبدئياً ويمكن إرجاعها بـ «قبول»
+            'accepted': {i for i, result in enumerate(results)
+                         if result['row'] is not None and not result['duplicate']},
+        }
+        context.user_data['bulk_import'] = batch
+        
+        summary = (f"<b>📥 ملخص الاستيراد ({len(results)} رسالة)</b>\n" +
+                   "".join(_format_bulk_row(i + 1, result, i in batch['accepted'])
+                           for i, result in enumerate(results)) +
+                   "\n" + _bulk_status(batch))
+        for part in iter_message_parts([summary]):
+            update.message.reply_text(part, parse_mode='HTML')
+        return BULK_IMPORT_CONFIRM
+    
+    except Exception as e:
+        update.message.reply_text(f"❌ حدث خطأ: {str(e)}")
+        return ConversationHandler.END
+
+@restricted
+def handle_bulk_import_confirmation(update: Update, context: CallbackContext):
+    """قبول أو رفض رسائل من الدفعة ثم تسجيل المقبولة بكتابة واحدة"""
+    try:
+        batch = context.user_data.get('bulk_import')
+        if not batch:
+            update.message.reply_text("❌ لا توجد دفعة معلقة!")
+            return ConversationHandler.END
+        
+        text = update.message.text.strip()
+        command = text.split()[0].lower() if text else ''
+        results = batch['results']
+        
+        if command in ('رفض', 'reject', 'قبول', 'accept'):
+            numbers = _parse_row_numbers(text, len(results))
+            if command in ('رفض', 'reject'):
+                batch['accepted'] -= numbers
+            else:
+                # الرسائل التي لم تُفهم أو حسابها غير معروف لا يمكن قبولها
+                batch['accepted'] |= {n for n in numbers if results[n]['row'] is not None}
+            update.message.reply_text(_bulk_status(batch), parse_mode='HTML')
+            return BULK_IMPORT_CONFIRM
+        
+        if command in ('نعم', 'yes', 'y', 'ok', 'موافق'):
+            if not batch['accepted']:
+                update.message.reply_text("❌ لا توجد رسائل مقبولة للتسجيل. أرسل «لا» للإلغاء.")
+                return BULK_IMPORT_CONFIRM
+            context.user_data.pop('bulk_import', None)
+            accepted = sorted(batch['accepted'])
+            record_transactions([results[i]['row'] for i in accepted])
+            remember_bank_messages([results[i]['message'] for i in accepted])
+            save_merchant_categories()
+            budget = calculate_budget()
+            update.message.reply_text(
+                f"<b>✅ تم تسجيل {len(accepted)} معاملة دفعة واحدة</b>\n"
+                f"<b>▪ موازنة : {budget:,.0f} ريال</b>",
+                parse_mode='HTML'
+            )
+            return ConversationHandler.END
+        
+        if command in ('لا', 'no', 'الغاء', 'إلغاء'):
+            context.user_data.pop('bulk_import', None)
+            update.message.reply_text("❌ تم إلغاء الاستيراد.")
+            return ConversationHandler.END
+        
+        update.message.reply_text(_bulk_status(batch), parse_mode='HTML')
+        return BULK_IMPORT_CONFIRM
+    
+    except Exception as e:
+        update.message.reply_text(f"❌ حدث خطأ: {str(e)}")
+        return ConversationHandler.END
+
 @restricted
 def handle_add_expense(update: Update, context: CallbackContext):
     try:
@@ -646,12 +2749,12 @@ def handle_add_expense(update: Update, context: CallbackContext):
         # الحصول على الوصف إذا كان موجوداً
         description = data[3].strip() if len(data) > 3 else ''
         
-        accounts, transactions, transfers = load_data()
+        accounts = load_accounts()
         
         # البحث عن اسم الحساب باستخدام الدالة الجديدة
         account_name = get_account_name(account_input, accounts)
         if not account_name:
-            update.message.reply_text("❌ الحساب غير موجود!")
+            update.message.reply_text(account_not_found_message(account_input, accounts))
             return ConversationHandler.END
         
         # تحديث رصيد الحساب
@@ -668,9 +2771,7 @@ def handle_add_expense(update: Update, context: CallbackContext):
             'التصنيف': category,
             'الوصف': description  # إضافة الوصف
         }
-        transactions = pd.concat([transactions, pd.DataFrame([new_transaction])], ignore_index=True)
-        
-        save_data(accounts, transactions, transfers)
+        record_transaction(new_transaction)
         
         # حساب الموازنة
         budget = calculate_budget()
@@ -693,6 +2794,8 @@ def handle_add_expense(update: Update, context: CallbackContext):
             f"<b>▪ {cleaned_account_name}: {new_balance:,.1f} ريال</b>\n"
             f"<b>▪ موازنة : {budget:,.0f} ريال</b>"
         )
+        for alert in budget_alerts(category, account_name):
+            message += f"\n{alert}"
         update.message.reply_text(message, parse_mode='HTML')
     except ValueError:
         update.message.reply_text("❌ المبلغ يجب أن يكون رقماً!")
@@ -712,12 +2815,12 @@ def handle_add_income(update: Update, context: CallbackContext):
         amount = float(data[1].strip())
         account_input = data[2].strip()
         
-        accounts, transactions, transfers = load_data()
+        accounts = load_accounts()
         
         # البحث عن اسم الحساب باستخدام الدالة الجديدة
         account_name = get_account_name(account_input, accounts)
         if not account_name:
-            update.message.reply_text("❌ الحساب غير موجود!")
+            update.message.reply_text(account_not_found_message(account_input, accounts))
             return ConversationHandler.END
         
         # تحديث رصيد الحساب
@@ -733,9 +2836,7 @@ def handle_add_income(update: Update, context: CallbackContext):
             'الحساب': account_name,
             'التصنيف': source
         }
-        transactions = pd.concat([transactions, pd.DataFrame([new_transaction])], ignore_index=True)
-        
-        save_data(accounts, transactions, transfers)
+        record_transaction(new_transaction)
         
         # حساب الموازنة
         budget = calculate_budget()
@@ -792,14 +2893,16 @@ def handle_transfer(update: Update, context: CallbackContext):
         to_acc_input = data[1].strip()
         amount = float(data[2].strip())
         
-        accounts, transactions, transfers = load_data()
+        accounts = load_accounts()
         
         # البحث عن أسماء الحسابات
         from_acc = get_account_name(from_acc_input, accounts)
         to_acc = get_account_name(to_acc_input, accounts)
         
         if not from_acc or not to_acc:
-            update.message.reply_text("❌ أحد الحسابات غير موجود!")
+            # تحديد الحساب الذي لم يُعرف (غير موجود أو يطابق أكثر من حساب)
+            missing_input = to_acc_input if from_acc else from_acc_input
+            update.message.reply_text(account_not_found_message(missing_input, accounts))
             return ConversationHandler.END
         
         # الحصول على معلومات الحساب المصدر
@@ -830,15 +2933,12 @@ def handle_transfer(update: Update, context: CallbackContext):
             context.user_data['pending_transfer'] = {
                 'from_acc': from_acc,
                 'to_acc': to_acc,
-                'amount': amount,
-                'accounts': accounts,
-                'transactions': transactions,
-                'transfers': transfers
+                'amount': amount
             }
             return TRANSFER_CONFIRM  # حالة جديدة للموافقة
         
         # إذا كان الرصيد كافي، تنفيذ التحويل مباشرة
-        return execute_transfer(update, from_acc, to_acc, amount, accounts, transactions, transfers)
+        return execute_transfer(update, from_acc, to_acc, amount)
         
     except ValueError:
         update.message.reply_text("❌ المبلغ يجب أن يكون رقماً!")
@@ -856,7 +2956,10 @@ def escape_markdown_v2(text):
 
 
 # دالة تنفيذ التحويل
-def execute_transfer(update, from_acc, to_acc, amount, accounts, transactions, transfers):
+def execute_transfer(update, from_acc, to_acc, amount):
+    # قراءة الأرصدة الحالية من الكاش (قد تكون تغيرت أثناء انتظار الموافقة)
+    accounts = load_accounts()
+    
     # تحديث الرصيد
     from_index = accounts[accounts['اسم الحساب'] == from_acc].index
     to_index = accounts[accounts['اسم الحساب'] == to_acc].index
@@ -871,9 +2974,7 @@ def execute_transfer(update, from_acc, to_acc, amount, accounts, transactions, t
         'إلى حساب': to_acc,
         'المبلغ': amount
     }
-    transfers = pd.concat([transfers, pd.DataFrame([new_transfer])], ignore_index=True)
-    
-    save_data(accounts, transactions, transfers)
+    record_transfer(new_transfer)
     
     # الحصول على الرصيد الجديد لكلا الحسابين
     from_balance = accounts.at[from_index[0], 'الرصيد']
@@ -911,15 +3012,44 @@ def handle_transfer_confirm(update: Update, context: CallbackContext):
             update,
             transfer_data['from_acc'],
             transfer_data['to_acc'],
-            transfer_data['amount'],
-            transfer_data['accounts'],
-            transfer_data['transactions'],
-            transfer_data['transfers']
+            transfer_data['amount']
         )
     else:
         update.message.reply_text("❌ تم إلغاء التحويل.")
         return ConversationHandler.END
 
+@restricted
+def show_cache_stats(update: Update, context: CallbackContext):
+    stats = get_ledger_cache_stats()
+    update.message.reply_text(
+        "🗄 إحصائيات كاش البيانات:\n\n"
+        f"✅ إصابات: {stats['hits']}\n"
+        f"❌ إخفاقات (قراءة من الملف): {stats['misses']}\n"
+        f"📈 نسبة الإصابة: {stats['hit_rate']:.0%}\n"
+        f"🔢 نسخة البيانات: {stats['version']}\n"
+        f"📝 عمليات معلقة في السجل: {stats['journal_pending']}"
+    )
+
+@restricted
+def compact_now(update: Update, context: CallbackContext):
+    merged = compact_journal()
+    save_merchant_categories()
+    if merged:
+        update.message.reply_text(f"🗜 تم دمج {merged} عملية في ملف Excel")
+    else:
+        update.message.reply_text("✅ لا توجد عمليات معلقة، ملف Excel محدّث")
+
+@restricted
+def export_excel(update: Update, context: CallbackContext):
+    """إرسال نسخة Excel من البيانات الحالية"""
+    from io import BytesIO
+    
+    excel_file = BytesIO()
+    export_to_excel(excel_file)
+    excel_file.seek(0)
+    excel_file.name = f"financial_tracker_{datetime.now().strftime('%Y-%m-%d')}.xlsx"
+    update.message.reply_document(document=excel_file, caption="📤 نسخة Excel من بياناتك")
+
 @restricted
 def cancel(update: Update, context: CallbackContext):
     update.message.reply_text("❌ تم الإلغاء.")
@@ -932,6 +3062,8 @@ def handle_message(update: Update, context: CallbackContext):
         show_accounts(update, context)
     elif text == '📈 عرض المصروفات':
         show_expenses(update, context)
+    elif text == '📊 تقارير':
+        show_reports(update, context)
     elif text == '🏦 إضافة حساب جديد':
         add_new_account(update, context)
     elif text == '📋 كشف حساب':
@@ -1010,7 +3142,7 @@ def handle_new_account(update: Update, context: CallbackContext):
 
 @restricted
 def account_statement_balance(update: Update, context: CallbackContext):
-    accounts, _, _ = load_data()
+    accounts = load_accounts()
     
     # جلب الحسابات بدون الإيموجي
     accounts_list = get_accounts_without_emoji(accounts)
@@ -1028,7 +3160,7 @@ def account_statement_balance(update: Update, context: CallbackContext):
 
 @restricted
 def account_statement(update: Update, context: CallbackContext):
-    accounts, _, _ = load_data()
+    accounts = load_accounts()
     
     # جلب الحسابات بدون الإيموجي
     accounts_list = get_accounts_without_emoji(accounts)
@@ -1044,60 +3176,204 @@ def account_statement(update: Update, context: CallbackContext):
     )
     return CATEGORY
 
+# علامات HTML في رسائل تيليجرام: <b> و </b> و <code> ...
+_HTML_TAG_PATTERN = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^>]*>')
+
+def _closing_tags(open_tags):
+    """علامات الإغلاق للعلامات المفتوحة (من الداخل للخارج)"""
+    return ''.join(f"</{name}>" for name, _ in reversed(open_tags))
+
+def _apply_html_tags(open_tags, text):
+    """قائمة العلامات المفتوحة بعد النص (بدون تعديل القائمة الأصلية)"""
+    open_tags = list(open_tags)
+    for match in _HTML_TAG_PATTERN.finditer(text):
+        name = match.group(2).lower()
+        if not match.group(1):
+            open_tags.append((name, match.group(0)))
+        elif open_tags and open_tags[-1][0] == name:
+            open_tags.pop()
+    return open_tags
+
+def _split_text(text, size):
+    """أخذ أول size حرف من النص بدون قطع كيان HTML مثل &amp;"""
+    piece = text[:size]
+    entity_start = piece.rfind('&')
+    if entity_start > 0 and ';' not in piece[entity_start:] and ';' in text[entity_start:entity_start + 10]:
+        piece = piece[:entity_start]
+    return piece
+
+def _iter_lines(pieces):
+    """تحويل أجزاء نصية متتالية إلى أسطر كاملة (السطر الناقص ينتظر الجزء التالي)"""
+    pending = ''
+    for piece in pieces:
+        lines = (pending + piece).splitlines(keepends=True)
+        pending = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        yield from lines
+    if pending:
+        yield pending
+
+def iter_message_parts(pieces, max_length=4000):
+    """
+    تجميع نص HTML (يصل على دفعات) في رسائل لا تتجاوز max_length
+    
+    كل رسالة تُرجع بمجرد امتلائها، والتقسيم عند حدود الأسطر: العلامات المفتوحة
+    عند نهاية الرسالة تُغلق فيها ويُعاد فتحها في بداية الرسالة التالية
+    """
+    open_tags = []  # (اسم العلامة، علامة الفتح كاملة)
+    chunk = []
+    chunk_length = 0
+    has_content = False
+    
+    def fits(piece, tags_after):
+        return chunk_length + len(piece) + len(_closing_tags(tags_after)) <= max_length
+    
+    def add(piece, tags_after):
+        nonlocal chunk_length, has_content, open_tags
+        chunk.append(piece)
+        chunk_length += len(piece)
+        has_content = True
+        open_tags = tags_after
+    
+    def flush():
+        nonlocal chunk, chunk_length, has_content
+        part = ''.join(chunk) + _closing_tags(open_tags)
+        reopen = ''.join(tag for _, tag in open_tags)
+        chunk = [reopen]
+        chunk_length = len(reopen)
+        has_content = False
+        return part
+    
+    for line in _iter_lines(pieces):
+        tags_after = _apply_html_tags(open_tags, line)
+        if has_content and not fits(line, tags_after):
+            yield flush()
+        if fits(line, tags_after):
+            add(line, tags_after)
+            continue
+        
+        # سطر أطول من الحد وحده: تقسيمه عند العلامات ثم داخل النص
+        for piece in re.split(r'(<[^>]*>)', line):
+            if not piece:
+                continue
+            if _HTML_TAG_PATTERN.fullmatch(piece):
+                tags_after = _apply_html_tags(open_tags, piece)
+                if has_content and not fits(piece, tags_after):
+                    yield flush()
+                add(piece, tags_after)
+                continue
+            while piece:
+                room = max_length - chunk_length - len(_closing_tags(open_tags))
+                if room <= 0 and has_content:
+                    yield flush()
+                    continue
+                text = _split_text(piece, max(room, 1))
+                add(text, open_tags)
+                piece = piece[len(text):]
+                if piece:
+                    yield flush()
+    
+    if has_content:
+        yield flush()
+
 def split_long_message(message, max_length=4000):
     """
-    تقسيم الرسالة الطويلة إلى أجزاء مع الحفاظ على تنسيق HTML
+    تقسيم الرسالة الطويلة إلى أجزاء عند حدود الأسطر مع الحفاظ على تنسيق HTML
     """
     if len(message) <= max_length:
         return [message]
+    return list(iter_message_parts([message], max_length))
+
+# كاش صفحات الكشوفات: كل كشف يُقسم إلى صفحات مرة واحدة ويُعرض صفحة صفحة بأزرار التنقل.
+# المفتاح (نوع الكشف، الحساب، بداية الفترة، نهايتها، نسخة البيانات) فأي تعديل ينتج كشفاً جديداً
+STATEMENT_PAGES_LIMIT = 32  # عدد الكشوفات المحفوظة
+# الكشوفات التي يتجاوز طولها المقدر هذا الحد (بالحروف) تُرسل كملف بدلاً من الصفحات
+STATEMENT_FILE_THRESHOLD = int(os.getenv("STATEMENT_FILE_THRESHOLD", "40000"))
+STATEMENT_FILE_FORMAT = os.getenv("STATEMENT_FILE_FORMAT", "xlsx").lower()  # xlsx أو csv
+_STATEMENT_PAGES = OrderedDict()  # رقم الكشف -> الصفحات
+_STATEMENT_PAGE_IDS = {}          # مفتاح الكشف -> رقم الكشف
+_STATEMENT_IDS = itertools.count(1)
+
+def _cache_statement_pages(page_key, pages):
+    """حفظ صفحات الكشف وإرجاع رقمه (يُستخدم في أزرار التنقل)"""
+    statement_id = next(_STATEMENT_IDS)
+    _STATEMENT_PAGES[statement_id] = {'key': page_key, 'pages': pages}
+    _STATEMENT_PAGE_IDS[page_key] = statement_id
+    while len(_STATEMENT_PAGES) > STATEMENT_PAGES_LIMIT:
+        _, evicted = _STATEMENT_PAGES.popitem(last=False)
+        _STATEMENT_PAGE_IDS.pop(evicted['key'], None)
+    return statement_id
+
+def _statement_page_keyboard(statement_id, page, page_count):
+    """أزرار التنقل بين صفحات الكشف (⏮ ◀ رقم الصفحة ▶ ⏭)"""
+    if page_count < 2:
+        return None
+    last = page_count - 1
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("⏮", callback_data=f"stmt:{statement_id}:0"),
+        InlineKeyboardButton("◀", callback_data=f"stmt:{statement_id}:{max(page - 1, 0)}"),
+        InlineKeyboardButton(f"{page + 1}/{page_count}", callback_data="stmt:noop"),
+        InlineKeyboardButton("▶", callback_data=f"stmt:{statement_id}:{min(page + 1, last)}"),
+        InlineKeyboardButton("⏭", callback_data=f"stmt:{statement_id}:{last}"),
+    ]])
+
+def send_cached_statement(update, page_key):
+    """إرسال الصفحة الأولى من كشف محفوظ لنفس الحساب والفترة ونسخة البيانات"""
+    statement_id = _STATEMENT_PAGE_IDS.get(page_key)
+    if statement_id is None:
+        return False
+    _STATEMENT_PAGES.move_to_end(statement_id)
+    pages = _STATEMENT_PAGES[statement_id]['pages']
+    update.message.reply_text(pages[0], parse_mode='HTML',
+                              reply_markup=_statement_page_keyboard(statement_id, 0, len(pages)))
+    return True
+
+def send_statement_pages(update, page_key, lines, account_name):
+    """
+    إرسال الكشف صفحة واحدة مع أزرار التنقل: الصفحة الأولى تُرسل بمجرد امتلائها
+    وباقي الصفحات تُحفظ في الكاش وتُعرض عند الضغط على الأزرار
+    """
+    parts = iter_message_parts(lines)
+    first_page = next(parts, None)
+    if first_page is None:
+        return
+    try:
+        sent = update.message.reply_text(first_page, parse_mode='HTML')
+    except BadRequest as e:
+        if "Message is too long" in str(e):
+            send_as_file(update, first_page + ''.join(parts), account_name)
+            return
+        raise e
     
-    parts = []
-    current_part = ""
-    open_tags = []
-    
-    i = 0
-    while i < len(message):
-        # إذا وجدنا علامة افتتاح
-        if message[i] == '<' and i + 1 < len(message) and message[i + 1] != '/':
-            tag_end = message.find('>', i)
-            if tag_end != -1:
-                tag = message[i:tag_end + 1]
-                if not tag.startswith('</'):
-                    open_tags.append(tag)
-                current_part += tag
-                i = tag_end + 1
-                continue
-        
-        # إذا وجدنا علامة إغلاق
-        elif message[i] == '<' and i + 1 < len(message) and message[i + 1] == '/':
-            tag_end = message.find('>', i)
-            if tag_end != -1 and open_tags:
-                open_tags.pop()
-                current_part += message[i:tag_end + 1]
-                i = tag_end + 1
-                continue
-        
-        current_part += message[i]
-        i += 1
-        
-        # إذا وصلنا إلى الحد الأقصى، ننشئ جزء جديد
-        if len(current_part) >= max_length:
-            # نغلق جميع العلامات المفتوحة
-            temp_part = current_part
-            for tag in reversed(open_tags):
-                closing_tag = tag.replace('<', '</').replace(' ', '>').split('>')[0] + '>'
-                temp_part += closing_tag
-            
-            parts.append(temp_part)
-            current_part = ""
-            # نعيد فتح العلامات للجزء التالي
-            for tag in open_tags:
-                current_part += tag
+    pages = [first_page, *parts]
+    statement_id = _cache_statement_pages(page_key, pages)
+    if len(pages) > 1:
+        sent.edit_reply_markup(reply_markup=_statement_page_keyboard(statement_id, 0, len(pages)))
+
+@restricted
+def handle_statement_page(update: Update, context: CallbackContext):
+    """التنقل بين صفحات الكشف من الكاش بدون إعادة تحميل البيانات"""
+    query = update.callback_query
+    if query.data == "stmt:noop":
+        query.answer()
+        return
     
-    if current_part:
-        parts.append(current_part)
+    _, statement_id, page = query.data.split(':')
+    entry = _STATEMENT_PAGES.get(int(statement_id))
+    if entry is None:
+        query.answer("⌛ انتهت صلاحية هذا الكشف، اطلبه من جديد")
+        return
     
-    return parts
+    _STATEMENT_PAGES.move_to_end(int(statement_id))
+    pages = entry['pages']
+    page = int(page)
+    query.answer()
+    try:
+        query.edit_message_text(pages[page], parse_mode='HTML',
+                                reply_markup=_statement_page_keyboard(int(statement_id), page, len(pages)))
+    except BadRequest as e:
+        # الضغط على زر الصفحة الحالية (مثل ⏮ في الصفحة الأولى)
+        if "not modified" not in str(e):
+            raise e
 
 # ثانياً: الدالة المعدلة handle_dated_statement
 @restricted
@@ -1154,12 +3430,12 @@ def handle_dated_statement(update: Update, context: CallbackContext):
 def process_dated_statement_request(update: Update, context: CallbackContext, account_input: str, date_input: str):
     """Processes the complete dated statement request."""
     try:
-        # Load data and find account
-        accounts, transactions, transfers = load_data()
+        # Load accounts and find account
+        accounts = load_accounts()
         account_name = get_account_name(account_input, accounts)
         
         if not account_name:
-            update.message.reply_text("❌ الحساب غير موجود!")
+            update.message.reply_text(account_not_found_message(account_input, accounts))
             return ConversationHandler.END
 
         # Parse dates if provided
@@ -1183,6 +3459,11 @@ def process_dated_statement_request(update: Update, context: CallbackContext, ac
         # تنظيف اسم الحساب من الإيموجي للعرض
         cleaned_account_name = re.sub(r'[^\w\s]', '', account_name).strip()
         
+        # نفس الكشف محفوظ من طلب سابق ولم تتغير البيانات بعده
+        page_key = ('dated', account_name, start_date, end_date, get_ledger_version())
+        if send_cached_statement(update, page_key):
+            return ConversationHandler.END
+        
         # الحصول على معلومات الحساب
         account_info = accounts[accounts['اسم الحساب'] == account_name].iloc[0]
         current_balance = account_info['الرصيد']
@@ -1191,261 +3472,154 @@ def process_dated_statement_request(update: Update, context: CallbackContext, ac
         # تحديد إذا كان نوع الحساب يحتاج إلى عكس الألوان
         reverse_colors = account_type in ['بطاقة ائتمان', 'دين']
         
-        # حساب الرصيد الافتتاحي الصحيح
-        def calculate_opening_balance(account_name, transactions, transfers):
-            """حساب الرصيد الافتتاحي الصحيح للحساب"""
-            # جميع معاملات الحساب
-            account_transactions = transactions[transactions['الحساب'] == account_name]
-            outgoing_transfers = transfers[transfers['من حساب'] == account_name]
-            incoming_transfers = transfers[transfers['إلى حساب'] == account_name]
-            
-            # حساب الإجماليات
-            total_income = account_transactions[account_transactions['النوع'] == 'دخل']['المبلغ'].sum()
-            total_expenses = account_transactions[account_transactions['النوع'] == 'مصروف']['المبلغ'].sum()
-            total_incoming = incoming_transfers['المبلغ'].sum()
-            total_outgoing = outgoing_transfers['المبلغ'].sum()
-            
-            # الرصيد الافتتاحي = الرصيد الحالي + المصروفات - الدخل + التحويلات الصادرة - التحويلات الواردة
-            opening_balance = current_balance + total_expenses - total_income + total_outgoing - total_incoming
-            
-            return opening_balance
-        
-        # حساب الرصيد الافتتاحي الصحيح
-        opening_balance = calculate_opening_balance(account_name, transactions, transfers)
+        # جدول العمليات المرتب من فهرس الأرصدة
+        statement = get_account_index(account_name)
+        operations = statement['frame']
+        opening_balance = statement['opening']
         
         # حساب الرصيد المدور للفترة المحددة
         rolled_balance = opening_balance
         rolled_balance_date = None
         
+        # الجدول مرتب بالتاريخ، فحدود الفترة تُحدد بالبحث الثنائي
+        days = operations['day'].to_numpy()
+        before_count = int(np.searchsorted(days, np.datetime64(start_date, 'ns'), side='left')) if start_date else 0
         if start_date:
-            # جميع العمليات قبل تاريخ البداية
-            transactions_before = transactions[
-                (transactions['الحساب'] == account_name) & 
-                (transactions['التاريخ'] < start_date)
-            ]
-            transfers_out_before = transfers[
-                (transfers['من حساب'] == account_name) & 
-                (transfers['التاريخ'] < start_date)
-            ]
-            transfers_in_before = transfers[
-                (transfers['إلى حساب'] == account_name) & 
-                (transfers['التاريخ'] < start_date)
-            ]
-            
-            # حساب الرصيد المدور
-            total_income_before = transactions_before[transactions_before['النوع'] == 'دخل']['المبلغ'].sum()
-            total_expenses_before = transactions_before[transactions_before['النوع'] == 'مصروف']['المبلغ'].sum()
-            total_incoming_before = transfers_in_before['المبلغ'].sum()
-            total_outgoing_before = transfers_out_before['المبلغ'].sum()
-            
-            rolled_balance = opening_balance + total_income_before - total_expenses_before + total_incoming_before - total_outgoing_before
-            
-            # الحصول على آخر تاريخ قبل الفترة المحددة
-            all_before_dates = []
-            if not transactions_before.empty:
-                all_before_dates.extend(transactions_before['التاريخ'].tolist())
-            if not transfers_out_before.empty:
-                all_before_dates.extend(transfers_out_before['التاريخ'].tolist())
-            if not transfers_in_before.empty:
-                all_before_dates.extend(transfers_in_before['التاريخ'].tolist())
-            
-            if all_before_dates:
-                rolled_balance_date = max(all_before_dates)
+            # الرصيد المدور = نقطة نهاية الشهر السابق + عمليات الشهر قبل بداية الفترة
+            if before_count:
+                rolled_balance = balance_before(account_name, start_date)
+                # آخر تاريخ قبل الفترة المحددة
+                rolled_balance_date = operations['date'].iat[before_count - 1]
             else:
                 rolled_balance_date = "2025-08-01"
 
-        # تصفية المعاملات والتحويلات بناء على النطاق التاريخي
+        # تصفية العمليات بناء على النطاق التاريخي
         if start_date and end_date:
-            account_transactions = transactions[
-                (transactions['الحساب'] == account_name) & 
-                (transactions['التاريخ'] >= start_date) & 
-                (transactions['التاريخ'] <= end_date)
-            ]
-            outgoing_transfers = transfers[
-                (transfers['من حساب'] == account_name) & 
-                (transfers['التاريخ'] >= start_date) & 
-                (transfers['التاريخ'] <= end_date)
-            ]
-            incoming_transfers = transfers[
-                (transfers['إلى حساب'] == account_name) & 
-                (transfers['التاريخ'] >= start_date) & 
-                (transfers['التاريخ'] <= end_date)
-            ]
+            period_end = int(np.searchsorted(days, np.datetime64(end_date, 'ns'), side='right'))
         else:
-            # إذا لم يتم تحديد تواريخ، نستخدم كل البيانات
-            account_transactions = transactions[transactions['الحساب'] == account_name]
-            outgoing_transfers = transfers[transfers['من حساب'] == account_name]
-            incoming_transfers = transfers[transfers['إلى حساب'] == account_name]
+            period_end = len(operations)
+        period_operations = operations.iloc[before_count:period_end]
+        
+        # الأرصدة الجارية في الفترة تبدأ من الرصيد المدور
+        signed_amounts = np.where(period_operations['is_income'], period_operations['amount'], -period_operations['amount'])
+        period_balances = np.cumsum(np.concatenate(([rolled_balance], signed_amounts)))[1:]
 
         # حساب إجماليات الفترة المحددة
-        total_income_period = account_transactions[account_transactions['النوع'] == 'دخل']['المبلغ'].sum()
-        total_expenses_period = account_transactions[account_transactions['النوع'] == 'مصروف']['المبلغ'].sum()
-        total_incoming_period = incoming_transfers['المبلغ'].sum()
-        total_outgoing_period = outgoing_transfers['المبلغ'].sum()
+        period_totals = period_operations.groupby('type')['amount'].sum()
+        total_income_period = period_totals.get('دخل', 0)
+        total_expenses_period = period_totals.get('مصروف', 0)
+        total_incoming_period = period_totals.get('تحويل وارد', 0)
+        total_outgoing_period = period_totals.get('تحويل صادر', 0)
+
+        # الكشف الكبير يُرسل كملف مباشرة بدلاً من عشرات الصفحات
+        if estimate_statement_size(period_operations) > STATEMENT_FILE_THRESHOLD:
+            opening_label = "الرصيد المدور" if start_date else "الرصيد الافتتاحي"
+            final_balance = period_balances[-1] if len(period_balances) else rolled_balance
+            caption = (f"📊 كشف بالتاريخ: {cleaned_account_name}\n"
+                       f"{opening_label}: {rolled_balance:,.0f} ريال\n"
+                       f"إجمالي مدين: +{total_income_period + total_incoming_period:,.0f} ريال\n"
+                       f"إجمالي دائن : -{total_expenses_period + total_outgoing_period:,.0f} ريال\n"
+                       f"💰 الرصيد الختامي: {final_balance:,.0f} ريال")
+            send_statement_file(update, cleaned_account_name, caption,
+                                statement_file_rows(period_operations, period_balances, opening_label, rolled_balance))
+            return ConversationHandler.END
 
         # إنشاء تقرير منظم بالشكل الجديد
-        message = f"<b>📊 كشف بالتاريخ: {cleaned_account_name}</b>\n"
-        
-        # إضافة النطاق التاريخي إذا كان محدداً
-        if start_date and end_date:
-            start_formatted = datetime.strptime(start_date, '%Y-%m-%d').strftime('%d-%m-%Y')
-            end_formatted = datetime.strptime(end_date, '%Y-%m-%d').strftime('%d-%m-%Y')
-            message += f"<b>📅 الفترة: من {start_formatted} إلى {end_formatted}</b>\n"
-        else:
-            message += f"<b>📅 التاريخ: {datetime.now().strftime('%d-%m-%Y')} (كشف كامل)</b>\n"
-        
-        message += "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n\n"
-        
-        # عرض الرصيد المدور أو الافتتاحي بناءً على النوع
-        if start_date:
-            message += f"<b>💰 الرصيد المدور: {rolled_balance:,.0f} ريال</b>\n\n"
-        else:
-            message += f"<b>💰 الرصيد الافتتاحي: {opening_balance:,.0f} ريال</b>\n\n"
-        
-        message += "<b>💳 العمليات</b>\n"
-        message += "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
-        
-        # دمج المعاملات والتحويلات في قائمة واحدة مرتبة حسب التاريخ
-        all_operations = []
-        
-        # 🔽 معالجة آمنة للمعاملات
-        for _, transaction in account_transactions.iterrows():
-            # معالجة تنسيق التاريخ بشكل آمن
-            raw_date = str(transaction['التاريخ'])
-            formatted_date = safe_date_format(raw_date)
+        def render_lines():
+            """أسطر الكشف بالتاريخ بالترتيب"""
+            yield f"<b>📊 كشف بالتاريخ: {cleaned_account_name}</b>\n"
             
-            operation = {
-                'date': raw_date,  # حفظ التاريخ الأصلي للترتيب
-                'display_date': formatted_date,  # التاريخ المنسق للعرض
-                'description': transaction['التصنيف'],
-                'amount': transaction['المبلغ'],
-                'type': transaction['النوع'],
-                'operation_type': 'معاملة',
-                'is_income': transaction['النوع'] == 'دخل'
-            }
-            all_operations.append(operation)
-        
-        # 🔽 معالجة آمنة للتحويلات الصادرة
-        for _, transfer in outgoing_transfers.iterrows():
-            to_acc_clean = re.sub(r'[^\w\s]', '', transfer['إلى حساب']).strip()
-            raw_date = str(transfer['التاريخ'])
-            formatted_date = safe_date_format(raw_date)
+            # إضافة النطاق التاريخي إذا كان محدداً
+            if start_date and end_date:
+                start_formatted = datetime.strptime(start_date, '%Y-%m-%d').strftime('%d-%m-%Y')
+                end_formatted = datetime.strptime(end_date, '%Y-%m-%d').strftime('%d-%m-%Y')
+                yield f"<b>📅 الفترة: من {start_formatted} إلى {end_formatted}</b>\n"
+            else:
+                yield f"<b>📅 التاريخ: {datetime.now().strftime('%d-%m-%Y')} (كشف كامل)</b>\n"
             
-            operation = {
-                'date': raw_date,
-                'display_date': formatted_date,
-                'description': f"تحويل إلى {to_acc_clean}",
-                'amount': transfer['المبلغ'],
-                'type': 'تحويل صادر',
-                'operation_type': 'تحويل',
-                'is_income': False
-            }
-            all_operations.append(operation)
-        
-        # 🔽 معالجة آمنة للتحويلات الواردة
-        for _, transfer in incoming_transfers.iterrows():
-            from_acc_clean = re.sub(r'[^\w\s]', '', transfer['من حساب']).strip()
-            raw_date = str(transfer['التاريخ'])
-            formatted_date = safe_date_format(raw_date)
+            yield "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n\n"
             
-            operation = {
-                'date': raw_date,
-                'display_date': formatted_date,
-                'description': f"تحويل من {from_acc_clean}",
-                'amount': transfer['المبلغ'],
-                'type': 'تحويل وارد',
-                'operation_type': 'تحويل',
-                'is_income': True
-            }
-            all_operations.append(operation)
-        
-        # بدء الرصيد الجاري من الرصيد الصحيح
-        if start_date:
-            running_balance = rolled_balance
-        else:
-            running_balance = opening_balance
-        
-        # عرض الرصيد الافتتاحي أو المدور كأول عملية
-        if start_date and rolled_balance_date:
-            # 🔽 معالجة آمنة لتاريخ الرصيد المدور
-            rolled_date_formatted = safe_date_format(rolled_balance_date)
-            
-            # تطبيق عكس الألوان للرصيد المدور
-            if reverse_colors:
-                emoji_color = "📕" if running_balance >= 0 else "📗"
+            # عرض الرصيد المدور أو الافتتاحي بناءً على النوع
+            if start_date:
+                yield f"<b>💰 الرصيد المدور: {rolled_balance:,.0f} ريال</b>\n\n"
             else:
-                emoji_color = "📗" if running_balance >= 0 else "📕"
-                
-            message += f"<b> 📆 {rolled_date_formatted} || الرصيد المدور حتى</b>\n"
-            message += f"<b> ▪  {running_balance:,.0f} ريال ||  الرصيد {running_balance:,.0f} ريال {emoji_color}</b>\n\n"
-        else:
-            # للكشف الكامل، نعرض الرصيد الافتتاحي
-            opening_date = "01-08-2025"
-            if reverse_colors:
-                emoji_color = "📕" if running_balance >= 0 else "📗"
+                yield f"<b>💰 الرصيد الافتتاحي: {opening_balance:,.0f} ريال</b>\n\n"
+            
+            yield "<b>💳 العمليات</b>\n"
+            yield "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
+            
+            # بدء الرصيد الجاري من الرصيد الصحيح
+            if start_date:
+                running_balance = rolled_balance
             else:
-                emoji_color = "📗" if running_balance >= 0 else "📕"
-                
-            message += f"<b> 📆 {opening_date} || الرصيد الافتتاحي</b>\n"
-            message += f"<b> ▪  {running_balance:,.0f} ريال ||  الرصيد {running_balance:,.0f} ريال {emoji_color}</b>\n\n"
-        
-        # ترتيب العمليات حسب التاريخ (باستخدام التاريخ الأصلي)
-        all_operations.sort(key=lambda x: x['date'])
-        
-        # عرض العمليات مع الرصيد
-        for operation in all_operations:
-            op_date = operation['display_date']
+                running_balance = opening_balance
+            
+            # عرض الرصيد الافتتاحي أو المدور كأول عملية
+            if start_date and rolled_balance_date:
+                # 🔽 معالجة آمنة لتاريخ الرصيد المدور
+                rolled_date_formatted = safe_date_format(rolled_balance_date)
             
-            if operation['is_income']:
-                running_balance += operation['amount']
-                amount_display = f"+{operation['amount']:,.0f}"
+                # تطبيق عكس الألوان للرصيد المدور
+                if reverse_colors:
+                    emoji_color = "📕" if running_balance >= 0 else "📗"
+                else:
+                    emoji_color = "📗" if running_balance >= 0 else "📕"
+            
+                yield f"<b> 📆 {rolled_date_formatted} || الرصيد المدور حتى</b>\n"
+                yield f"<b> ▪  {running_balance:,.0f} ريال ||  الرصيد {running_balance:,.0f} ريال {emoji_color}</b>\n\n"
             else:
-                running_balance -= operation['amount']
-                amount_display = f"-{operation['amount']:,.0f}"
+                # للكشف الكامل، نعرض الرصيد الافتتاحي
+                opening_date = "01-08-2025"
+                if reverse_colors:
+                    emoji_color = "📕" if running_balance >= 0 else "📗"
+                else:
+                    emoji_color = "📗" if running_balance >= 0 else "📕"
+            
+                yield f"<b> 📆 {opening_date} || الرصيد الافتتاحي</b>\n"
+                yield f"<b> ▪  {running_balance:,.0f} ريال ||  الرصيد {running_balance:,.0f} ريال {emoji_color}</b>\n\n"
             
-            # تطبيق عكس الألوان لكل عملية
+            # عرض العمليات مع الرصيد
+            for op_date, description, amount, is_income, running_balance in zip(
+                    period_operations['shown'], period_operations['description'], period_operations['amount'],
+                    period_operations['is_income'], period_balances):
+            
+                if is_income:
+                    amount_display = f"+{amount:,.0f}"
+                else:
+                    amount_display = f"-{amount:,.0f}"
+            
+                # تطبيق عكس الألوان لكل عملية
+                if reverse_colors:
+                    emoji_color = "📕" if running_balance >= 0 else "📗"
+                else:
+                    emoji_color = "📗" if running_balance >= 0 else "📕"
+            
+                yield f"<b> 📆 {op_date} || {description}</b>\n"
+                yield f"<b> ▪  {amount_display} ريال ||   الرصيد :  {running_balance:,.0f} ريال {emoji_color}</b>\n\n"
+            
+            # تطبيق عكس الألوان للرصيد الختامي
+            final_balance = running_balance
             if reverse_colors:
-                emoji_color = "📕" if running_balance >= 0 else "📗"
+                final_emoji = "📕" if final_balance >= 0 else "📗"
             else:
-                emoji_color = "📗" if running_balance >= 0 else "📕"
+                final_emoji = "📗" if final_balance >= 0 else "📕"
             
-            message += f"<b> 📆 {op_date} || {operation['description']}</b>\n"
-            message += f"<b> ▪  {amount_display} ريال ||   الرصيد :  {running_balance:,.0f} ريال {emoji_color}</b>\n\n"
-        
-        # تطبيق عكس الألوان للرصيد الختامي
-        final_balance = running_balance
-        if reverse_colors:
-            final_emoji = "📕" if final_balance >= 0 else "📗"
-        else:
-            final_emoji = "📗" if final_balance >= 0 else "📕"
+            # الملخص المالي
+            yield "<b>🧮 الملخص المالي</b>\n"
+            yield "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
             
-        # الملخص المالي
-        message += "<b>🧮 الملخص المالي</b>\n"
-        message += "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
-        
-        if start_date:
-            message += f"<b>الرصيد المدور: {rolled_balance:,.0f} ريال</b>\n"
-        else:
-            message += f"<b>الرصيد الافتتاحي: {opening_balance:,.0f} ريال</b>\n"
+            if start_date:
+                yield f"<b>الرصيد المدور: {rolled_balance:,.0f} ريال</b>\n"
+            else:
+                yield f"<b>الرصيد الافتتاحي: {opening_balance:,.0f} ريال</b>\n"
             
-        message += f"<b>إجمالي مدين: +{total_income_period + total_incoming_period:,.0f} ريال</b>\n"
-        message += f"<b>إجمالي دائن : -{total_expenses_period + total_outgoing_period:,.0f} ريال</b>\n"
-        message += "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
-        message += f"<b>💰 الرصيد الختامي: {final_balance:,.0f} ريال {final_emoji}</b>"
+            yield f"<b>إجمالي مدين: +{total_income_period + total_incoming_period:,.0f} ريال</b>\n"
+            yield f"<b>إجمالي دائن : -{total_expenses_period + total_outgoing_period:,.0f} ريال</b>\n"
+            yield "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
+            yield f"<b>💰 الرصيد الختامي: {final_balance:,.0f} ريال {final_emoji}</b>"
         
-        # إرسال الرسالة مع معالجة الطول الزائد
-        message_parts = split_long_message(message)
-        
-        for i, part in enumerate(message_parts):
-            try:
-                update.message.reply_text(part, parse_mode='HTML')
-            except BadRequest as e:
-                if "Message is too long" in str(e):
-                    if i == 0:
-                        send_as_file(update, message, cleaned_account_name)
-                        break
-                else:
-                    raise e
+        # إرسال الكشف صفحة صفحة مع أزرار التنقل
+        send_statement_pages(update, page_key, render_lines(), cleaned_account_name)
                     
     except Exception as e:
         update.message.reply_text(f"❌ خطأ: {str(e)}")
@@ -1456,47 +3630,31 @@ def process_dated_statement_request(update: Update, context: CallbackContext, ac
 
 def safe_date_format(date_str):
     """تحويل التاريخ إلى تنسيق آمن DD-MM-YYYY"""
-    try:
-        # إذا كان التاريخ فارغاً
-        if not date_str or pd.isna(date_str):
-            return "01-01-2025"
-        
-        date_str = str(date_str).strip()
-        
-        # محاولة تحويل من YYYY-MM-DD
-        if re.match(r'\d{4}-\d{2}-\d{2}', date_str):
-            return datetime.strptime(date_str, '%Y-%m-%d').strftime('%d-%m-%Y')
-        
-        # محاولة تحويل من DD-MM-YYYY
-        elif re.match(r'\d{2}-\d{2}-\d{4}', date_str):
-            return date_str  # هو بالفعل بالتنسيق المطلوب
-        
-        # محاولة تحويل من DD/MM/YYYY
-        elif re.match(r'\d{2}/\d{2}/\d{4}', date_str):
-            return datetime.strptime(date_str, '%d/%m/%Y').strftime('%d-%m-%Y')
-        
-        # إذا فشلت جميع المحاولات، ارجع التاريخ كما هو
-        return date_str
-        
-    except Exception:
-        # في حالة أي خطأ، ارجع التاريخ الأصلي
-        return str(date_str)
+    # إذا كان التاريخ فارغاً
+    if date_str is None or pd.isna(date_str) or not str(date_str).strip():
+        return "01-01-2025"
+    return display_date(str(date_str).strip())
 
 @restricted
 def handle_account_statement_balance(update: Update, context: CallbackContext):
     try:
         account_input = update.message.text.strip()
-        accounts, transactions, transfers = load_data()
+        accounts = load_accounts()
         
         # البحث عن اسم الحساب
         account_name = get_account_name(account_input, accounts)
         if not account_name:
-            update.message.reply_text("❌ الحساب غير موجود!")
+            update.message.reply_text(account_not_found_message(account_input, accounts))
             return ConversationHandler.END
         
         # تنظيف اسم الحساب من الإيموجي للعرض
         cleaned_account_name = re.sub(r'[^\w\s]', '', account_name).strip()
         
+        # نفس الكشف محفوظ من طلب سابق ولم تتغير البيانات بعده
+        page_key = ('balance', account_name, None, None, get_ledger_version())
+        if send_cached_statement(update, page_key):
+            return ConversationHandler.END
+        
         # الحصول على معلومات الحساب
         account_info = accounts[accounts['اسم الحساب'] == account_name].iloc[0]
         current_balance = account_info['الرصيد']
@@ -1505,140 +3663,96 @@ def handle_account_statement_balance(update: Update, context: CallbackContext):
         # 🔽 التعديل الجديد: تحديد إذا كان نوع الحساب يحتاج إلى عكس الألوان
         reverse_colors = account_type in ['بطاقة ائتمان', 'دين']
         
-        # تصفية المعاملات والتحويلات
-        account_transactions = transactions[transactions['الحساب'] == account_name]
-        outgoing_transfers = transfers[transfers['من حساب'] == account_name]
-        incoming_transfers = transfers[transfers['إلى حساب'] == account_name]
-        
-        # حساب الرصيد الافتتاحي
-        total_income = account_transactions[account_transactions['النوع'] == 'دخل']['المبلغ'].sum()
-        total_expenses = account_transactions[account_transactions['النوع'] == 'مصروف']['المبلغ'].sum()
-        total_incoming_transfers = incoming_transfers['المبلغ'].sum()
-        total_outgoing_transfers = outgoing_transfers['المبلغ'].sum()
-        
-        opening_balance = current_balance + total_expenses - total_income + total_outgoing_transfers - total_incoming_transfers
+        # جدول العمليات المرتب مع الأرصدة الجارية من فهرس الأرصدة
+        statement = get_account_index(account_name)
+        all_operations = statement['frame']
+        
+        # الرصيد الافتتاحي والإجماليات
+        totals = statement['totals']
+        total_income = totals['دخل']
+        total_expenses = totals['مصروف']
+        total_incoming_transfers = totals['تحويل وارد']
+        total_outgoing_transfers = totals['تحويل صادر']
+        
+        opening_balance = statement['opening']
+        
+        # الكشف الكبير يُرسل كملف مباشرة بدلاً من عشرات الصفحات
+        if estimate_statement_size(all_operations) > STATEMENT_FILE_THRESHOLD:
+            caption = (f"📊 كشف حساب: {cleaned_account_name}\n"
+                       f"الرصيد الافتتاحي: {opening_balance:,.0f} ريال\n"
+                       f"إجمالي مدين: +{total_income + total_incoming_transfers:,.0f} ريال\n"
+                       f"إجمالي دائن : -{total_expenses + total_outgoing_transfers:,.0f} ريال\n"
+                       f"💰 الرصيد الختامي: {current_balance:,.0f} ريال")
+            send_statement_file(update, cleaned_account_name, caption,
+                                statement_file_rows(all_operations, all_operations['balance'], "الرصيد الافتتاحي", opening_balance))
+            return ConversationHandler.END
         
         # إنشاء تقرير منظم بالشكل الجديد
-        message = f"<b>📊 كشف حساب: {cleaned_account_name}</b>\n"
-        message += f"<b>📅 التاريخ: {datetime.now().strftime('%d-%m-%Y')}</b>\n"
-        message += "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n\n"
-        
-        message += f"<b>💰 الرصيد الافتتاحي: {opening_balance:,.0f} ريال</b>\n\n"
-        
-        message += "<b>💳 العمليات</b>\n"
-        message += "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
-        
-        # دمج المعاملات والتحويلات في قائمة واحدة مرتبة حسب التاريخ
-        all_operations = []
-        
-        # إضافة المعاملات
-        for _, transaction in account_transactions.iterrows():
-            operation = {
-                'date': transaction['التاريخ'],
-                'description': transaction['التصنيف'],
-                'amount': transaction['المبلغ'],
-                'type': transaction['النوع'],
-                'operation_type': 'معاملة',
-                'is_income': transaction['النوع'] == 'دخل'
-            }
-            all_operations.append(operation)
-        
-        # إضافة التحويلات الصادرة
-        for _, transfer in outgoing_transfers.iterrows():
-            to_acc_clean = re.sub(r'[^\w\s]', '', transfer['إلى حساب']).strip()
-            operation = {
-                'date': transfer['التاريخ'],
-                'description': f"تحويل إلى {to_acc_clean}",
-                'amount': transfer['المبلغ'],
-                'type': 'تحويل صادر',
-                'operation_type': 'تحويل',
-                'is_income': False
-            }
-            all_operations.append(operation)
-        
-        # إضافة التحويلات الواردة
-        for _, transfer in incoming_transfers.iterrows():
-            from_acc_clean = re.sub(r'[^\w\s]', '', transfer['من حساب']).strip()
-            operation = {
-                'date': transfer['التاريخ'],
-                'description': f"تحويل من {from_acc_clean}",
-                'amount': transfer['المبلغ'],
-                'type': 'تحويل وارد',
-                'operation_type': 'تحويل',
-                'is_income': True
-            }
-            all_operations.append(operation)
-        
-        # تحديد تاريخ الرصيد الافتتاحي
-        if all_operations:
-            opening_date = min([op['date'] for op in all_operations])
-            opening_date_formatted = datetime.strptime(opening_date, '%Y-%m-%d').strftime('%d-%m-%Y')
-        else:
-            opening_date_formatted = "01-08-2025"
-        
-        # نبدأ بالرصيد الافتتاحي
-        running_balance = opening_balance
-        
-        # 🔽 التعديل الجديد: تطبيق عكس الألوان للرصيد الافتتاحي
-        if reverse_colors:
-            emoji_color = "📕" if running_balance >= 0 else "📗"
-        else:
-            emoji_color = "📗" if running_balance >= 0 else "📕"
+        def render_lines():
+            """أسطر كشف الحساب بالترتيب"""
+            yield f"<b>📊 كشف حساب: {cleaned_account_name}</b>\n"
+            yield f"<b>📅 التاريخ: {datetime.now().strftime('%d-%m-%Y')}</b>\n"
+            yield "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n\n"
             
-        message += f"<b> 📆 {opening_date_formatted} || الرصيد الافتتاحي</b>\n"
-        message += f"<b> ▪  {running_balance:,.0f} ريال ||  الرصيد {running_balance:,.0f} ريال {emoji_color}</b>\n\n"
-        
-        # ترتيب العمليات حسب التاريخ
-        all_operations.sort(key=lambda x: x['date'])
-        
-        # عرض العمليات مع الرصيد
-        for operation in all_operations:
-            op_date = datetime.strptime(operation['date'], '%Y-%m-%d').strftime('%d-%m-%Y')
+            yield f"<b>💰 الرصيد الافتتاحي: {opening_balance:,.0f} ريال</b>\n\n"
             
-            if operation['is_income']:
-                running_balance += operation['amount']
-                amount_display = f"+{operation['amount']:,.0f}"
+            yield "<b>💳 العمليات</b>\n"
+            yield "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
+            
+            # تحديد تاريخ الرصيد الافتتاحي
+            if not all_operations.empty:
+                opening_date_formatted = all_operations['shown'].iat[0]
             else:
-                running_balance -= operation['amount']
-                amount_display = f"-{operation['amount']:,.0f}"
+                opening_date_formatted = "01-08-2025"
+            
+            # نبدأ بالرصيد الافتتاحي
+            running_balance = opening_balance
             
-            # 🔽 التعديل الجديد: تطبيق عكس الألوان لكل عملية
+            # 🔽 التعديل الجديد: تطبيق عكس الألوان للرصيد الافتتاحي
             if reverse_colors:
                 emoji_color = "📕" if running_balance >= 0 else "📗"
             else:
                 emoji_color = "📗" if running_balance >= 0 else "📕"
             
-            message += f"<b> 📆 {op_date} || {operation['description']}</b>\n"
-            message += f"<b> ▪  {amount_display} ريال ||   الرصيد :  {running_balance:,.0f} ريال {emoji_color}</b>\n\n"
-        
-        # 🔽 التعديل الجديد: تطبيق عكس الألوان للرصيد الختامي
-        if reverse_colors:
-            final_emoji = "📕" if current_balance >= 0 else "📗"
-        else:
-            final_emoji = "📗" if current_balance >= 0 else "📕"
+            yield f"<b> 📆 {opening_date_formatted} || الرصيد الافتتاحي</b>\n"
+            yield f"<b> ▪  {running_balance:,.0f} ريال ||  الرصيد {running_balance:,.0f} ريال {emoji_color}</b>\n\n"
             
-        # الملخص المالي
-        message += "<b>🧮 الملخص المالي</b>\n"
-        message += "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
-        message += f"<b>الرصيد الافتتاحي: {opening_balance:,.0f} ريال</b>\n"
-        message += f"<b>إجمالي مدين: +{total_income + total_incoming_transfers:,.0f} ريال</b>\n"
-        message += f"<b>إجمالي دائن : -{total_expenses + total_outgoing_transfers:,.0f} ريال</b>\n"
-        message += "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
-        message += f"<b>💰 الرصيد الختامي: {current_balance:,.0f} ريال {final_emoji}</b>"
-        
-        # 🔽 التعديل الجديد: إرسال الرسالة مع معالجة الطول الزائد
-        message_parts = split_long_message(message)
-        
-        for i, part in enumerate(message_parts):
-            try:
-                update.message.reply_text(part, parse_mode='HTML')
-            except BadRequest as e:
-                if "Message is too long" in str(e):
-                    if i == 0:  # إذا فشل الجزء الأول، نرسل كملف
-                        send_as_file(update, message, cleaned_account_name)
-                        break
+            # عرض العمليات مع الرصيد
+            for op_date, description, amount, is_income, running_balance in zip(
+                    all_operations['shown'], all_operations['description'], all_operations['amount'],
+                    all_operations['is_income'], all_operations['balance']):
+            
+                if is_income:
+                    amount_display = f"+{amount:,.0f}"
                 else:
-                    raise e
+                    amount_display = f"-{amount:,.0f}"
+            
+                # 🔽 التعديل الجديد: تطبيق عكس الألوان لكل عملية
+                if reverse_colors:
+                    emoji_color = "📕" if running_balance >= 0 else "📗"
+                else:
+                    emoji_color = "📗" if running_balance >= 0 else "📕"
+            
+                yield f"<b> 📆 {op_date} || {description}</b>\n"
+                yield f"<b> ▪  {amount_display} ريال ||   الرصيد :  {running_balance:,.0f} ريال {emoji_color}</b>\n\n"
+            
+            # 🔽 التعديل الجديد: تطبيق عكس الألوان للرصيد الختامي
+            if reverse_colors:
+                final_emoji = "📕" if current_balance >= 0 else "📗"
+            else:
+                final_emoji = "📗" if current_balance >= 0 else "📕"
+            
+            # الملخص المالي
+            yield "<b>🧮 الملخص المالي</b>\n"
+            yield "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
+            yield f"<b>الرصيد الافتتاحي: {opening_balance:,.0f} ريال</b>\n"
+            yield f"<b>إجمالي مدين: +{total_income + total_incoming_transfers:,.0f} ريال</b>\n"
+            yield f"<b>إجمالي دائن : -{total_expenses + total_outgoing_transfers:,.0f} ريال</b>\n"
+            yield "<b>⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯⎯</b>\n"
+            yield f"<b>💰 الرصيد الختامي: {current_balance:,.0f} ريال {final_emoji}</b>"
+        
+        # إرسال الكشف صفحة صفحة مع أزرار التنقل
+        send_statement_pages(update, page_key, render_lines(), cleaned_account_name)
                     
     except Exception as e:
         update.message.reply_text(f"❌ خطأ: {str(e)}")
@@ -1661,18 +3775,64 @@ def send_as_file(update, content, account_name):
         caption=f"📊 كشف حساب {account_name} (تم الإرسال كملف due to length)"
     )
 
+_STATEMENT_FILE_HEADER = ['التاريخ', 'الوصف', 'المبلغ', 'الرصيد']
+
+def estimate_statement_size(operations):
+    """تقدير طول نص الكشف بالحروف من عدد العمليات وأطوال أوصافها بدون بنائه"""
+    return int(operations['description'].astype(str).str.len().sum()) + 100 * len(operations)
+
+def statement_file_rows(operations, balances, opening_label, opening_balance):
+    """صفوف ملف الكشف: الرصيد الافتتاحي (أو المدور) ثم العمليات بمبالغ موقعة"""
+    yield ['', opening_label, '', round(float(opening_balance), 2)]
+    for op_date, description, amount, is_income, balance in zip(
+            operations['date'], operations['description'], operations['amount'],
+            operations['is_income'], balances):
+        yield [op_date, description, float(amount) if is_income else -float(amount), round(float(balance), 2)]
+
+def write_statement_file(rows, file_format=None):
+    """كتابة صفوف الكشف في ملف بالذاكرة صفاً صفاً (CSV أو XLSX بوضع الكتابة فقط)"""
+    from io import BytesIO, TextIOWrapper
+    
+    file_format = file_format or STATEMENT_FILE_FORMAT
+    output = BytesIO()
+    if file_format == 'csv':
+        import csv
+        # utf-8-sig حتى يفتح Excel الملف بالعربية بشكل صحيح
+        text = TextIOWrapper(output, encoding='utf-8-sig', newline='')
+        writer = csv.writer(text)
+        writer.writerow(_STATEMENT_FILE_HEADER)
+        writer.writerows(rows)
+        text.detach()  # نفصل الغلاف حتى لا يغلق BytesIO
+    else:
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('كشف حساب')
+        sheet.append(_STATEMENT_FILE_HEADER)
+        for row in rows:
+            sheet.append(row)
+        workbook.save(output)
+    output.seek(0)
+    return output
+
+def send_statement_file(update, account_name, caption, rows):
+    """إرسال الكشف كملف XLSX أو CSV"""
+    file_format = 'csv' if STATEMENT_FILE_FORMAT == 'csv' else 'xlsx'
+    statement_file = write_statement_file(rows, file_format)
+    statement_file.name = f"كشف_حساب_{account_name}.{file_format}"
+    update.message.reply_document(document=statement_file, caption=caption)
+
 
 
 @restricted
 def handle_account_statement(update: Update, context: CallbackContext):
     try:
         account_input = update.message.text.strip()
-        accounts, transactions, transfers = load_data()
+        accounts = load_accounts()
         
         # البحث عن اسم الحساب
         account_name = get_account_name(account_input, accounts)
         if not account_name:
-            update.message.reply_text("❌ الحساب غير موجود!")
+            update.message.reply_text(account_not_found_message(account_input, accounts))
             return ConversationHandler.END
         
         # تنظيف اسم الحساب من الإيموجي للعرض
@@ -1683,18 +3843,21 @@ def handle_account_statement(update: Update, context: CallbackContext):
         current_balance = account_info['الرصيد']
         account_type = account_info['النوع']
         
-        # تصفية المعاملات والتحويلات
-        account_transactions = transactions[transactions['الحساب'] == account_name]
-        outgoing_transfers = transfers[transfers['من حساب'] == account_name]
-        incoming_transfers = transfers[transfers['إلى حساب'] == account_name]
+        # عمليات الحساب من فهرس الأرصدة، مقسمة حسب النوع بترتيب تسجيلها
+        statement = get_account_index(account_name)
+        operations = statement['frame'].sort_values('seq')
+        account_transactions = operations[operations['rank'] == 0]
+        outgoing_transfers = operations[operations['rank'] == _OPERATION_RANK['تحويل صادر']]
+        incoming_transfers = operations[operations['rank'] == _OPERATION_RANK['تحويل وارد']]
         
-        # حساب الرصيد الافتتاحي
-        total_income = account_transactions[account_transactions['النوع'] == 'دخل']['المبلغ'].sum()
-        total_expenses = account_transactions[account_transactions['النوع'] == 'مصروف']['المبلغ'].sum()
-        total_incoming_transfers = incoming_transfers['المبلغ'].sum()
-        total_outgoing_transfers = outgoing_transfers['المبلغ'].sum()
+        # الرصيد الافتتاحي والإجماليات
+        totals = statement['totals']
+        total_income = totals['دخل']
+        total_expenses = totals['مصروف']
+        total_incoming_transfers = totals['تحويل وارد']
+        total_outgoing_transfers = totals['تحويل صادر']
         
-        opening_balance = current_balance + total_expenses - total_income + total_outgoing_transfers - total_incoming_transfers
+        opening_balance = statement['opening']
         
         # إنشاء تقرير منظم
         message = f"📊 *كشف حساب: {cleaned_account_name}*\n"
@@ -1712,22 +3875,22 @@ def handle_account_statement(update: Update, context: CallbackContext):
             message += "لا توجد معاملات\n\n"
         else:
             # الدخل
-            income_transactions = account_transactions[account_transactions['النوع'] == 'دخل']
+            income_transactions = account_transactions[account_transactions['type'] == 'دخل']
             if not income_transactions.empty:
                 message += "↙️ *الدخل:*\n"
-                for _, transaction in income_transactions.iterrows():
-                    category_escaped = escape_markdown(str(transaction['التصنيف']), version=2)
-                    message += f"   + {transaction['المبلغ']:,.0f} ريال - {category_escaped} ({transaction['التاريخ']})\n"
-                message += f"   المجموع: +{income_transactions['المبلغ'].sum():,.0f} ريال\n\n"
+                for amount, category, date in zip(income_transactions['amount'], income_transactions['description'], income_transactions['date']):
+                    category_escaped = escape_markdown(str(category), version=1)
+                    message += f"   + {amount:,.0f} ريال - {category_escaped} ({date})\n"
+                message += f"   المجموع: +{total_income:,.0f} ريال\n\n"
             
             # المصروفات
-            expense_transactions = account_transactions[account_transactions['النوع'] == 'مصروف']
+            expense_transactions = account_transactions[account_transactions['type'] == 'مصروف']
             if not expense_transactions.empty:
                 message += "↗️ *المصروفات:*\n"
-                for _, transaction in expense_transactions.iterrows():
-                    category_escaped = escape_markdown(str(transaction['التصنيف']), version=2)
-                    message += f"   - {transaction['المبلغ']:,.0f} ريال - {category_escaped} ({transaction['التاريخ']})\n"
-                message += f"   المجموع: -{expense_transactions['المبلغ'].sum():,.0f} ريال\n\n"
+                for amount, category, date in zip(expense_transactions['amount'], expense_transactions['description'], expense_transactions['date']):
+                    category_escaped = escape_markdown(str(category), version=1)
+                    message += f"   - {amount:,.0f} ريال - {category_escaped} ({date})\n"
+                message += f"   المجموع: -{total_expenses:,.0f} ريال\n\n"
         
         # التحويلات
         message += "🔄 *التحويلات*\n"
@@ -1739,20 +3902,18 @@ def handle_account_statement(update: Update, context: CallbackContext):
             # التحويلات الواردة
             if not incoming_transfers.empty:
                 message += "⬅️ *التحويلات الواردة:*\n"
-                for _, transfer in incoming_transfers.iterrows():
-                    from_acc_clean = re.sub(r'[^\w\s]', '', transfer['من حساب']).strip()
-                    from_acc_escaped = escape_markdown(from_acc_clean, version=2)
-                    message += f"   + {transfer['المبلغ']:,.0f} ريال من {from_acc_escaped} ({transfer['التاريخ']})\n"
-                message += f"   المجموع: +{incoming_transfers['المبلغ'].sum():,.0f} ريال\n\n"
+                for amount, from_acc_clean, date in zip(incoming_transfers['amount'], incoming_transfers['counterparty'], incoming_transfers['date']):
+                    from_acc_escaped = escape_markdown(from_acc_clean, version=1)
+                    message += f"   + {amount:,.0f} ريال من {from_acc_escaped} ({date})\n"
+                message += f"   المجموع: +{total_incoming_transfers:,.0f} ريال\n\n"
             
             # التحويلات الصادرة
             if not outgoing_transfers.empty:
                 message += "➡️ *التحويلات الصادرة:*\n"
-                for _, transfer in outgoing_transfers.iterrows():
-                    to_acc_clean = re.sub(r'[^\w\s]', '', transfer['إلى حساب']).strip()
-                    to_acc_escaped = escape_markdown(to_acc_clean, version=2)
-                    message += f"   - {transfer['المبلغ']:,.0f} ريال إلى {to_acc_escaped} ({transfer['التاريخ']})\n"
-                message += f"   المجموع: -{outgoing_transfers['المبلغ'].sum():,.0f} ريال\n\n"
+                for amount, to_acc_clean, date in zip(outgoing_transfers['amount'], outgoing_transfers['counterparty'], outgoing_transfers['date']):
+                    to_acc_escaped = escape_markdown(to_acc_clean, version=1)
+                    message += f"   - {amount:,.0f} ريال إلى {to_acc_escaped} ({date})\n"
+                message += f"   المجموع: -{total_outgoing_transfers:,.0f} ريال\n\n"
         
         # الملخص المالي
         message += "🧮 *الملخص المالي*\n"
@@ -1785,14 +3946,17 @@ def handle_account_statement(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 def calculate_budget():
-    """حساب الموازنة الإجمالية (مجموع كل الحسابات مطروحاً منها 800000)"""
-    accounts, _, _ = load_data()
-    total_balance = accounts['الرصيد'].sum()
-    budget = total_balance - 800000
-    return budget
+    """حساب الموازنة الإجمالية (مجموع كل الحسابات مطروحاً منها BUDGET_BASELINE)"""
+    return get_total_balance() - BUDGET_BASELINE
 
 def main():
-    init_excel_file()
+    init_storage()
+    build_duplicate_index()
+    build_merchant_categories()
+    build_monthly_spend()
+    build_rollups()
+    build_checkpoints()
+    build_daily_balances()
     
     updater = Updater(TELEGRAM_BOT_TOKEN)
     dispatcher = updater.dispatcher
@@ -1806,7 +3970,9 @@ def main():
         MessageHandler(Filters.regex('^📋 كشف حساب$'), account_statement),
         MessageHandler(Filters.regex('^📋 كشف حساب رصيد العملية$'), account_statement_balance),
         MessageHandler(Filters.regex('^📅 كشف بالتاريخ$'), handle_dated_statement),
-        MessageHandler(Filters.regex('^🏦 معالجة رسالة بنك$'), process_bank_message)
+        MessageHandler(Filters.regex('^🏦 معالجة رسالة بنك$'), process_bank_message),
+        MessageHandler(Filters.regex('^📥 استيراد رسائل بنك$'), bulk_import),
+        CommandHandler('import', bulk_import)
     ],
     states={
         ADD_EXPENSE: [MessageHandler(Filters.text & ~Filters.command, handle_add_expense)],
@@ -1819,12 +3985,24 @@ def main():
         DATE_STATEMENT_ACCOUNT: [MessageHandler(Filters.text & ~Filters.command, handle_dated_statement)],
         DATE_STATEMENT_DATES: [MessageHandler(Filters.text & ~Filters.command, handle_dated_statement)],
         PROCESS_BANK_MSG: [MessageHandler(Filters.text & ~Filters.command, handle_bank_message)],
-        CONFIRM_TRANSACTION: [MessageHandler(Filters.text & ~Filters.command, handle_transaction_confirmation)]
+        CONFIRM_TRANSACTION: [MessageHandler(Filters.text & ~Filters.command, handle_transaction_confirmation)],
+        BULK_IMPORT: [MessageHandler((Filters.text & ~Filters.command) | Filters.document, handle_bulk_import)],
+        BULK_IMPORT_CONFIRM: [MessageHandler(Filters.text & ~Filters.command, handle_bulk_import_confirmation)]
     },
     fallbacks=[CommandHandler('cancel', cancel)]
 )
     
     dispatcher.add_handler(CommandHandler("start", start))
+    dispatcher.add_handler(CommandHandler("cache", show_cache_stats))
+    dispatcher.add_handler(CommandHandler("compact", compact_now))
+    dispatcher.add_handler(CommandHandler("export", export_excel))
+    dispatcher.add_handler(CommandHandler("reports", show_reports))
+    dispatcher.add_handler(CommandHandler("balance", show_balance_history))
+    dispatcher.add_handler(CallbackQueryHandler(handle_statement_page, pattern=r'^stmt:'))
+    
+    # دمج سجل العمليات في ملف Excel والتحقق من نقاط الأرصدة بشكل دوري
+    updater.job_queue.run_repeating(compact_journal_job, interval=JOURNAL_COMPACT_INTERVAL, first=JOURNAL_COMPACT_INTERVAL)
+    updater.job_queue.run_repeating(reload_rules_job, interval=RULES_RELOAD_INTERVAL, first=RULES_RELOAD_INTERVAL)
     dispatcher.add_handler(conv_handler)
     dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
     # === إضافة keep_alive هنا ===
@@ -1833,6 +4011,10 @@ def main():
     print("🤖 البوت يعمل...")
     updater.start_polling()
     updater.idle()
+    
+    # دمج ما تبقى في السجل وحفظ التصنيفات المتعلمة قبل الإغلاق
+    compact_journal()
+    save_merchant_categories()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,59 @@
+import importlib
+import os
+import shutil
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'test')
+
+
+@pytest.fixture(params=['excel', 'sqlite'])
+def finance(request, tmp_path, monkeypatch):
+    """نسخة جديدة من الوحدة تعمل على نسخة من ملف البيانات في مجلد مؤقت، لكل طبقة تخزين"""
+    shutil.copy(os.path.join(ROOT, 'financial_tracker.xlsx'), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('STORAGE_BACKEND', request.param)
+    monkeypatch.setenv('SQLITE_FILE', str(tmp_path / 'financial_tracker.db'))
+    import finance
+    finance = importlib.reload(finance)
+    finance.init_storage()
+    yield finance
+    if finance._SQLITE_CONNECTION is not None:
+        finance._SQLITE_CONNECTION.close()
+
+
+class FakeMessage:
+    """رسالة تيليجرام تحفظ الردود بدل إرسالها"""
+
+    def __init__(self, text):
+        self.text = text
+        self.document = None
+        self.replies = []
+
+    def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+
+class FakeUpdate:
+    def __init__(self, text, user_id):
+        self.message = FakeMessage(text)
+        self.effective_user = SimpleNamespace(id=user_id)
+        self.callback_query = None
+
+
+@pytest.fixture
+def send(finance):
+    """استدعاء معالج برسالة من مستخدم مسموح له، وإرجاع الردود"""
+    context = SimpleNamespace(user_data={}, bot_data={}, args=[])
+
+    def send(handler, text):
+        update = FakeUpdate(text, finance.ALLOWED_USER_IDS[0])
+        handler(update, context)
+        return update.message.replies
+    send.context = context
+    return send
@@ -0,0 +1,65 @@
+import pandas as pd
+import pytest
+
+import finance
+
+NAMES = ['🏛 راجحي ', '🏛 أهلي 121', '🏛 أهلي 136', '👤 ابو مسير', '👤 العم أبو عمر', '💵 جيب', '🏦 مكة']
+
+
+@pytest.fixture
+def accounts():
+    return pd.DataFrame({'اسم الحساب': NAMES, 'النوع': 'بنك', 'الرصيد': 0.0})
+
+
+@pytest.mark.parametrize('user_input, expected', [
+    ('راجحي', '🏛 راجحي '),
+    ('  🏛 راجحي', '🏛 راجحي '),
+    ('أهلي 136', '🏛 أهلي 136'),
+    ('اهلي 121', '🏛 أهلي 121'),
+    ('مكه', '🏦 مكة'),
+    ('مسير', '👤 ابو مسير'),
+    ('جي', '💵 جيب'),
+])
+def test_unique_match(accounts, user_input, expected):
+    assert finance.find_account_names(user_input, accounts) == [expected]
+    assert finance.get_account_name(user_input, accounts) == expected
+
+
+def test_ambiguous_match(accounts):
+    assert finance.find_account_names('أهلي', accounts) == ['🏛 أهلي 121', '🏛 أهلي 136']
+    assert finance.get_account_name('أهلي', accounts) is None
+    message = finance.account_not_found_message('أهلي', accounts)
+    assert message.startswith('⚠️') and 'أهلي 121' in message and 'أهلي 136' in message
+
+
+def test_prefix_and_word_prefix_are_one_tier(accounts):
+    # بداية الاسم لا تخفي الحساب الذي تبدأ إحدى كلماته بالنص
+    assert finance.find_account_names('ابو', accounts) == ['👤 ابو مسير', '👤 العم أبو عمر']
+    assert finance.get_account_name('ابو', accounts) is None
+    assert finance.get_account_name('ابو عمر', accounts) == '👤 العم أبو عمر'
+
+
+def test_help_examples_name_one_account(finance, send):
+    accounts = finance.load_accounts()
+    for handler in (finance.add_expense, finance.add_income):
+        examples = [line for line in send(handler, '')[0].splitlines() if line.startswith('• `')]
+        for example in examples:
+            account = example.strip('• `').rsplit(',', 1)[1]
+            assert len(finance.find_account_names(account, accounts)) == 1, example
+
+
+def test_exact_match_beats_longer_names(accounts):
+    accounts = pd.concat([accounts, pd.DataFrame({'اسم الحساب': ['💵 جيب 2'], 'النوع': 'نقد', 'الرصيد': 0.0})])
+    assert finance.find_account_names('جيب', accounts) == ['💵 جيب']
+
+
+def test_no_match(accounts):
+    assert finance.find_account_names('بطاقة', accounts) == []
+    assert finance.find_account_names('🏛', accounts) == []
+    assert finance.account_not_found_message('بطاقة', accounts) == "❌ الحساب غير موجود!"
+
+
+def test_index_follows_account_changes(accounts):
+    assert finance.get_account_name('سامبا', accounts) is None
+    accounts = pd.concat([accounts, pd.DataFrame({'اسم الحساب': ['🏛 سامبا'], 'النوع': 'بنك', 'الرصيد': 0.0})])
+    assert finance.get_account_name('سامبا', accounts) == '🏛 سامبا'
@@ -0,0 +1,63 @@
+import finance as finance_module
+
+PURCHASE = "شراء عبر نقاط البيع\nبطاقة: 0103;مدى-أبل باي\nمبلغ: SAR 45.50\nلدى: AL FAISAL BAKERY\nفي: 25-09-25 14:32"
+SUPERMARKET = "شراء عبر نقاط البيع\nبطاقة: 0105;مدى\nمبلغ: SAR 312.75\nلدى: PRICE REDUCER 22\nفي: 03-09-25 20:11"
+UNPARSED = "عزيزنا العميل\nنود إعلامكم بتحديث تطبيق البنك"
+
+
+def test_split_bank_messages():
+    text = f"{PURCHASE}\n\n{SUPERMARKET}\n-----\n{UNPARSED}\n"
+    assert finance_module.split_bank_messages(text) == [PURCHASE, SUPERMARKET, UNPARSED]
+
+
+def test_read_bank_messages_csv():
+    text = 'date,body\n2025-09-25,"' + PURCHASE + '"\n2025-09-03,"' + SUPERMARKET + '"\n'
+    assert finance_module.read_bank_messages_csv(text) == [PURCHASE, SUPERMARKET]
+    # بدون عنوان معروف: أطول خلية في كل صف
+    assert finance_module.read_bank_messages_csv('1,"' + PURCHASE + '"\n') == [PURCHASE]
+
+
+def test_parse_row_numbers():
+    assert finance_module._parse_row_numbers("رفض 3 7 10-12 40", 12) == {2, 6, 9, 10, 11}
+
+
+def _start_batch(finance, send):
+    send(finance.bulk_import, '📥 استيراد رسائل')
+    # تيليجرام يقسم اللصق الطويل إلى عدة رسائل
+    first_line, rest = UNPARSED.split('\n', 1)
+    send(finance.handle_bulk_import, f"{PURCHASE}\n\n{SUPERMARKET}\n\n{first_line}")
+    send(finance.handle_bulk_import, rest)
+    return send(finance.handle_bulk_import, 'تم')
+
+
+def test_bulk_import_summary(finance, send):
+    summary = '\n'.join(_start_batch(finance, send))
+    assert '3 رسالة' in summary
+    assert 'مقبولة: 2 | ❌ مرفوضة: 1' in summary
+    assert send.context.user_data['bulk_import']['accepted'] == {0, 1}
+
+
+def test_bulk_import_accept_and_reject(finance, send):
+    transactions_before = len(finance.load_data()[1])
+    _start_batch(finance, send)
+    assert 'مقبولة: 1 | ❌ مرفوضة: 2' in send(finance.handle_bulk_import_confirmation, 'رفض 2')[0]
+    # الرسالة التي لم تُفهم لا يمكن قبولها
+    assert 'مقبولة: 1 |' in send(finance.handle_bulk_import_confirmation, 'قبول 3')[0]
+    assert 'مقبولة: 2 |' in send(finance.handle_bulk_import_confirmation, 'قبول 2')[0]
+    send(finance.handle_bulk_import_confirmation, 'رفض 1')
+    replies = send(finance.handle_bulk_import_confirmation, 'نعم')
+    assert 'تم تسجيل 1 معاملة' in replies[0]
+    assert 'bulk_import' not in send.context.user_data
+    transactions = finance.load_data()[1]
+    assert len(transactions) == transactions_before + 1
+    recorded = transactions.iloc[-1]
+    assert (recorded['المبلغ'], recorded['الحساب'], recorded['التاريخ']) == (312.75, '🏛 أهلي 136', '2025-09-03')
+
+
+def test_bulk_import_cancel(finance, send):
+    transactions_before = len(finance.load_data()[1])
+    _start_batch(finance, send)
+    send(finance.handle_bulk_import_confirmation, 'رفض 1-3')
+    assert 'لا توجد رسائل مقبولة' in send(finance.handle_bulk_import_confirmation, 'نعم')[0]
+    assert 'تم إلغاء' in send(finance.handle_bulk_import_confirmation, 'لا')[0]
+    assert len(finance.load_data()[1]) == transactions_before
@@ -0,0 +1,27 @@
+import json
+
+
+def test_learned_category_saved_in_batches(finance):
+    finance.record_transaction({
+        'التاريخ': '2025-10-01', 'النوع': 'مصروف', 'المبلغ': 12.5, 'الحساب': '💵 جيب',
+        'التصنيف': 'هدايا', 'الوصف': 'محل الورد 204'})
+    assert finance.categorize_merchant('محل الورد 311') == 'هدايا'
+    assert finance._MERCHANT_CATEGORIES['dirty']
+
+    finance.save_merchant_categories()
+    assert not finance._MERCHANT_CATEGORIES['dirty']
+    with open(finance.MERCHANT_CATEGORIES_FILE, encoding='utf-8') as f:
+        assert ['محل الورد', 'هدايا'] in json.load(f)
+
+    finance._MERCHANT_CATEGORIES['entries'].clear()
+    finance.build_merchant_categories()
+    assert finance.learned_category('محل الورد') == 'هدايا'
+
+
+def test_rule_category_not_stored(finance):
+    finance.learn_merchant_category('LANDMARK 12', '🍔 طعام')
+    assert finance.categorize_merchant('landmark') == '🍔 طعام'
+    # العودة لتصنيف القاعدة الثابتة تحذف الجهة من المتعلمة
+    finance.learn_merchant_category('LANDMARK 12', '👕 ملابس')
+    assert 'landmark' not in finance._MERCHANT_CATEGORIES['entries']
+    assert finance.categorize_merchant('landmark') == '👕 ملابس'
@@ -0,0 +1,40 @@
+import datetime
+
+import pytest
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('2025-09-03', '2025-09-03'),
+    ('2025/9/3', '2025-09-03'),
+    ('03-09-2025', '2025-09-03'),
+    ('3/9/25', '2025-09-03'),
+    ('03.09.2025 14:05', '2025-09-03'),
+    ('2025-09-03T14:05:00', '2025-09-03'),
+    ('1/1/70', '1970-01-01'),
+    ('29-02-2024', '2024-02-29'),
+    (' 2025-09-03 ', '2025-09-03'),
+])
+def test_normalize_date_text(finance, text, expected):
+    assert finance._normalize_date_text(text) == expected
+
+
+@pytest.mark.parametrize('text', [
+    '', 'اليوم', '2025-13-01', '31-04-2025', '29-02-2025', '2025-09', '3-9-2025-1', '123-09-2025', '2025-0a-03',
+])
+def test_normalize_date_text_rejects(finance, text):
+    assert finance._normalize_date_text(text) is None
+
+
+def test_normalize_date_values(finance):
+    assert finance.normalize_date(datetime.datetime(2025, 9, 3, 10, 30)) == '2025-09-03'
+    assert finance.normalize_date(None) is None
+    assert finance.normalize_date(float('nan')) is None
+
+
+def test_append_records_keeps_caller_rows(finance):
+    row = {'التاريخ': '03/09/2025', 'النوع': 'مصروف', 'المبلغ': 10.0, 'الحساب': '💵 جيب',
+           'التصنيف': 'طعام', 'الوصف': 'اختبار'}
+    finance._append_records([{'kind': 'transaction', 'row': row}])
+    assert row['التاريخ'] == '03/09/2025'
+    transactions = finance.load_data()[1]
+    assert transactions['التاريخ'].iloc[-1] == '2025-09-03'
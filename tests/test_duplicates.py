@@ -0,0 +1,63 @@
+import finance as finance_module
+
+PURCHASE = "شراء عبر نقاط البيع\nبطاقة: 0103;مدى-أبل باي\nمبلغ: SAR 45.50\nلدى: AL FAISAL BAKERY\nفي: 25-09-25 14:32"
+
+
+def _row(finance, **changes):
+    row = {'التاريخ': '2025-09-25', 'النوع': 'مصروف', 'المبلغ': 45.5, 'الحساب': '🏛 أهلي 121',
+           'التصنيف': '🍔 طعام', 'الوصف': 'AL FAISAL BAKERY'}
+    row.update(changes)
+    return row
+
+
+def test_message_hash_ignores_spacing_case_and_letter_forms():
+    assert finance_module.message_hash("Purchase  at\nAL أحمد") == finance_module.message_hash("purchase at al احمد ")
+    assert finance_module.message_hash("مبلغ 45") != finance_module.message_hash("مبلغ 46")
+
+
+def test_transaction_fingerprint():
+    fingerprint = finance_module.transaction_fingerprint
+    assert fingerprint(45.5, '2025-09-25', '🏛 أهلي 121', 'Al Faisal Bakery') == \
+        fingerprint('45.50', '2025-09-25 14:32', 'اهلي 121', 'AL FAISAL BAKERY!')
+    assert fingerprint(45.5, '2025-09-25', 'أهلي 121', float('nan')) == fingerprint(45.5, '2025-09-25', 'أهلي 121', '')
+    assert fingerprint(45.5, '2025-09-25', 'أهلي 121', '') != fingerprint(45.5, '2025-09-26', 'أهلي 121', '')
+
+
+def test_recorded_transaction_is_found(finance):
+    finance.build_duplicate_index()
+    assert finance.find_duplicate(_row(finance)) is None
+    finance.record_transaction(_row(finance))
+    # البصمة أضيفت تدريجياً دون إعادة بناء الفهرس
+    assert finance._DUPLICATE_INDEX['version'] == finance._LEDGER_CACHE['version']
+    assert finance.find_duplicate(_row(finance, الوصف='al faisal bakery')) is not None
+    assert finance.find_duplicate(_row(finance, المبلغ=45.0)) is None
+
+
+def test_remembered_message_is_found_after_restart(finance):
+    finance.build_duplicate_index()
+    finance.remember_bank_messages([PURCHASE])
+    other_row = _row(finance, المبلغ=1.0)
+    assert finance.find_duplicate(other_row, PURCHASE.replace('\n', '\n  ')) == "نفس رسالة البنك سُجلت من قبل"
+    finance._DUPLICATE_INDEX['messages'] = set()
+    finance.build_duplicate_index()
+    assert finance.find_duplicate(other_row, PURCHASE) is not None
+
+
+def test_bulk_import_excludes_duplicates(finance, send):
+    finance.build_duplicate_index()
+    finance.remember_bank_messages([PURCHASE])
+    send(finance.bulk_import, '📥 استيراد رسائل')
+    send(finance.handle_bulk_import, PURCHASE)
+    summary = '\n'.join(send(finance.handle_bulk_import, 'تم'))
+    assert '🔁' in summary and 'مقبولة: 0 |' in summary
+    # يمكن قبول الرسالة المكررة يدوياً
+    assert 'مقبولة: 1 |' in send(finance.handle_bulk_import_confirmation, 'قبول 1')[0]
+
+
+def test_same_transaction_twice_in_one_batch(finance):
+    finance.build_duplicate_index()
+    accounts = finance.load_accounts()
+    # نفس المعاملة في رسالتين مختلفتين (وقت مختلف في نفس اليوم)، ثم نفس الرسالة مرة ثانية
+    other_copy = PURCHASE.replace('14:32', '14:35')
+    results = finance.parse_bank_messages([PURCHASE, other_copy, PURCHASE], accounts)
+    assert [result['duplicate'] for result in results] == [None, "مكررة في نفس الدفعة", "مكررة في نفس الدفعة"]
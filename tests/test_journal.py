@@ -0,0 +1,63 @@
+import os
+import warnings
+
+import pandas as pd
+import pytest
+
+
+def _cold_load(finance):
+    """قراءة البيانات من الملفات كما عند التشغيل"""
+    finance._LEDGER_CACHE['data'] = None
+    return finance.load_data()
+
+
+def _assert_same_data(left, right):
+    for left_frame, right_frame in zip(left, right):
+        pd.testing.assert_frame_equal(left_frame.reset_index(drop=True), right_frame.reset_index(drop=True),
+                                      check_dtype=False)
+
+
+def _record_sample(finance):
+    accounts = finance.load_data()[0]
+    first, second = accounts['اسم الحساب'].iloc[1], accounts['اسم الحساب'].iloc[2]
+    finance.record_transaction({'التاريخ': '2025-09-01', 'النوع': 'مصروف', 'المبلغ': 12.5,
+                                'الحساب': first, 'التصنيف': 'طعام', 'الوصف': 'اختبار'})
+    finance.record_transfer({'التاريخ': '2025-09-02', 'من حساب': first, 'إلى حساب': second, 'المبلغ': 100.25})
+    return first, second
+
+
+def test_journal_rows_survive_reload(finance):
+    before = finance.load_data()
+    first, second = _record_sample(finance)
+    cached = finance.load_data()
+    assert len(cached[1]) == len(before[1]) + 1
+    assert len(cached[2]) == len(before[2]) + 1
+    balances = cached[0].set_index('اسم الحساب')['الرصيد']
+    expected = before[0].set_index('اسم الحساب')['الرصيد']
+    assert balances[first] == expected[first] - 12.5 - 100.25
+    assert balances[second] == expected[second] + 100.25
+    _assert_same_data(cached, _cold_load(finance))
+
+
+def test_compaction_merges_journal(finance):
+    if finance.STORAGE_BACKEND == 'sqlite':
+        pytest.skip('SQLite يكتب كل عملية مباشرة في القاعدة')
+    _record_sample(finance)
+    cached = finance.load_data()
+    assert finance.compact_journal() == 2
+    assert not os.path.exists(finance.JOURNAL_FILE)
+    assert finance.compact_journal() == 0
+    _assert_same_data(cached, _cold_load(finance))
+
+
+def test_whole_number_balances_accept_fractions(finance):
+    accounts, transactions, transfers = finance.load_data()
+    finance.save_data(accounts.astype({'الرصيد': 'int64'}), transactions, transfers)
+    accounts = _cold_load(finance)[0]
+    name = accounts['اسم الحساب'].iloc[1]
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', FutureWarning)
+        finance.record_transaction({'التاريخ': '2025-09-01', 'النوع': 'دخل', 'المبلغ': 0.5,
+                                    'الحساب': name, 'التصنيف': 'اختبار', 'الوصف': ''})
+    balance = finance.load_data()[0].set_index('اسم الحساب')['الرصيد'][name]
+    assert balance == accounts.set_index('اسم الحساب')['الرصيد'][name] + 0.5
@@ -0,0 +1,70 @@
+import re
+
+import finance
+
+_TAG = re.compile(r'<[^>]*>')
+
+
+def _balanced(part):
+    """كل علامة مفتوحة في الجزء مغلقة فيه"""
+    return finance._apply_html_tags([], part) == []
+
+
+def _text(parts):
+    return ''.join(_TAG.sub('', part) for part in parts)
+
+
+def test_short_message_is_unchanged():
+    assert finance.split_long_message("<b>قصير</b>", 100) == ["<b>قصير</b>"]
+
+
+def test_parts_fit_and_balance_tags():
+    message = "<b>كشف حساب</b>\n<pre>" + "".join(f"سطر رقم {i} &amp; تفاصيل\n" for i in range(200)) + "</pre>\n<i>النهاية</i>"
+    parts = finance.split_long_message(message, 500)
+    assert len(parts) > 1
+    assert all(len(part) <= 500 for part in parts)
+    assert all(_balanced(part) for part in parts)
+    # العلامة المفتوحة عند القطع يُعاد فتحها في الجزء التالي
+    assert all(part.startswith('<pre>') for part in parts[1:-1])
+    assert _text(parts) == _TAG.sub('', message)
+
+
+def test_long_line_is_split_without_cutting_entities():
+    message = "<b>" + "أ&amp;ب " * 400 + "</b>"
+    parts = finance.split_long_message(message, 97)
+    assert all(len(part) <= 97 for part in parts)
+    assert all(_balanced(part) for part in parts)
+    assert all(re.search(r'&(?!amp;)', _TAG.sub('', part)) is None for part in parts)
+    assert _text(parts) == _TAG.sub('', message)
+
+
+def test_streamed_pieces_match_whole_message():
+    message = "<b>كشف</b>\n<pre>" + "".join(f"{i} &lt;قيد&gt; &amp; وصف\n" for i in range(150)) + "</pre>"
+    # أجزاء تقطع الأسطر والعلامات والكيانات في أماكن عشوائية
+    pieces = [message[i:i + 37] for i in range(0, len(message), 37)]
+    parts = list(finance.iter_message_parts(pieces, 400))
+    assert parts == list(finance.iter_message_parts([message], 400))
+    assert all(len(part) <= 400 and _balanced(part) for part in parts)
+    assert all(re.search(r'&(?!(amp|lt|gt);)', _TAG.sub('', part)) is None for part in parts)
+    assert _text(parts) == _TAG.sub('', message)
+
+
+def test_nested_tags_are_reopened_in_order():
+    message = "<b><i>" + "".join(f"سطر {i}\n" for i in range(100)) + "</i></b>"
+    parts = list(finance.iter_message_parts([message], 120))
+    assert len(parts) > 1
+    assert all(part.startswith('<b><i>') and part.endswith('</i></b>') for part in parts)
+    assert all(_balanced(part) for part in parts)
+
+
+def test_first_part_is_yielded_before_the_input_ends():
+    consumed = []
+
+    def pieces():
+        for i in range(1000):
+            consumed.append(i)
+            yield f"سطر رقم {i}\n"
+
+    first = next(finance.iter_message_parts(pieces(), 200))
+    assert len(first) <= 200
+    assert len(consumed) < 1000
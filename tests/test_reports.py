@@ -0,0 +1,20 @@
+import pytest
+
+
+def _transaction(kind, amount, category='🍔 طعام'):
+    return {'kind': 'transaction', 'row': {
+        'التاريخ': '2025-09-10', 'النوع': kind, 'المبلغ': amount, 'الحساب': '💵 جيب',
+        'التصنيف': category, 'الوصف': 'اختبار'}}
+
+
+def test_unknown_kinds_are_left_out_of_the_totals(finance):
+    finance.build_rollups()
+    before = dict(finance.report_summary(months=120)['months'])['2025-09']
+    finance._append_records([_transaction('مصروف', 40.0), _transaction('دخل', 100.0),
+                             _transaction('تحويل', 158.67)])
+    after = dict(finance.report_summary(months=120)['months'])['2025-09']
+    assert set(after) == {'دخل', 'مصروف', 'تحويلات', 'العدد'}
+    assert after['مصروف'] == pytest.approx(before['مصروف'] + 40.0)
+    assert after['دخل'] == pytest.approx(before['دخل'] + 100.0)
+    assert after['تحويلات'] == pytest.approx(before['تحويلات'])
+    assert after['العدد'] == before['العدد'] + 3
@@ -0,0 +1,56 @@
+import json
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _write(path, rules):
+    path.write_text(json.dumps(rules, ensure_ascii=False), encoding='utf-8')
+    return str(path)
+
+
+def test_read_rules_file_normalizes_types(finance, tmp_path):
+    path = _write(tmp_path / 'rules.json', {
+        'account_mapping': {'0103': '🏛 أهلي 121'},
+        'allowed_user_ids': ['42', 7],
+        'monthly_budgets': {'categories': {'🍔 طعام': '1500'}},
+    })
+    account_mapping, auto_categories, allowed_user_ids, monthly_budgets = finance._read_rules_file(path)
+    assert account_mapping == {'0103': '🏛 أهلي 121'}
+    # القسم غير الموجود يبقى على قيمته الحالية
+    assert auto_categories == finance.AUTO_CATEGORIES
+    assert allowed_user_ids == [42, 7]
+    assert monthly_budgets == {'categories': {'🍔 طعام': 1500.0}, 'accounts': {}}
+
+
+@pytest.mark.parametrize('rules', [
+    [],
+    {'account_mapping': ['0103']},
+    {'auto_categories': 'coffee'},
+    {'allowed_user_ids': 42},
+    {'monthly_budgets': {'categories': ['🍔 طعام']}},
+])
+def test_read_rules_file_rejects_wrong_types(finance, tmp_path, rules):
+    with pytest.raises(ValueError):
+        finance._read_rules_file(_write(tmp_path / 'rules.json', rules))
+
+
+def test_invalid_rules_file_keeps_current_rules(finance, tmp_path, monkeypatch):
+    path = tmp_path / 'rules.json'
+    monkeypatch.setattr(finance, 'RULES_FILE', str(path))
+    _write(path, {'auto_categories': {'bookstore': '📚 كتب'}})
+    assert finance.reload_rules()
+    assert finance.match_category('BOOKSTORE 12') == '📚 كتب'
+
+    path.write_text('{"auto_categories": ', encoding='utf-8')
+    assert not finance.reload_rules()
+    assert finance.match_category('BOOKSTORE 12') == '📚 كتب'
+
+
+def test_example_rules_file_is_valid(finance):
+    example = os.path.join(ROOT, 'rules.example.json')
+    account_mapping, auto_categories, allowed_user_ids, monthly_budgets = finance._read_rules_file(example)
+    assert account_mapping and auto_categories and allowed_user_ids
+    assert set(monthly_budgets) == {'categories', 'accounts'}
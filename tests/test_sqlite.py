@@ -0,0 +1,40 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def sqlite_finance(finance):
+    if finance.STORAGE_BACKEND != 'sqlite':
+        pytest.skip('خاص بطبقة SQLite')
+    return finance
+
+
+def test_migration_copies_workbook(sqlite_finance):
+    finance = sqlite_finance
+    accounts, transactions, transfers = finance._read_workbook()
+    data = finance.load_data()
+    assert [len(frame) for frame in data] == [len(accounts), len(transactions), len(transfers)]
+
+
+def test_own_writes_do_not_reload(sqlite_finance):
+    finance = sqlite_finance
+    accounts = finance.load_data()[0]
+    misses = finance._LEDGER_CACHE['misses']
+    finance.record_transaction({'التاريخ': '2025-09-01', 'النوع': 'مصروف', 'المبلغ': 12.5,
+                                'الحساب': accounts['اسم الحساب'].iloc[1], 'التصنيف': 'طعام', 'الوصف': ''})
+    cached = finance.load_data()
+    # الكتابة من نفس الاتصال لا تغير data_version: العملية تُطبق على الكاش ولا يُعاد تحميل الجداول
+    assert finance._LEDGER_CACHE['misses'] == misses
+    with sqlite3.connect(finance.SQLITE_FILE) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM transactions").fetchone()[0] == len(cached[1])
+
+
+def test_external_write_reloads(sqlite_finance):
+    finance = sqlite_finance
+    accounts = finance.load_data()[0]
+    name = accounts['اسم الحساب'].iloc[1]
+    with sqlite3.connect(finance.SQLITE_FILE) as connection:
+        connection.execute("UPDATE accounts SET balance = balance + 1 WHERE name = ?", (name,))
+    reloaded = finance.load_data()[0].set_index('اسم الحساب')['الرصيد']
+    assert reloaded[name] == accounts.set_index('اسم الحساب')['الرصيد'][name] + 1
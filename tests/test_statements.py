@@ -0,0 +1,18 @@
+def test_statement_escapes_markdown_v1(finance, send):
+    accounts = finance.load_accounts()
+    name = accounts['اسم الحساب'].iloc[1]
+    finance.record_transaction({'التاريخ': '2025-09-01', 'النوع': 'مصروف', 'المبلغ': 10.0,
+                                'الحساب': name, 'التصنيف': 'قهوة_الصباح (2.5)', 'الوصف': ''})
+    message = '\n'.join(send(finance.handle_account_statement, name))
+    # الرسالة تُرسل بـ Markdown (الإصدار الأول): تُهرب _ فقط ولا تظهر شرطات قبل ( أو .
+    assert 'قهوة\\_الصباح (2.5)' in message
+
+
+def test_statement_balances_follow_index(finance, send):
+    accounts = finance.load_accounts()
+    name = accounts['اسم الحساب'].iloc[1]
+    index = finance.get_account_index(name)
+    frame = index['frame']
+    signed = frame['amount'].where(frame['is_income'], -frame['amount'])
+    current = accounts.set_index('اسم الحساب')['الرصيد'][name]
+    assert index['opening'] + signed.sum() == current